@@ -255,7 +255,9 @@ base_wlan_hal_dummy::base_wlan_hal_dummy(HALType type, const std::string &iface_
 
     std::string path = std::string(BEEROCKS_TMP_PATH) + "/" + get_iface_name();
     mkdir(path.c_str(), S_IRWXU | S_IRWXG | S_IROTH | S_IXOTH);
-    inotify_add_watch(m_fd_ext_events, path.c_str(), (IN_CREATE | IN_DELETE | IN_MODIFY));
+    // IN_MOVED_TO allows writing a batch of events to a temporary file and moving it in place.
+    inotify_add_watch(m_fd_ext_events, path.c_str(),
+                      (IN_CREATE | IN_DELETE | IN_MODIFY | IN_MOVED_TO));
 
     // Initialize the FSM
     fsm_setup();
@@ -359,7 +361,7 @@ bool base_wlan_hal_dummy::refresh_vaps_info(int id) { return true; }
 /**
  * @brief process simulated events
  *        events are expected to be simulated by writing the event
- *        string to the first line in the EVENT file.
+ *        string to the EVENT file, one event per line.
  *        For example, simulating client connected event:
  *        echo "STA_CONNECTED,11:22:33:44:55:66"
  *
@@ -397,40 +399,44 @@ bool base_wlan_hal_dummy::process_ext_events()
         LOG(DEBUG) << "Invalid event, missing " << event_file << " file";
         return true;
     }
+    // Process all events in the file, so many events can be simulated with a single write. A
+    // failing event doesn't prevent the following ones from being processed.
+    bool result = true;
     std::string event;
-    std::getline(stream, event);
-    if (event.empty()) {
-        LOG(DEBUG) << "Received empty event, ignoring";
-        return true;
-    }
-    LOG(DEBUG) << "Received event " << event;
-
-    parsed_obj_map_t event_obj;
-    map_event_obj_parser(event, event_obj);
-    //base_wlan_hal_dummy::parsed_obj_debug(event_obj);
-
-    // Process the event
-    if (event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE] == "EVENT") {
-        if (!process_dummy_event(event_obj)) {
-            LOG(ERROR) << "Failed processing DUMMY event: "
-                       << event_obj[DUMMY_EVENT_KEYLESS_PARAM_OPCODE];
-            return false;
+    while (std::getline(stream, event)) {
+        if (event.empty()) {
+            LOG(DEBUG) << "Received empty event, ignoring";
+            continue;
         }
-    }
-    // Process data
-    else if (event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE] == "DATA") {
-        if (!process_dummy_data(event_obj)) {
-            LOG(ERROR) << "Failed processing DUMMY data: "
-                       << event_obj[DUMMY_EVENT_KEYLESS_PARAM_OPCODE];
-            return false;
+        LOG(DEBUG) << "Received event " << event;
+
+        parsed_obj_map_t event_obj;
+        map_event_obj_parser(event, event_obj);
+        //base_wlan_hal_dummy::parsed_obj_debug(event_obj);
+
+        // Process the event
+        if (event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE] == "EVENT") {
+            if (!process_dummy_event(event_obj)) {
+                LOG(ERROR) << "Failed processing DUMMY event: "
+                           << event_obj[DUMMY_EVENT_KEYLESS_PARAM_OPCODE];
+                result = false;
+            }
+        }
+        // Process data
+        else if (event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE] == "DATA") {
+            if (!process_dummy_data(event_obj)) {
+                LOG(ERROR) << "Failed processing DUMMY data: "
+                           << event_obj[DUMMY_EVENT_KEYLESS_PARAM_OPCODE];
+                result = false;
+            }
+        } else {
+            LOG(ERROR) << "Unsupported type " << event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE];
+            result = false;
         }
-    } else {
-        LOG(ERROR) << "Unsupported type " << event_obj[DUMMY_EVENT_KEYLESS_PARAM_TYPE];
-        return false;
     }
 
     stream.close();
-    return true;
+    return result;
 }
 
 std::string base_wlan_hal_dummy::get_radio_mac()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import logging
 import socket
 from enum import Enum
-from typing import Dict
+from typing import Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -65,14 +66,92 @@ class tlv:
                                                            tlv_value=self.value)
 
 
+def parse_reply_line(line: str, verbose: bool = False) -> Optional[Dict[str, str]]:
+    """Parse a single line of a CAPI reply.
+
+    Parameters
+    ----------
+    line : str
+        The line received from the server.
+
+    verbose : bool
+        If True, print out the valid replies (RUNNING and COMPLETE).
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        None if more lines are expected, i.e. for an empty line or a `CAPIReply.RUNNING` message.
+        For a `CAPIReply.COMPLETE` message, the parameter,value pairs that follow it, as a dict.
+
+    Raises
+    ------
+    ValueError
+        If the server replied with `CAPIReply.INVALID`, `CAPIReply.ERROR` or something unknown.
+    """
+    r = line.strip()
+    if not r:
+        pass  # server replied with an empty line
+    elif CAPIReply.RUNNING.value in r:
+        if verbose:
+            print(r)
+    elif CAPIReply.COMPLETE.value in r:
+        if verbose:
+            print(r)
+        reply_value_str = r[len(CAPIReply.COMPLETE.value) + 1:].strip()
+        reply_values = reply_value_str.split(',')
+        return {k: v for k, v in zip(reply_values[::2], reply_values[1::2])}
+    elif CAPIReply.INVALID.value in r or CAPIReply.ERROR.value in r:
+        raise ValueError("Server replied with {}".format(r))
+    else:
+        raise ValueError("Received an unknown reply from the server:\n {}".format(r))
+    return None
+
+
+def format_start_wps_registration(band: str) -> str:
+    """Format the start_wps_registration command, see `UCCSocket.start_wps_registration`."""
+    return "start_wps_registration,band,{},WpsConfigMethod,PBC".format(band)
+
+
+def format_dev_get_parameter(parameter: str, **additional_parameters: str) -> str:
+    """Format the dev_get_parameter command, see `UCCSocket.dev_get_parameter`."""
+    command = "dev_get_parameter,program,map,parameter,{}".format(parameter)
+    if additional_parameters:
+        command += ',' + ','.join([','.join(param) for param in additional_parameters.items()])
+    return command
+
+
+def format_dev_send_1905(dest: str, message_type: int, *tlvs: tlv) -> str:
+    """Format the dev_send_1905 command, see `UCCSocket.dev_send_1905`."""
+    cmd = "DEV_SEND_1905,DestALid,{dest:s},MessageTypeValue,0x{message_type:04x}"\
+        .format(dest=dest, message_type=message_type)
+    if len(tlvs) > 1:
+        formatted_tlvs = [tlv.format(tlv_num + 1) for (tlv_num, tlv) in enumerate(tlvs)]
+        cmd += ',' + ','.join(formatted_tlvs)
+    elif tlvs:
+        cmd += ',' + tlvs[0].format()
+    return cmd
+
+
 class UCCSocket:
     """Abstraction of the target listening socket.
 
     It connects to the listener and it sends and receives
     CAPI commands from it.
+
+    By default, a new connection is opened for every command. In persistent mode, the connection
+    is kept open and reused for subsequent commands, and it is re-established automatically when
+    the device closes it.
+
+    Note that the listener on the device serves a single client at a time: when a new client
+    connects, the connection of the previous one is closed. A persistent connection is therefore
+    dropped whenever anything else connects to the device (e.g. an `AsyncUCCSocket`, or a manual
+    CAPI client). It is only re-established if the device did not reply to the command yet, so a
+    command in flight fails. Only use persistent mode when nothing else talks to the device.
     """
 
-    def __init__(self, host: str, port: int, timeout: int = 30):
+    RECV_SIZE = 4096
+
+    def __init__(self, host: str, port: int, timeout: int = 30, persistent: bool = False):
         """Constructor for UCCSocket
 
         Parameters
@@ -84,21 +163,36 @@ class UCCSocket:
         timeout: int
             (optional) The timeout for both creating a connection,
             and receiving or sending data.
+        persistent: bool
+            (optional) Keep the connection open between commands.
         """
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.persistent = persistent
+        self.conn = None
+        self.buffer = bytearray()
+        self.lines_received = 0
 
     def __enter__(self):
-        self.conn = socket.create_connection((self.host, self.port), self.timeout)
+        if not self.conn:
+            self.conn = socket.create_connection((self.host, self.port), self.timeout)
+            self.buffer = bytearray()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        # A failed command may leave unread replies on the connection, so don't reuse it.
+        if not self.persistent or exc_type:
+            self.close()
+
+    def close(self) -> None:
+        """Close the connection, if it is open."""
+        if self.conn:
+            self.conn.close()
+            self.conn = None
 
     def send_cmd(self, command: str) -> None:
         """Send a new CAPI command to the device.
-        If previous replies from the server were available, they will be discarded.
 
         Parameters
         ----------
@@ -107,7 +201,29 @@ class UCCSocket:
         """
         if command[-1] != "\n":
             command += "\n"
-        self.conn.send(command.encode("utf-8"))
+        self.conn.sendall(command.encode("utf-8"))
+
+    def _read_line(self) -> str:
+        """Read a single line from the connection.
+
+        Data received after the line is kept for the next call.
+
+        Raises
+        ------
+        ConnectionError
+            If the connection is closed by the device.
+        """
+        while True:
+            newline = self.buffer.find(b"\n")
+            if newline >= 0:
+                line = self.buffer[:newline].decode("utf-8")
+                del self.buffer[:newline + 1]
+                self.lines_received += 1
+                return line
+            data = self.conn.recv(self.RECV_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by {}:{}".format(self.host, self.port))
+            self.buffer.extend(data)
 
     def get_reply(self, verbose: bool = False) -> Dict[str, str]:
         """Wait until the server replies with a `CAPIReply` message other than `CAPIReply.RUNNING`.
@@ -128,34 +244,58 @@ class UCCSocket:
             parameter,value pairs. These are converted to a dict and returned. If the COMPLETE
             message has no parameters, an empty dict is returned.
         """
-        data = bytearray()
         while True:
-            # resetting data to the next line:
-            data = data[data.find(b"\n") + 1:]
-            while b"\n" not in data:
-                # reading until there is a newline
-                data.extend(self.conn.recv(256))
-            replies = data.decode("utf-8").split("\n")
-            for r in replies:
-                if not r:
-                    pass  # server replied with an empty line
-                elif CAPIReply.RUNNING.value in r:
-                    if verbose:
-                        print(r)
-                elif CAPIReply.COMPLETE.value in r:
-                    if verbose:
-                        print(r)
-                    reply_value_str = r[len(CAPIReply.COMPLETE.value) + 1:].strip()
-                    reply_values = reply_value_str.split(',')
-                    return {k: v for k, v in zip(reply_values[::2], reply_values[1::2])}
-                elif CAPIReply.INVALID.value in r or CAPIReply.ERROR.value in r:
-                    raise ValueError("Server replied with {}".format(r))
-                else:
-                    raise ValueError("Received an unknown reply from the server:\n {}".format(r))
+            reply = parse_reply_line(self._read_line(), verbose)
+            if reply is not None:
+                return reply
 
     def cmd_reply(self, command: str, verbose: bool = False) -> Dict[str, str]:
-        """Open the connection, send a command and wait for the reply."""
+        """Open the connection, send a command and wait for the reply.
+
+        In persistent mode, the existing connection is reused. If the device closed it in the
+        mean time, a new connection is made and the command is sent again.
+        """
+        return self.cmd_replies([command], verbose)[0]
+
+    def cmd_replies(self, commands: List[str], verbose: bool = False) -> List[Dict[str, str]]:
+        """Send several commands over a single connection and collect their replies in order.
+
+        The listener on the device handles all data it receives at once as a single command, so
+        the commands can't be in flight at the same time. Instead, each command is sent as soon
+        as the reply to the previous one is complete.
+
+        Parameters
+        ----------
+        commands : List[str]
+            The commands to send.
+
+        verbose : bool
+            If True, print out the valid replies (RUNNING and COMPLETE) as they arrive.
+
+        Returns
+        -------
+        List[Dict[str, str]]
+            The reply to each command, as returned by `get_reply`.
+        """
+        replies = []
         with self:
+            for command in commands:
+                replies.append(self._cmd_reply_reconnect(command, verbose))
+        return replies
+
+    def _cmd_reply_reconnect(self, command: str, verbose: bool) -> Dict[str, str]:
+        """Send a command and get its reply, reconnecting once if the connection was closed."""
+        lines_received = self.lines_received
+        try:
+            self.send_cmd(command)
+            return self.get_reply(verbose)
+        except ConnectionError as error:
+            # Only retry if nothing was received yet, i.e. the command was not handled.
+            if not self.persistent or self.lines_received != lines_received or self.buffer:
+                raise
+            logger.debug("Reconnecting to %s:%d: %s", self.host, self.port, error)
+            self.close()
+            self.__enter__()
             self.send_cmd(command)
             return self.get_reply(verbose)
 
@@ -168,8 +308,7 @@ class UCCSocket:
             The band on which to start wps
 
         """
-        command = "start_wps_registration,band,{},WpsConfigMethod,PBC".format(band)
-        self.cmd_reply(command)
+        self.cmd_reply(format_start_wps_registration(band))
 
     def dev_get_parameter(self, parameter: str, **additional_parameters: str) -> str:
         """Call dev_get_parameter and return the parameter, or raise KeyError if it is missing.
@@ -189,9 +328,7 @@ class UCCSocket:
         str
             The value of the requested parameter.
         """
-        command = "dev_get_parameter,program,map,parameter,{}".format(parameter)
-        if additional_parameters:
-            command += ',' + ','.join([','.join(param) for param in additional_parameters.items()])
+        command = format_dev_get_parameter(parameter, **additional_parameters)
         return self.cmd_reply(command)[parameter]
 
     def dev_send_1905(self, dest: str, message_type: int, *tlvs: tlv) -> int:
@@ -212,16 +349,90 @@ class UCCSocket:
         -------
         The MID of the message, as an integer.
         """
-        cmd = "DEV_SEND_1905,DestALid,{dest:s},MessageTypeValue,0x{message_type:04x}"\
-            .format(**locals())
-        if len(tlvs) > 1:
-            formatted_tlvs = [tlv.format(tlv_num + 1) for (tlv_num, tlv) in enumerate(tlvs)]
-            cmd += ',' + ','.join(formatted_tlvs)
-        elif tlvs:
-            cmd += ',' + tlvs[0].format()
+        cmd = format_dev_send_1905(dest, message_type, *tlvs)
         return int(self.cmd_reply(cmd)["mid"], base=0)
 
 
+class AsyncUCCSocket:
+    """asyncio counterpart of `UCCSocket`.
+
+    It has the same interface as UCCSocket, but all commands are coroutines, so commands to many
+    devices can be run concurrently, e.g. with `asyncio.gather`. Every command uses a new
+    connection.
+
+    The listener on the device serves a single client at a time (see `UCCSocket`), so the commands
+    sent with the same AsyncUCCSocket are serialized: they are only concurrent with commands to
+    other devices. Use a single AsyncUCCSocket per device. A connection to the device from another
+    client, e.g. a persistent `UCCSocket`, is dropped by the device when a command is sent.
+    """
+
+    def __init__(self, host: str, port: int, timeout: int = 30):
+        """Constructor for AsyncUCCSocket
+
+        Parameters
+        ----------
+        host: str
+            The host to connect to. Can either be an ip or a hostname.
+        port: str
+            The port to connect to.
+        timeout: int
+            (optional) The timeout for the whole command, from connecting until the reply.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # asyncio locks belong to an event loop, so a new one is made for each loop.
+        self._lock = None
+        self._lock_loop = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    async def _cmd_reply(self, command: str, verbose: bool) -> Dict[str, str]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if command[-1] != "\n":
+                command += "\n"
+            writer.write(command.encode("utf-8"))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by {}:{}".format(self.host,
+                                                                              self.port))
+                reply = parse_reply_line(line.decode("utf-8"), verbose)
+                if reply is not None:
+                    return reply
+        finally:
+            writer.close()
+
+    async def cmd_reply(self, command: str, verbose: bool = False) -> Dict[str, str]:
+        """Open the connection, send a command and wait for the reply.
+
+        If another command to the device is in progress, wait until it is complete first.
+        """
+        async with self._get_lock():
+            return await asyncio.wait_for(self._cmd_reply(command, verbose), self.timeout)
+
+    async def start_wps_registration(self, band: str) -> None:
+        """Call start_wps_registration on a given band, see `UCCSocket.start_wps_registration`."""
+        await self.cmd_reply(format_start_wps_registration(band))
+
+    async def dev_get_parameter(self, parameter: str, **additional_parameters: str) -> str:
+        """Call dev_get_parameter and return the parameter, see `UCCSocket.dev_get_parameter`."""
+        command = format_dev_get_parameter(parameter, **additional_parameters)
+        return (await self.cmd_reply(command))[parameter]
+
+    async def dev_send_1905(self, dest: str, message_type: int, *tlvs: tlv) -> int:
+        """Call dev_send_1905 and return the MID, see `UCCSocket.dev_send_1905`."""
+        cmd = format_dev_send_1905(dest, message_type, *tlvs)
+        return int((await self.cmd_reply(cmd))["mid"], base=0)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simulated UCC")
     parser.add_argument("host", help="The device hostname or IP.", type=str)
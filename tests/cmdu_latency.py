@@ -0,0 +1,235 @@
+###############################################################
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+# SPDX-FileCopyrightText: 2020 the prplMesh contributors (see AUTHORS.md)
+# This code is subject to the terms of the BSD+Patent license.
+# See LICENSE file for more details.
+###############################################################
+
+'''Request/response latency analysis of the CMDUs in a capture.
+
+Requests are paired with their response and/or ACK by message type, MID and the addresses of
+both ends. For each kind of exchange, the latency distribution, the number of retransmitted
+requests and the number of unanswered requests is reported.
+'''
+
+import argparse
+import json
+import math
+from typing import Dict, List
+
+import sniffer
+
+IEEE1905_MULTICAST = "01:80:c2:00:00:13"
+
+ACK = 0x8000
+
+# Request message type to the message type of its response.
+RESPONSE_TYPES = {
+    0x0002: 0x0003,  # Topology query / response
+    0x0005: 0x0006,  # Link metric query / response
+    0x0007: 0x0008,  # AP autoconfiguration search / response
+    0x8001: 0x8002,  # AP capability query / report
+    0x8004: 0x8005,  # Channel preference query / report
+    0x8006: 0x8007,  # Channel selection request / response
+    0x8009: 0x800A,  # Client capability query / report
+    0x800B: 0x800C,  # AP metrics query / response
+    0x800D: 0x800E,  # Associated STA link metrics query / response
+    0x800F: 0x8010,  # Unassociated STA link metrics query / response
+    0x8011: 0x8012,  # Beacon metrics query / response
+}
+
+# Message types that are acknowledged with an ACK (0x8000) with the same MID.
+ACKED_TYPES = {
+    0x8003,  # Multi-AP policy config request
+    0x8008,  # Operating channel report
+    0x800F,  # Unassociated STA link metrics query
+    0x8011,  # Beacon metrics query
+    0x8013,  # Combined infrastructure metrics
+    0x8014,  # Client steering request
+    0x8015,  # Client steering BTM report
+    0x8016,  # Client association control request
+    0x8017,  # Steering completed
+    0x8018,  # Higher layer data
+    0x8019,  # Backhaul steering request
+}
+
+# Upper bounds of the latency histogram buckets, in ms. The last bucket is unbounded.
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Percentiles that are reported.
+PERCENTILES = (50, 90, 95, 99)
+
+
+class _Request:
+    '''A request CMDU that is waiting for one kind of reply.'''
+
+    def __init__(self, packet: sniffer.Packet, reply_type: int):
+        self.packet = packet
+        self.reply_type = reply_type
+        self.retransmissions = 0
+        self.replies = 0
+
+    @property
+    def label(self) -> str:
+        return "0x{:04x}/0x{:04x}".format(self.packet.ieee1905_message_type, self.reply_type)
+
+    def matches_reply(self, packet: sniffer.Packet) -> bool:
+        '''Check that the reply comes from the destination of the request.'''
+        return self.packet.eth_dst in (IEEE1905_MULTICAST, packet.eth_src)
+
+
+class _Exchange:
+    '''Statistics of one kind of request/reply exchange, e.g. 0x8004/0x8005.'''
+
+    def __init__(self):
+        self.requests = 0
+        self.retransmissions = 0
+        self.unanswered = 0
+        self.duplicate_replies = 0
+        self.latencies = []
+
+    def to_dict(self) -> dict:
+        latencies_ms = sorted(latency * 1000 for latency in self.latencies)
+        result = {
+            "requests": self.requests,
+            "answered": len(latencies_ms),
+            "unanswered": self.unanswered,
+            "retransmissions": self.retransmissions,
+            "duplicate_replies": self.duplicate_replies,
+        }
+        if latencies_ms:
+            result["latency_ms"] = {
+                "min": latencies_ms[0],
+                "mean": sum(latencies_ms) / len(latencies_ms),
+                "max": latencies_ms[-1],
+            }
+            for percentile in PERCENTILES:
+                result["latency_ms"]["p{}".format(percentile)] = percentile_of(latencies_ms,
+                                                                               percentile)
+            result["histogram_ms"] = _histogram(latencies_ms)
+        return result
+
+
+def percentile_of(sorted_values: List[float], percentile: float) -> float:
+    '''Nearest-rank percentile of a non-empty sorted list.'''
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def _histogram(values_ms: List[float]) -> Dict[str, int]:
+    '''Count the values in each of HISTOGRAM_BUCKETS_MS, labelled by their upper bound.'''
+    labels = ["<={}".format(bound) for bound in HISTOGRAM_BUCKETS_MS]
+    labels.append(">{}".format(HISTOGRAM_BUCKETS_MS[-1]))
+    counts = [0] * len(labels)
+    for value in values_ms:
+        bucket = 0
+        while bucket < len(HISTOGRAM_BUCKETS_MS) and value > HISTOGRAM_BUCKETS_MS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    return dict(zip(labels, counts))
+
+
+def _expected_replies(msg_type: int) -> List[int]:
+    replies = []
+    if msg_type in RESPONSE_TYPES:
+        replies.append(RESPONSE_TYPES[msg_type])
+    if msg_type in ACKED_TYPES:
+        replies.append(ACK)
+    return replies
+
+
+def analyze(packets: List[sniffer.Packet]) -> dict:
+    '''Pair the requests and replies in "packets" and compute the latency statistics.
+
+    Only the first fragment of a CMDU is taken into account. A request that is seen again with the
+    same type, source and MID while it is still unanswered is counted as a retransmission; its
+    latency is measured from the first transmission.
+
+    Returns
+    -------
+    dict
+        The report, with per-exchange statistics under "exchanges" and the requests that never got
+        a reply under "unanswered". It can be serialized to JSON as is.
+    '''
+    requests = []
+    # Latest request for each (reply type, requester, mid).
+    pending = {}
+    exchanges = {}
+    unanswered = []
+
+    def exchange(label: str) -> _Exchange:
+        if label not in exchanges:
+            exchanges[label] = _Exchange()
+        return exchanges[label]
+
+    for packet in packets:
+        if not packet.ieee1905 or packet.ieee1905_fragment_id != 0:
+            continue
+        msg_type = packet.ieee1905_message_type
+        # A reply first: a response can itself be acknowledged, e.g. 0x8015.
+        request = pending.get((msg_type, packet.eth_dst, packet.ieee1905_mid))
+        if request and request.matches_reply(packet):
+            if request.replies == 0:
+                exchange(request.label).latencies.append(packet.frame_time_epoch -
+                                                         request.packet.frame_time_epoch)
+            else:
+                exchange(request.label).duplicate_replies += 1
+            request.replies += 1
+        for reply_type in _expected_replies(msg_type):
+            key = (reply_type, packet.eth_src, packet.ieee1905_mid)
+            request = pending.get(key)
+            if request and request.replies == 0 and \
+                    request.packet.ieee1905_message_type == msg_type:
+                request.retransmissions += 1
+                exchange(request.label).retransmissions += 1
+                continue
+            request = _Request(packet, reply_type)
+            requests.append(request)
+            pending[key] = request
+            exchange(request.label).requests += 1
+
+    for request in requests:
+        if request.replies == 0:
+            exchange(request.label).unanswered += 1
+            unanswered.append({
+                "exchange": request.label,
+                "frame_number": request.packet.frame_number,
+                "time": request.packet.frame_time_epoch,
+                "eth_src": request.packet.eth_src,
+                "eth_dst": request.packet.eth_dst,
+                "mid": request.packet.ieee1905_mid,
+                "retransmissions": request.retransmissions,
+            })
+
+    return {
+        "exchanges": {label: exchanges[label].to_dict() for label in sorted(exchanges)},
+        "unanswered": unanswered,
+    }
+
+
+def write_report(packets: List[sniffer.Packet], filename: str, test: str = None) -> dict:
+    '''Analyze "packets" and write the report as JSON to "filename".'''
+    report = analyze(packets)
+    if test:
+        report["test"] = test
+    with open(filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report CMDU request/response latencies")
+    parser.add_argument("pcap", nargs='+', help="The libpcap files to analyze.")
+    parser.add_argument("--output", "-o", help="Write the JSON reports to this file.")
+    args = parser.parse_args()
+
+    reports = {}
+    for pcap in args.pcap:
+        capture = sniffer.Sniffer('', '')
+        capture.follow(pcap)
+        reports[pcap] = analyze(capture.get_packet_capture())
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(reports, output, indent=2)
+    else:
+        print(json.dumps(reports, indent=2))
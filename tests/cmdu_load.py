@@ -0,0 +1,285 @@
+###############################################################
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+# SPDX-FileCopyrightText: 2020 the prplMesh contributors (see AUTHORS.md)
+# This code is subject to the terms of the BSD+Patent license.
+# See LICENSE file for more details.
+###############################################################
+
+'''CMDU load generator, to benchmark how many messages per second a controller or agent handles.
+
+A mix of CMDUs is injected with dev_send_1905 at a target rate. The latency from the request to
+its response (or ACK, for messages that don't have a response) is taken from the wired sniffer
+capture, so it doesn't include the CAPI overhead. The report gives the achieved send rate, the
+throughput of answered requests, the latency percentiles and the drop rate.
+
+Note that the wired sniffer only captures on the gateway's network, so with a chain or tree
+topology only the agents connected directly to the gateway can be used.
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+from capi import tlv
+import cmdu_latency
+import environment as env
+from opts import debug, opts, status
+
+
+class LoadMessage:
+    '''A kind of CMDU that can be part of the load.
+
+    "tlvs" is called with the destination entity and returns the TLVs to send.
+    '''
+
+    def __init__(self, msg_type: int, tlvs: Callable[[env.ALEntity], List[tlv]] = None,
+                 needs_radio: bool = False):
+        self.msg_type = msg_type
+        self.tlvs = tlvs or (lambda dest: [])
+        # Only agents have radios, so this message can't be sent to the controller.
+        self.needs_radio = needs_radio
+
+    @property
+    def reply_type(self) -> int:
+        return cmdu_latency.RESPONSE_TYPES.get(self.msg_type, cmdu_latency.ACK)
+
+
+MESSAGES = {
+    'topology_query': LoadMessage(0x0002),
+    'ap_capability_query': LoadMessage(0x8001),
+    'link_metric_query': LoadMessage(0x0005, lambda dest: [tlv(0x08, 0x0002, "0x00 0x02")]),
+    'channel_preference_query': LoadMessage(0x8004),
+    # Steering opportunity for the first radio of the destination, acknowledged with an ACK.
+    'steering_request': LoadMessage(0x8014, lambda dest: [
+        tlv(0x9B, 0x000C, "{%s 0x00 0x000A 0x0000 0x00}" % dest.radios[0].mac)],
+        needs_radio=True),
+}
+
+
+class SentCmdu:
+    '''A CMDU that was injected, with what the capture says about it.'''
+
+    def __init__(self, name: str, src: env.ALEntity, dest: env.ALEntity, mid: int,
+                 send_lag: float):
+        self.name = name
+        self.src = src
+        self.dest = dest
+        self.mid = mid
+        # How much later than scheduled the CMDU was sent.
+        self.send_lag = send_lag
+        # Capture timestamps, None if not captured.
+        self.request_time = None
+        self.reply_time = None
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    '''Parse a message mix like "topology_query=4,steering_request=1" into weights.'''
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in MESSAGES:
+            raise ValueError("Unknown message {}, choose from {}".format(
+                name, ', '.join(MESSAGES)))
+        weights[name] = float(weight) if weight else 1.0
+    return weights
+
+
+def _send_loop(sender: env.ALEntity, destinations: List[env.ALEntity], weights: Dict[str, float],
+               rate: float, duration: float, sent: List[SentCmdu], lock: threading.Lock,
+               rng: random.Random) -> None:
+    '''Send CMDUs from "sender" at "rate" per second for "duration" seconds.
+
+    The schedule is open loop: if a CMDU can't be sent in time, the next ones are sent as soon as
+    possible, so a slow device shows up as send lag rather than as a lower offered rate.
+    '''
+    names = list(weights)
+    start = time.monotonic()
+    count = int(rate * duration)
+    for i in range(count):
+        scheduled = start + i / rate
+        delay = scheduled - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        dest = destinations[i % len(destinations)]
+        candidates = [name for name in names if dest.radios or not MESSAGES[name].needs_radio]
+        name = rng.choices(candidates, [weights[name] for name in candidates])[0]
+        message = MESSAGES[name]
+        lag = time.monotonic() - scheduled
+        mid = sender.dev_send_1905(dest.mac, message.msg_type, *message.tlvs(dest))
+        with lock:
+            sent.append(SentCmdu(name, sender, dest, mid, lag))
+
+
+def run_load(senders: List[env.ALEntity], destinations: List[env.ALEntity], mix: Dict[str, float],
+             rate: float, duration: float, drain_timeout: float = 3, seed: int = None) -> Dict:
+    '''Inject a mix of CMDUs and measure how they are answered.
+
+    Parameters
+    ----------
+    senders: List[env.ALEntity]
+        The entities whose CAPI is used to send the CMDUs. Each one sends from its own thread, at
+        an equal share of "rate".
+
+    destinations: List[env.ALEntity]
+        The entities to send to, in a round robin fashion. A sender never sends to itself.
+
+    mix: Dict[str, float]
+        The relative weight of each of MESSAGES, see parse_mix.
+
+    rate: float
+        The total number of CMDUs per second.
+
+    duration: float
+        How long to send, in seconds.
+
+    drain_timeout: float
+        How long to wait for the replies after the last CMDU was sent.
+
+    seed: int
+        Seed of the random generators, to make the message sequence reproducible. Each sender
+        has its own generator, seeded with "seed" plus its index, so the sequence doesn't depend
+        on how the sender threads are scheduled.
+
+    Returns
+    -------
+    Dict
+        The report, see analyze_load.
+    '''
+    sent = []
+    lock = threading.Lock()
+    threads = []
+    for index, sender in enumerate(senders):
+        targets = [dest for dest in destinations if dest is not sender]
+        rng = random.Random(seed + index if seed is not None else None)
+        threads.append(threading.Thread(target=_send_loop, args=(
+            sender, targets, mix, rate / len(senders), duration, sent, lock, rng)))
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    send_duration = time.monotonic() - start
+
+    # The replies come in the order of the requests, more or less, so waiting for each one in
+    # turn with a common deadline returns as soon as everything is answered.
+    deadline = time.monotonic() + drain_timeout
+    for cmdu in sent:
+        message = MESSAGES[cmdu.name]
+        requests = env.wired_sniffer.find_cmdus(message.msg_type, cmdu.src.mac, cmdu.dest.mac,
+                                                cmdu.mid)
+        if requests:
+            cmdu.request_time = requests[0].frame_time_epoch
+        replies = env.wired_sniffer.wait_for_cmdus(message.reply_type, cmdu.dest.mac,
+                                                   cmdu.src.mac, cmdu.mid,
+                                                   max(0, deadline - time.monotonic()))
+        if replies:
+            cmdu.reply_time = replies[0].frame_time_epoch
+    return analyze_load(sent, rate, send_duration)
+
+
+def _latency_summary(latencies: List[float]) -> Dict[str, float]:
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    if not latencies_ms:
+        return {}
+    summary = {"p{}".format(percentile): cmdu_latency.percentile_of(latencies_ms, percentile)
+               for percentile in (50, 90, 99, 99.9)}
+    summary["max"] = latencies_ms[-1]
+    return summary
+
+
+def analyze_load(sent: List[SentCmdu], rate: float, send_duration: float) -> Dict:
+    '''Compute the benchmark results of the CMDUs in "sent".
+
+    A CMDU counts as dropped if no reply was captured. CMDUs of which the request itself was not
+    captured are counted separately, and are left out of the latency statistics.
+    '''
+    def summarize(cmdus: List[SentCmdu]) -> Dict:
+        answered = [cmdu for cmdu in cmdus if cmdu.reply_time is not None]
+        latencies = [cmdu.reply_time - cmdu.request_time for cmdu in answered
+                     if cmdu.request_time is not None]
+        return {
+            "sent": len(cmdus),
+            "answered": len(answered),
+            "not_captured": sum(1 for cmdu in cmdus if cmdu.request_time is None),
+            "drop_rate": 1 - len(answered) / len(cmdus) if cmdus else 0,
+            "latency_ms": _latency_summary(latencies),
+        }
+
+    report = summarize(sent)
+    report.update({
+        "target_rate": rate,
+        "send_duration": send_duration,
+        "send_rate": len(sent) / send_duration if send_duration else 0,
+        "max_send_lag": max((cmdu.send_lag for cmdu in sent), default=0),
+    })
+    # Throughput: answered requests per second over the time the requests were being sent.
+    answered_times = [cmdu.reply_time for cmdu in sent if cmdu.reply_time is not None]
+    request_times = [cmdu.request_time for cmdu in sent if cmdu.request_time is not None]
+    if answered_times and request_times:
+        span = max(answered_times) - min(request_times)
+        report["throughput"] = len(answered_times) / span if span > 0 else 0
+    report["messages"] = {name: summarize([cmdu for cmdu in sent if cmdu.name == name])
+                          for name in sorted({cmdu.name for cmdu in sent})}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark CMDU handling with dev_send_1905")
+    parser.add_argument("--verbose", "-v", action='store_true', default=False,
+                        help="report each action")
+    user = os.getenv("SUDO_USER", os.getenv("USER", ""))
+    parser.add_argument("--unique-id", "-u", type=str, default=user,
+                        help="append UNIQUE_ID to all container names, e.g. gateway-<UNIQUE_ID>; "
+                             "defaults to {}".format(user))
+    parser.add_argument("--tag", "-t", type=str,
+                        help="use runner image with tag TAG instead of 'latest'")
+    parser.add_argument("--skip-init", action='store_true', default=False,
+                        help="don't start up the containers")
+    parser.add_argument("--agents", type=int, default=2, help="number of repeaters to start")
+    parser.add_argument("--to-controller", action='store_true', default=False,
+                        help="let the agents send to the controller instead of the other way round")
+    parser.add_argument("--mix", type=str, default=','.join(MESSAGES),
+                        help="comma separated messages with optional weight, e.g. "
+                             "topology_query=4,steering_request=1; choose from: " +
+                             ', '.join(MESSAGES))
+    parser.add_argument("--rate", type=float, default=20, help="CMDUs per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send")
+    parser.add_argument("--seed", type=int, help="seed for the message sequence")
+    parser.add_argument("--output", "-o", type=str, help="write the JSON report to this file")
+    options = parser.parse_args()
+
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as error:
+        parser.error(str(error))
+
+    opts.verbose = options.verbose
+    opts.tcpdump_dir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..', 'logs'))
+
+    env.launch_environment_docker(options.unique_id, options.skip_init, options.tag or "",
+                                  options.agents)
+    if options.to_controller:
+        senders, destinations = list(env.agents), [env.controller]
+    else:
+        senders, destinations = [env.controller], list(env.agents)
+
+    env.wired_sniffer.start('cmdu_load')
+    try:
+        report = run_load(senders, destinations, mix, options.rate, options.duration,
+                          seed=options.seed)
+    finally:
+        env.wired_sniffer.stop()
+
+    status("Sent {sent} CMDUs at {send_rate:.1f}/s, {answered} answered, "
+           "drop rate {drop_rate:.1%}".format(**report))
+    debug(json.dumps(report, indent=2))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -6,7 +6,9 @@
 ###############################################################
 
 import re
-from typing import Dict
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Union
 
 import environment as env
 
@@ -16,67 +18,435 @@ RE_MAC = rb"(?P<mac>([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2})"
 
 class MapClient:
     '''Represents a client (STA) in the connection map.'''
-    def __init__(self, mac: str):
+    __slots__ = ('mac', 'ipv4', 'name', 'channel', 'bandwidth', 'rx_rssi', 'parent')
+
+    def __init__(self, mac: str, ipv4: str = None, name: str = None, channel: int = None,
+                 bandwidth: str = None, rx_rssi: int = None,
+                 parent: Union['MapVap', 'MapEthernet'] = None):
         self.mac = mac
+        self.ipv4 = ipv4
+        self.name = name
+        # The channel information is only known for wireless clients.
+        self.channel = channel
+        self.bandwidth = bandwidth
+        self.rx_rssi = rx_rssi
+        # The VAP or ethernet interface the client is connected to.
+        self.parent = parent
 
 
 class MapVap:
     '''Represents a VAP in the connection map.'''
+    __slots__ = ('bssid', 'ssid', 'iface', 'backhaul', 'radio', 'clients')
 
-    def __init__(self, bssid: str, ssid: bytes):
+    def __init__(self, bssid: str, ssid: bytes, iface: str = None, backhaul: bool = False,
+                 radio: 'MapRadio' = None):
         self.bssid = bssid
         self.ssid = ssid
+        self.iface = iface
+        self.backhaul = backhaul
+        self.radio = radio
         self.clients = {}
 
-    def add_client(self, mac: str):
-        client = MapClient(mac)
+    def add_client(self, mac: str, **kwargs) -> MapClient:
+        client = MapClient(mac, parent=self, **kwargs)
         self.clients[mac] = client
         return client
 
 
 class MapRadio:
     '''Represents a radio in the connection map.'''
+    __slots__ = ('uid', 'iface', 'channel', 'cac', 'bandwidth', 'freq', 'device', 'vaps',
+                 'backhaul_vaps')
 
-    def __init__(self, uid: str):
+    def __init__(self, uid: str, iface: str = None, channel: int = None, cac: bool = False,
+                 bandwidth: str = None, freq: int = None, device: 'MapDevice' = None):
         self.uid = uid
+        self.iface = iface
+        # None if the channel is not known (N/A).
+        self.channel = channel
+        # True while the channel availability check of a DFS channel is in progress.
+        self.cac = cac
+        self.bandwidth = bandwidth
+        self.freq = freq
+        self.device = device
+        # The fronthaul VAPs. The backhaul VAPs are kept apart, in backhaul_vaps.
         self.vaps = {}
+        self.backhaul_vaps = {}
 
-    def add_vap(self, bssid: str, ssid: bytes):
-        vap = MapVap(bssid, ssid)
-        self.vaps[bssid] = vap
+    def add_vap(self, bssid: str, ssid: bytes, backhaul: bool = False, **kwargs) -> MapVap:
+        vap = MapVap(bssid, ssid, backhaul=backhaul, radio=self, **kwargs)
+        if backhaul:
+            self.backhaul_vaps[bssid] = vap
+        else:
+            self.vaps[bssid] = vap
         return vap
 
 
+class MapEthernet:
+    '''Represents the ethernet interface of a device in the connection map.'''
+    __slots__ = ('mac', 'device', 'clients')
+
+    def __init__(self, mac: str, device: 'MapDevice'):
+        self.mac = mac
+        self.device = device
+        self.clients = {}
+
+    def add_client(self, mac: str, **kwargs) -> MapClient:
+        client = MapClient(mac, parent=self, **kwargs)
+        self.clients[mac] = client
+        return client
+
+
+class MapBackhaul:
+    '''Represents the backhaul link of a repeater to its parent in the connection map.'''
+    __slots__ = ('mac', 'channel', 'bandwidth', 'parent', 'device')
+
+    def __init__(self, mac: str, channel: int, bandwidth: str,
+                 parent: Union[MapVap, MapEthernet]):
+        self.mac = mac
+        # The channel is 0 for a wired backhaul.
+        self.channel = channel
+        self.bandwidth = bandwidth
+        # The (backhaul) VAP or ethernet interface of the parent device the link is connected to.
+        self.parent = parent
+        self.device = None
+
+    @property
+    def wireless(self) -> bool:
+        return isinstance(self.parent, MapVap)
+
+
 class MapDevice:
-    '''Represents a device in the connection map.'''
+    '''Represents a device (gateway or repeater bridge) in the connection map.'''
+    __slots__ = ('mac', 'name', 'ipv4', 'gateway', 'ethernet', 'backhaul', 'radios')
 
-    def __init__(self, mac: str):
+    def __init__(self, mac: str, name: str = None, ipv4: str = None, gateway: bool = False):
         self.mac = mac
+        self.name = name
+        self.ipv4 = ipv4
+        self.gateway = gateway
+        self.ethernet = None
+        # The link to the parent device, None for the gateway.
+        self.backhaul = None
         self.radios = {}
 
-    def add_radio(self, uid: str):
-        radio = MapRadio(uid)
+    def add_radio(self, uid: str, **kwargs) -> MapRadio:
+        radio = MapRadio(uid, device=self, **kwargs)
         self.radios[uid] = radio
         return radio
 
+    @property
+    def parent(self) -> Optional['MapDevice']:
+        '''The upstream device, None for the gateway.'''
+        if not self.backhaul:
+            return None
+        if isinstance(self.backhaul.parent, MapVap):
+            return self.backhaul.parent.radio.device
+        return self.backhaul.parent.device
+
+
+class ConnMap(dict):
+    '''The connection map: the devices indexed by bridge MAC address.
+
+    Besides the devices, all other nodes are indexed by MAC address as well. They are separate
+    indexes, because e.g. the radio MAC address is also the BSSID of its first VAP.
+    '''
+    __slots__ = ('gateway', 'ethernets', 'backhauls', 'radios', 'vaps', 'clients')
+
+    def __init__(self):
+        super().__init__()
+        self.gateway = None
+        self.ethernets = {}
+        self.backhauls = {}
+        self.radios = {}
+        # Both fronthaul and backhaul VAPs.
+        self.vaps = {}
+        self.clients = {}
+
+    def client_bssid(self, mac: str) -> Optional[str]:
+        '''The BSSID client "mac" is associated with, None if it isn't associated.'''
+        client = self.clients.get(mac)
+        if client and isinstance(client.parent, MapVap):
+            return client.parent.bssid
+        return None
+
+
+_RE_KEYWORD = re.compile(rb'( *)([A-Za-z_]+)')
+_RE_BRIDGE = re.compile(rb'(?P<type>GW|IRE)_BRIDGE: name: (?P<name>.*?), mac: ' + RE_MAC +
+                        rb', ipv4: (?P<ipv4>\S*)')
+_RE_BACKHAUL = re.compile(rb'IRE_BACKHAUL: mac: ' + RE_MAC +
+                          rb', ch: (?P<ch>\d+), bw: (?P<bw>[^,\s]*)')
+_RE_ETHERNET = re.compile(rb'ETHERNET: mac: ' + RE_MAC)
+_RE_RADIO = re.compile(rb'RADIO: (?P<iface>\S+) mac: ' + RE_MAC +
+                       rb', ch: (?P<ch>\d+|N/A)(?P<cac>\(CAC\))?, bw: (?P<bw>[^,]*), '
+                       rb'freq: (?P<freq>\d+)MHz')
+_RE_VAP = re.compile(rb'(?P<kind>[fb])VAP\[\d+\]: (?P<iface>\S+) bssid: ' + RE_MAC +
+                     rb', ssid: (?P<ssid>.*)$')
+_RE_CLIENT = re.compile(rb'CLIENT: mac: ' + RE_MAC + rb', ipv4: (?P<ipv4>[^,]*), '
+                        rb'name: (?P<name>.*?)(?:, ch: (?P<ch>\d+), bw: (?P<bw>[^,]*), '
+                        rb'rx_rssi: (?P<rssi>-?\d+))?$')
+
+_PATTERNS = {
+    b'GW_BRIDGE': _RE_BRIDGE,
+    b'IRE_BRIDGE': _RE_BRIDGE,
+    b'IRE_BACKHAUL': _RE_BACKHAUL,
+    b'ETHERNET': _RE_ETHERNET,
+    b'RADIO': _RE_RADIO,
+    b'fVAP': _RE_VAP,
+    b'bVAP': _RE_VAP,
+    b'CLIENT': _RE_CLIENT,
+}
+
+
+def _text(match: re.Match, group: str) -> Optional[str]:
+    value = match.group(group)
+    return value.decode('utf-8', errors='replace') if value is not None else None
+
+
+def _int(match: re.Match, group: str) -> Optional[int]:
+    value = match.group(group)
+    return int(value) if value is not None and value.lstrip(b'-').isdigit() else None
+
+
+def parse_conn_map(output: bytes) -> ConnMap:
+    '''Parse the output of bml_conn_map into a ConnMap.
+
+    bml_conn_map prints a tree, with 4 spaces of indentation per level. The parent of each line is
+    the closest preceding line with less indentation. Each line is matched against a single
+    pattern, selected by its keyword. Lines that are not part of the tree are skipped.
+    '''
+    conn_map = ConnMap()
+    # (indentation, node) of the ancestors of the current line.
+    stack = []
+    for line in output.split(b'\n'):
+        keyword = _RE_KEYWORD.match(line)
+        if not keyword:
+            continue
+        pattern = _PATTERNS.get(keyword.group(2))
+        if not pattern:
+            continue
+        indent = keyword.end(1)
+        match = pattern.match(line, indent)
+        if not match:
+            continue
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        parent = stack[-1][1] if stack else None
+        mac = _text(match, 'mac')
+
+        if pattern is _RE_BRIDGE:
+            node = MapDevice(mac, _text(match, 'name'), _text(match, 'ipv4'),
+                             gateway=match.group('type') == b'GW')
+            if node.gateway:
+                conn_map.gateway = node
+            elif isinstance(parent, MapBackhaul):
+                node.backhaul = parent
+                parent.device = node
+            conn_map[mac] = node
+        elif pattern is _RE_BACKHAUL:
+            if not isinstance(parent, (MapVap, MapEthernet)):
+                continue
+            node = MapBackhaul(mac, _int(match, 'ch'), _text(match, 'bw'), parent)
+            conn_map.backhauls[mac] = node
+        elif pattern is _RE_ETHERNET:
+            if not isinstance(parent, MapDevice):
+                continue
+            node = MapEthernet(mac, parent)
+            parent.ethernet = node
+            conn_map.ethernets[mac] = node
+        elif pattern is _RE_RADIO:
+            if not isinstance(parent, MapDevice):
+                continue
+            node = parent.add_radio(mac, iface=_text(match, 'iface'), channel=_int(match, 'ch'),
+                                    cac=match.group('cac') is not None,
+                                    bandwidth=_text(match, 'bw'), freq=_int(match, 'freq'))
+            conn_map.radios[mac] = node
+        elif pattern is _RE_VAP:
+            if not isinstance(parent, MapRadio):
+                continue
+            node = parent.add_vap(mac, match.group('ssid'), iface=_text(match, 'iface'),
+                                  backhaul=match.group('kind') == b'b')
+            conn_map.vaps[mac] = node
+        else:
+            if not isinstance(parent, (MapVap, MapEthernet)):
+                continue
+            node = parent.add_client(mac, ipv4=_text(match, 'ipv4'), name=_text(match, 'name'),
+                                     channel=_int(match, 'ch'), bandwidth=_text(match, 'bw'),
+                                     rx_rssi=_int(match, 'rssi'))
+            conn_map.clients[mac] = node
+        stack.append((indent, node))
+    return conn_map
+
 
 def get_conn_map() -> Dict[str, MapDevice]:
     '''Get the connection map from the controller.'''
-    conn_map = {}
-    for line in env.beerocks_cli_command("bml_conn_map").split(b'\n'):
-        # TODO we need to parse indentation to get the exact topology.
-        # For the time being, just parse the repeaters.
-        bridge = re.search(rb' {8}IRE_BRIDGE: .* mac: ' + RE_MAC, line)
-        radio = re.match(rb' {16}RADIO: .* mac: ' + RE_MAC, line)
-        vap = re.match(rb' {20}fVAP.* bssid: ' + RE_MAC + rb', ssid: (?P<ssid>.*)$', line)
-        client = re.match(rb' {24}CLIENT: mac: ' + RE_MAC, line)
-        if bridge:
-            cur_agent = MapDevice(bridge.group('mac').decode('utf-8'))
-            conn_map[cur_agent.mac] = cur_agent
-        elif radio:
-            cur_radio = cur_agent.add_radio(radio.group('mac').decode('utf-8'))
-        elif vap:
-            cur_vap = cur_radio.add_vap(vap.group('mac').decode('utf-8'), vap.group('ssid'))
-        elif client:
-            cur_vap.add_client(client.group('mac').decode('utf-8'))
-    return conn_map
+    return parse_conn_map(env.beerocks_cli_command("bml_conn_map"))
+
+
+class TopologyChange:
+    '''A structural difference between two connection maps.
+
+    "node_type" is one of 'device', 'radio', 'vap' or 'client', and "mac" identifies the node
+    (the BSSID for a VAP). For a move, "old" and "new" are the MAC addresses of the parent (the
+    upstream device for a device, the VAP or ethernet interface for a client). For a channel
+    change, they are (channel, bandwidth, cac) tuples, and for an SSID change the SSIDs.
+    '''
+    __slots__ = ('kind', 'node_type', 'mac', 'old', 'new')
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MOVED = 'moved'
+    CHANNEL_CHANGED = 'channel_changed'
+    SSID_CHANGED = 'ssid_changed'
+
+    def __init__(self, kind: str, node_type: str, mac: str, old=None, new=None):
+        self.kind = kind
+        self.node_type = node_type
+        self.mac = mac
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        change = "{} {} {}".format(self.node_type, self.mac, self.kind)
+        if self.kind in (self.ADDED, self.REMOVED):
+            return change
+        return "{}: {} -> {}".format(change, self.old, self.new)
+
+
+def _device_parent(device: MapDevice) -> Optional[str]:
+    parent = device.parent
+    return parent.mac if parent else None
+
+
+def _client_parent(client: MapClient) -> str:
+    return client.parent.bssid if isinstance(client.parent, MapVap) else client.parent.mac
+
+
+def _radio_channel(radio: MapRadio) -> tuple:
+    return (radio.channel, radio.bandwidth, radio.cac)
+
+
+def _diff_index(changes: List[TopologyChange], node_type: str, old: dict, new: dict,
+                attributes: Dict[str, Callable]) -> None:
+    '''Add the changes between the "old" and "new" indexes of a node type to "changes".
+
+    "attributes" maps the kind of change to a function that gets the attribute to compare.
+    '''
+    old_keys = old.keys()
+    new_keys = new.keys()
+    for mac in new_keys - old_keys:
+        changes.append(TopologyChange(TopologyChange.ADDED, node_type, mac))
+    for mac in old_keys - new_keys:
+        changes.append(TopologyChange(TopologyChange.REMOVED, node_type, mac))
+    if not attributes:
+        return
+    for mac in old_keys & new_keys:
+        for kind, attribute in attributes.items():
+            old_value = attribute(old[mac])
+            new_value = attribute(new[mac])
+            if old_value != new_value:
+                changes.append(TopologyChange(kind, node_type, mac, old_value, new_value))
+
+
+def diff_conn_maps(old: ConnMap, new: ConnMap) -> List[TopologyChange]:
+    '''Get the structural changes from connection map "old" to "new".
+
+    Nodes are compared through the MAC indexes, so the cost is linear in the size of the maps.
+    '''
+    changes = []
+    _diff_index(changes, 'device', old, new, {TopologyChange.MOVED: _device_parent})
+    _diff_index(changes, 'radio', old.radios, new.radios,
+                {TopologyChange.CHANNEL_CHANGED: _radio_channel})
+    _diff_index(changes, 'vap', old.vaps, new.vaps,
+                {TopologyChange.SSID_CHANGED: lambda vap: vap.ssid})
+    _diff_index(changes, 'client', old.clients, new.clients,
+                {TopologyChange.MOVED: _client_parent})
+    return changes
+
+
+class ConnMapWatcher:
+    '''Keeps the latest connection map and reports how it changes.
+
+    The connection map is fetched with bml_conn_map, either when poll is called, or periodically
+    in a background thread after start. Every fetch is compared to the previous snapshot, and the
+    changes are passed to "on_changes", if given. "fetch" replaces get_conn_map, e.g. to parse a
+    saved bml_conn_map output.
+    '''
+
+    def __init__(self, poll_interval: float = 0.5,
+                 on_changes: Callable[[List[TopologyChange]], None] = None,
+                 fetch: Callable[[], ConnMap] = None):
+        self.poll_interval = poll_interval
+        self.on_changes = on_changes
+        self.fetch = fetch or get_conn_map
+        self.snapshot = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def poll(self) -> List[TopologyChange]:
+        '''Fetch the connection map and return what changed since the previous snapshot.'''
+        conn_map = self.fetch()
+        with self.condition:
+            changes = diff_conn_maps(self.snapshot or ConnMap(), conn_map)
+            self.snapshot = conn_map
+            self.condition.notify_all()
+        if changes and self.on_changes:
+            self.on_changes(changes)
+        return changes
+
+    def _run(self) -> None:
+        while True:
+            self.poll()
+            with self.condition:
+                if self.condition.wait_for(lambda: self.stopping, self.poll_interval):
+                    return
+
+    def start(self) -> None:
+        '''Poll in a background thread until stop is called.'''
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        # Nothing to join if the thread was not started, e.g. when start failed.
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def wait_for_topology(self, predicate: Callable[[ConnMap], bool], timeout: float) -> bool:
+        '''Wait until "predicate" is true for the connection map, at most "timeout" seconds.
+
+        Without a background thread, the connection map is polled every poll_interval; with one,
+        every new snapshot of the thread is checked. The last snapshot is available in
+        self.snapshot afterwards, whatever the result.
+
+        Returns
+        -------
+        bool
+            True if the predicate became true, False on timeout.
+        '''
+        deadline = time.monotonic() + timeout
+        if self.thread:
+            with self.condition:
+                checked = None
+                while True:
+                    if self.snapshot is not checked:
+                        checked = self.snapshot
+                        if checked is not None and predicate(checked):
+                            return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+        while True:
+            self.poll()
+            if predicate(self.snapshot):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
@@ -5,6 +5,8 @@
 # See LICENSE file for more details.
 ###############################################################
 
+import asyncio
+import concurrent.futures
 from enum import Enum
 import json
 import os
@@ -12,9 +14,12 @@ import platform
 import re
 import subprocess
 import time
+from typing import Awaitable, Dict, List, Tuple
 
-from capi import UCCSocket
-from opts import opts, debug, err
+from capi import AsyncUCCSocket, UCCSocket
+from logfollower import get_log_follower
+from opts import opts, debug, err, status
+from profiling import profiler
 import sniffer
 
 
@@ -45,9 +50,16 @@ class ALEntity:
         # Convenience functions that propagate to ucc_socket
         self.cmd_reply = self.ucc_socket.cmd_reply
         self.dev_get_parameter = self.ucc_socket.dev_get_parameter
-        self.dev_send_1905 = self.ucc_socket.dev_send_1905
+        self.dev_send_1905 = profiler.profiled(
+            'dev_send_1905',
+            lambda dest, message_type, *tlvs, **kwargs: '0x{:04x}'.format(message_type)
+        )(self.ucc_socket.dev_send_1905)
         self.start_wps_registration = self.ucc_socket.start_wps_registration
 
+        # Same interface, as coroutines, to talk to several entities concurrently with gather().
+        self.async_ucc_socket = AsyncUCCSocket(ucc_socket.host, ucc_socket.port,
+                                               ucc_socket.timeout)
+
     def command(self, *command: str) -> bytes:
         '''Run `command` on the device and return its output as bytes.
 
@@ -66,6 +78,14 @@ class ALEntity:
         '''Poll the entity's logfile until it contains "regex" or times out.'''
         raise NotImplementedError("wait_for_log is not implemented in abstract class ALEntity")
 
+    def wait_for_logs(self, regexes: [str], start_line: int,
+                      timeout: float) -> Dict[str, Tuple[bool, int, tuple]]:
+        '''Poll the entity's logfile until it contains all "regexes" or times out.
+
+        Returns the wait_for_log result for each regex.
+        '''
+        raise NotImplementedError("wait_for_logs is not implemented in abstract class ALEntity")
+
 
 class Radio:
     '''Abstract representation of a radio on a MultiAP agent.
@@ -84,6 +104,21 @@ class Radio:
         '''Poll the radio's logfile until it contains "regex" or times out.'''
         raise NotImplementedError("wait_for_log is not implemented in abstract class Radio")
 
+    def wait_for_logs(self, regexes: [str], start_line: int,
+                      timeout: float) -> Dict[str, Tuple[bool, int, tuple]]:
+        '''Poll the radio's logfile until it contains all "regexes" or times out.
+
+        Returns the wait_for_log result for each regex.
+        '''
+        raise NotImplementedError("wait_for_logs is not implemented in abstract class Radio")
+
+    def send_station_events(self, events: List[Tuple['Station', 'StationEvent']]) -> None:
+        '''Associate and disassociate many stations with the radio's VAP in one go.
+
+        The events are applied in order.
+        '''
+        raise NotImplementedError("send_station_events is not implemented in abstract class Radio")
+
 
 class Station:
     '''Placeholder for a wireless (fronthaul) station.
@@ -138,6 +173,7 @@ controller = None
 agents = []
 
 
+@profiler.profiled('beerocks_cli_command', lambda command, **kwargs: command)
 def beerocks_cli_command(command: str) -> bytes:
     '''Execute `command` beerocks_cli command on the controller and return its output.'''
     debug("Send CLI command " + command)
@@ -146,6 +182,32 @@ def beerocks_cli_command(command: str) -> bytes:
     return res
 
 
+def gather(*coroutines: Awaitable) -> list:
+    '''Run "coroutines" concurrently and return their results, in order.
+
+    Example, to get the AL MAC address of all agents at once:
+    gather(*[agent.async_ucc_socket.dev_get_parameter('ALid') for agent in agents])
+    '''
+    async def gather_all():
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(gather_all())
+
+
+def cmd_reply_all(command: str, entities: List[ALEntity] = None) -> List[Dict[str, str]]:
+    '''Send CAPI "command" to the controller and all agents (or to "entities") concurrently.
+
+    The device serves a single CAPI client at a time, so the command is only concurrent between
+    different entities: if an entity is given more than once, its commands are sent one after the
+    other. A persistent connection of the entities' ucc_socket is closed first, since the device
+    would drop it anyway.
+    '''
+    if entities is None:
+        entities = [controller] + list(agents)
+    for entity in entities:
+        entity.ucc_socket.close()
+    return gather(*[entity.async_ucc_socket.cmd_reply(command) for entity in entities])
+
+
 def checkpoint() -> None:
     '''Checkpoint the current state.
 
@@ -164,8 +226,8 @@ installdir = os.path.join(rootdir, 'build', 'install')
 on_wsl = "microsoft" in platform.uname()[3].lower()
 
 
-def _docker_wait_for_log(container: str, program: str, regex: str, start_line: int,
-                         timeout: float) -> bool:
+def _docker_logfilename(container: str, program: str) -> str:
+    '''Get the path of the log of "program" in "container".'''
     logfilename = os.path.join(rootdir, 'logs', container, 'beerocks_{}.log'.format(program))
     # WSL doesn't support symlinks on NTFS, so resolve the symlink manually
     if on_wsl:
@@ -173,27 +235,44 @@ def _docker_wait_for_log(container: str, program: str, regex: str, start_line: i
             rootdir, 'logs', container,
             subprocess.check_output(["tail", "-2", logfilename]).decode('utf-8').
             rstrip(' \t\r\n\0'))
+    return logfilename
 
-    deadline = time.monotonic() + timeout
+
+def _docker_wait_for_log(container: str, program: str, regex: str, start_line: int,
+                         timeout: float) -> bool:
     try:
-        while True:
-            with open(logfilename) as logfile:
-                for (i, v) in enumerate(logfile.readlines()):
-                    if i <= start_line:
-                        continue
-                    search = re.search(regex, v)
-                    if search:
-                        debug("Found '{}'\n\tin {}".format(regex, logfilename))
-                        return (True, i, search.groups())
-            if time.monotonic() < deadline:
-                time.sleep(.3)
-            else:
-                err("Can't find '{}'\n\tin log of {} on {} after {}s".format(regex, program,
-                                                                             container, timeout))
-                return (False, start_line, None)
-    except OSError:
+        # The follower is shared by all checks on the same log, so the log is only read once.
+        follower = get_log_follower(_docker_logfilename(container, program))
+        line, match = follower.wait_for_line(regex, start_line, timeout)
+    except (OSError, subprocess.CalledProcessError):
         err("Can't read log of {} on {}".format(program, container))
         return (False, start_line, None)
+    if match:
+        debug("Found '{}'\n\tin {}".format(regex, follower.logfilename))
+        return (True, line, match.groups())
+    err("Can't find '{}'\n\tin log of {} on {} after {}s".format(regex, program, container,
+                                                                 timeout))
+    return (False, start_line, None)
+
+
+def _docker_wait_for_logs(container: str, program: str, regexes: [str], start_line: int,
+                          timeout: float) -> Dict[str, Tuple[bool, int, tuple]]:
+    try:
+        follower = get_log_follower(_docker_logfilename(container, program))
+        matches = follower.wait_for_lines(regexes, start_line, timeout)
+    except (OSError, subprocess.CalledProcessError):
+        err("Can't read log of {} on {}".format(program, container))
+        return {regex: (False, start_line, None) for regex in regexes}
+    results = {}
+    for regex, (line, match) in matches.items():
+        if match:
+            debug("Found '{}'\n\tin {}".format(regex, follower.logfilename))
+            results[regex] = (True, line, match.groups())
+        else:
+            err("Can't find '{}'\n\tin log of {} on {} after {}s".format(regex, program,
+                                                                         container, timeout))
+            results[regex] = (False, start_line, None)
+    return results
 
 
 class ALEntityDocker(ALEntity):
@@ -207,13 +286,12 @@ class ALEntityDocker(ALEntity):
         self.bridge_name = 'br-lan'
 
         # First, get the UCC port from the config file
-        if is_controller:
-            config_file_name = 'beerocks_controller.conf'
-        else:
-            config_file_name = 'beerocks_agent.conf'
-        with open(os.path.join(installdir, 'config', config_file_name)) as config_file:
-            ucc_port = \
-                re.search(r'ucc_listener_port=(?P<port>[0-9]+)', config_file.read()).group('port')
+        ucc_port = _docker_ucc_port(is_controller)
+
+        # Get the addresses and links of all interfaces with a single docker exec. The radios
+        # take their MAC address from it as well.
+        self.ip_output = self.command(
+            'sh', '-c', 'ip -o -f inet addr show; ip -o link list').decode('utf-8')
 
         # On WSL, connect to the locally exposed container port
         if on_wsl:
@@ -222,20 +300,19 @@ class ALEntityDocker(ALEntity):
             device_ip = published_port_output[0]
             ucc_port = int(published_port_output[1])
         else:
-            device_ip_output = self.command(
-                'ip', '-f', 'inet', 'addr', 'show', self.bridge_name)
-            device_ip = re.search(
-                r'inet (?P<ip>[0-9.]+)', device_ip_output.decode('utf-8')).group('ip')
+            device_ip = re.search(r'^\d+: {}\s+inet (?P<ip>[0-9.]+)'.format(self.bridge_name),
+                                  self.ip_output, re.MULTILINE).group('ip')
 
         ucc_socket = UCCSocket(device_ip, ucc_port)
         mac = ucc_socket.dev_get_parameter('ALid')
 
         super().__init__(mac, ucc_socket, installdir, is_controller)
 
-        # We always have two radios, wlan0 and wlan2
-        RadioDocker(self, "wlan0")
-        RadioDocker(self, "wlan2")
+        # The radios are the wlan interfaces (normally wlan0 and wlan2), without the VAPs.
+        for iface_name in re.findall(r'^\d+: (wlan\d+)(?:@\S+)?:', self.ip_output, re.MULTILINE):
+            RadioDocker(self, iface_name)
 
+    @profiler.profiled('docker_exec', lambda self, *command, **kwargs: ' '.join(command)[:100])
     def command(self, *command: str) -> bytes:
         '''Execute `command` in docker container and return its output.'''
         return subprocess.check_output(("docker", "exec", self.name) + command)
@@ -245,14 +322,21 @@ class ALEntityDocker(ALEntity):
         program = "controller" if self.is_controller else "agent"
         return _docker_wait_for_log(self.name, program, regex, start_line, timeout)
 
+    def wait_for_logs(self, regexes: [str], start_line: int,
+                      timeout: float) -> Dict[str, Tuple[bool, int, tuple]]:
+        '''Poll the entity's logfile until it contains all "regexes" or times out.'''
+        program = "controller" if self.is_controller else "agent"
+        return _docker_wait_for_logs(self.name, program, regexes, start_line, timeout)
+
 
 class RadioDocker(Radio):
     '''Docker implementation of a radio.'''
 
     def __init__(self, agent: ALEntityDocker, iface_name: str):
         self.iface_name = iface_name
-        ip_output = agent.command("ip", "-o",  "link", "list", "dev", self.iface_name).decode()
-        mac = re.search(r"link/ether (([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2})", ip_output).group(1)
+        mac = re.search(r"^\d+: {}(@\S+)?: .*link/ether (?P<mac>([0-9a-fA-F]{{2}}:){{5}}"
+                        r"[0-9a-fA-F]{{2}})".format(self.iface_name),
+                        agent.ip_output, re.MULTILINE).group('mac')
         super().__init__(agent, mac)
 
         # Since dummy bwl always uses the first VAP, in practice we always have a single VAP with
@@ -264,12 +348,41 @@ class RadioDocker(Radio):
         program = "agent_" + self.iface_name
         return _docker_wait_for_log(self.agent.name, program, regex, start_line, timeout)
 
+    def wait_for_logs(self, regexes: [str], start_line: int,
+                      timeout: float) -> Dict[str, Tuple[bool, int, tuple]]:
+        '''Poll the radio's logfile until it contains all "regexes" or times out.'''
+        program = "agent_" + self.iface_name
+        return _docker_wait_for_logs(self.agent.name, program, regexes, start_line, timeout)
+
     def send_bwl_event(self, event: str) -> None:
         # The file is only available within the docker container so we need to use an echo command.
         # Inside the container, $USER is set to the username that was used for starting it.
         command = "echo \"{}\" > /tmp/$USER/beerocks/{}/EVENT".format(event, self.iface_name)
         self.agent.command('sh', '-c', command)
 
+    def send_bwl_events(self, events: List[str]) -> None:
+        '''Send many events to the dummy bwl with a single command.
+
+        The events are written to a temporary file outside the watched directory and moved in
+        place, so the agent never reads a partial batch. They are passed as arguments to the shell
+        to avoid quoting issues.
+        '''
+        script = ('tmp=/tmp/$USER/beerocks/{iface}.EVENT.$$ && printf "%s\\n" "$@" > $tmp && '
+                  'mv $tmp /tmp/$USER/beerocks/{iface}/EVENT').format(iface=self.iface_name)
+        self.agent.command('sh', '-c', script, 'sh', *events)
+
+    def send_station_events(self, events: List[Tuple[Station, StationEvent]]) -> None:
+        '''Associate and disassociate many stations with the radio's VAP in one go.'''
+        self.send_bwl_events(["EVENT {} {}".format(_BWL_STATION_EVENTS[event], sta.mac)
+                              for sta, event in events])
+
+
+# The dummy bwl event for each StationEvent.
+_BWL_STATION_EVENTS = {
+    StationEvent.CONNECT: "AP-STA-CONNECTED",
+    StationEvent.DISCONNECT: "AP-STA-DISCONNECTED",
+}
+
 
 class VirtualAPDocker(VirtualAP):
     '''Docker implementation of a VAP.'''
@@ -313,34 +426,162 @@ def _get_bridge_interface(docker_network):
     return bridge
 
 
-def launch_environment_docker(unique_id: str, skip_init: bool = False, tag: str = ""):
+def _docker_ucc_port(is_controller: bool) -> str:
+    '''Get the UCC port of the controller or agent from its config file.'''
+    if is_controller:
+        config_file_name = 'beerocks_controller.conf'
+    else:
+        config_file_name = 'beerocks_agent.conf'
+    with open(os.path.join(installdir, 'config', config_file_name)) as config_file:
+        return re.search(r'ucc_listener_port=(?P<port>[0-9]+)', config_file.read()).group('port')
+
+
+def _docker_start(name: str, network: str, unique_id: str, tag: str,
+                  is_controller: bool = False) -> None:
+    '''Start a prplMesh container "name" attached to "network", in the background.'''
+    command = [os.path.join(rootdir, "tools", "docker", "run.sh"), "--force", "--detach",
+               "--unique-id", unique_id, "--name", name, "--network", network]
+    if tag:
+        command += ["--tag", tag]
+    # On WSL, the UCC port has to be published to be reachable from the host
+    if on_wsl:
+        ucc_port = _docker_ucc_port(is_controller)
+        command += ["--expose", ucc_port, "--publish", "127.0.0.1::" + ucc_port]
+    command.append("start-controller-agent" if is_controller else "start-agent")
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+
+
+def _docker_wait_operational(name: str, timeout: float) -> None:
+    '''Wait until prplMesh in container "name" reports that it is operational.
+
+    Raises TimeoutError if it is not operational after "timeout" seconds.
+    '''
+    test_command = [os.path.join(rootdir, "tools", "docker", "test.sh"), "-n", name]
+    deadline = time.monotonic() + timeout
+    while subprocess.run(test_command, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL).returncode != 0:
+        if time.monotonic() > deadline:
+            raise TimeoutError("{} not operational after {}s".format(name, timeout))
+        time.sleep(.5)
+    debug("{} operational".format(name))
+
+
+def _docker_connect_downstream(name: str, network: str) -> None:
+    '''Connect container "name" to "network" and bridge the new interface into its br-lan.'''
+    inspect_result = subprocess.run(('docker', 'network', 'inspect', network),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if inspect_result.returncode != 0:
+        subprocess.check_call(('docker', 'network', 'create', network), stdout=subprocess.DEVNULL)
+        # Register the network so tools/docker/stop.sh removes it, like run.sh does.
+        with open(os.path.join(rootdir, 'tools', 'docker', '.test_containers'), 'a') as f:
+            f.write('network {}\n'.format(network))
+    subprocess.check_call(('docker', 'network', 'connect', network, name))
+    # The new interface is the only ethernet interface that is not in the bridge yet.
+    subprocess.check_call(('docker', 'exec', name, 'sh', '-c',
+                           'for iface in $(ls /sys/class/net | grep "^eth"); do '
+                           '[ -e /sys/class/net/$iface/master ] || { '
+                           'ip address flush dev $iface; ip link set dev $iface master br-lan; }; '
+                           'done'))
+
+
+# Supported topologies for launch_environment_docker.
+TOPOLOGIES = ('star', 'chain', 'tree')
+
+
+def _topology_parents(num_agents: int, topology: str, fanout: int = 2) -> List[int]:
+    '''Get the index of the parent of each agent in "topology"; -1 is the gateway.
+
+    In a star, all agents are connected to the gateway. In a chain, each agent is connected to the
+    previous one. In a tree, the gateway and each agent have "fanout" children.
+    '''
+    if topology == 'star':
+        return [-1] * num_agents
+    if topology == 'chain':
+        return [i - 1 for i in range(num_agents)]
+    if topology == 'tree':
+        return [i // fanout - 1 for i in range(num_agents)]
+    raise ValueError("Unknown topology {}".format(topology))
+
+
+def _launch_containers_docker(unique_id: str, gateway: str, repeaters: List[str], tag: str,
+                              topology: str, timeout: float) -> None:
+    '''Start the gateway and repeater containers, and wait until they are operational.
+
+    The repeaters are started level by level, all repeaters of a level in parallel. A repeater is
+    started when its parent is operational.
+    '''
+    network = 'prplMesh-net-{}'.format(unique_id)
+    _docker_start(gateway, network, unique_id, tag, is_controller=True)
+    _docker_wait_operational(gateway, timeout)
+
+    parents = _topology_parents(len(repeaters), topology)
+    started = {-1}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        while len(started) <= len(repeaters):
+            level = [i for i, parent in enumerate(parents)
+                     if i not in started and parent in started]
+            for parent in sorted({parents[i] for i in level} - {-1}):
+                _docker_connect_downstream(repeaters[parent],
+                                           '{}-{}'.format(network, repeaters[parent]))
+            for i in level:
+                if parents[i] == -1:
+                    _docker_start(repeaters[i], network, unique_id, tag)
+                else:
+                    _docker_start(repeaters[i], '{}-{}'.format(network, repeaters[parents[i]]),
+                                  unique_id, tag)
+            list(executor.map(lambda i: _docker_wait_operational(repeaters[i], timeout), level))
+            started.update(level)
+
+
+def launch_environment_docker(unique_id: str, skip_init: bool = False, tag: str = "",
+                              num_agents: int = 2, topology: str = 'star',
+                              timeout: float = 120):
+    '''Start (unless "skip_init") and discover a gateway and "num_agents" repeaters.
+
+    The repeaters are connected to the gateway according to "topology", see _topology_parents.
+    Each repeater other than the ones connected to the gateway is on a separate docker network
+    (prplMesh-net-<unique_id>-<parent>) that is bridged into the br-lan of its parent. Note that
+    the wired sniffer only captures on the gateway's network.
+    '''
     global wired_sniffer
     iface = _get_bridge_interface('prplMesh-net-{}'.format(unique_id))
-    wired_sniffer = sniffer.Sniffer(iface, opts.tcpdump_dir)
+    wired_sniffer = sniffer.Sniffer(iface, opts.tcpdump_dir, use_tshark=not opts.native_decoder,
+                                    ring_buffer_files=opts.ring_buffer_files,
+                                    ring_buffer_filesize=opts.ring_buffer_filesize)
 
     gateway = 'gateway-' + unique_id
-    repeater1 = 'repeater1-' + unique_id
-    repeater2 = 'repeater2-' + unique_id
+    repeaters = ['repeater{}-{}'.format(i + 1, unique_id) for i in range(num_agents)]
 
     if not skip_init:
-        command = [os.path.join(rootdir, "tests", "test_gw_repeater.sh"), "-f", "-u", unique_id,
-                   "-g", gateway, "-r", repeater1, "-r", repeater2, "-d", "7"]
-        if tag:
-            command += ["-t", tag]
         wired_sniffer.start('init')
         try:
-            subprocess.check_call(command)
+            _launch_containers_docker(unique_id, gateway, repeaters, tag, topology, timeout)
         finally:
             wired_sniffer.stop()
 
     global controller, agents
-    controller = ALEntityDocker(gateway, True)
-    agents = (ALEntityDocker(repeater1), ALEntityDocker(repeater2))
+
+    def discover(name: str, is_controller: bool = False) -> Tuple[ALEntityDocker, float]:
+        start = time.monotonic()
+        entity = ALEntityDocker(name, is_controller)
+        return entity, time.monotonic() - start
+
+    # Discover the entities in parallel, so it takes as long as the slowest one, not the sum.
+    discovery_start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        controller_future = executor.submit(discover, gateway, True)
+        agent_futures = [executor.submit(discover, repeater) for repeater in repeaters]
+        controller, controller_time = controller_future.result()
+        agent_results = [agent_future.result() for agent_future in agent_futures]
+    agents = tuple(agent for agent, _ in agent_results)
+    discovery_time = time.monotonic() - discovery_start
+    # The sum of the discovery times is how long it would take one entity after the other.
+    serial_time = controller_time + sum(agent_time for _, agent_time in agent_results)
+    status('Discovered {} entities in {:.2f}s ({:.2f}s serial)'.format(
+        1 + len(agents), discovery_time, serial_time))
 
     debug('controller: {}'.format(controller.mac))
-    debug('agent1: {}'.format(agents[0].mac))
-    debug('agent1 wlan0: {}'.format(agents[0].radios[0].mac))
-    debug('agent1 wlan2: {}'.format(agents[0].radios[1].mac))
-    debug('agent2: {}'.format(agents[1].mac))
-    debug('agent2 wlan0: {}'.format(agents[1].radios[0].mac))
-    debug('agent2 wlan2: {}'.format(agents[1].radios[1].mac))
+    for i, agent in enumerate(agents):
+        debug('agent{}: {}'.format(i + 1, agent.mac))
+        for radio in agent.radios:
+            debug('agent{} {}: {}'.format(i + 1, radio.iface_name, radio.mac))
@@ -0,0 +1,290 @@
+###############################################################
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+# SPDX-FileCopyrightText: 2020 the prplMesh contributors (see AUTHORS.md)
+# This code is subject to the terms of the BSD+Patent license.
+# See LICENSE file for more details.
+###############################################################
+
+import array
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import time
+from typing import Dict, Iterable, Pattern, Tuple, Union
+
+
+class _Inotify:
+    '''Minimal inotify wrapper that watches a directory for modified or created files.
+
+    inotify is not available in the python standard library, so call it through ctypes. If it is
+    not available at all (e.g. not on Linux), "fd" is None and the caller has to poll.
+    '''
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, directory: str):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout: float) -> None:
+        '''Wait until something changes in the directory or "timeout" expires.'''
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                os.read(self.fd, 4096)  # Drain the events, we don't care about the details
+            except BlockingIOError:
+                pass
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LogFollower:
+    '''Follows a log file that is being appended to.
+
+    The follower keeps the byte offset up to which the file has been read, the offset of every
+    line, and the text of the lines read so far, so waiting for a new log line only reads what was
+    appended in the mean time. The text may be evicted to limit memory usage; it is then read
+    again from the file, using the line offsets, when it is needed.
+
+    If the file is rotated (different inode) or truncated, the follower starts over from the
+    beginning of the new file.
+
+    It wakes up on inotify events of the log directory, and falls back to polling if inotify is not
+    available.
+
+    Followers are shared by everybody who follows the same log: use get_log_follower to get one.
+    '''
+
+    # Polling interval when inotify is not available.
+    POLL_INTERVAL = 0.05
+    # Even with inotify, check the file regularly. Events may be missed, e.g. on network or
+    # bind-mounted file systems.
+    INOTIFY_INTERVAL = 0.5
+
+    def __init__(self, logfilename: str):
+        self.logfilename = logfilename
+        self.inotify = _Inotify(os.path.dirname(logfilename))
+        self.last_used = 0
+        self._reset(None)
+
+    def _reset(self, inode: int) -> None:
+        '''Forget everything that was read, e.g. because the file was rotated.'''
+        self.inode = inode
+        self.offset = 0
+        # Offsets of the start of each complete line, plus the offset after the last one.
+        self.line_offsets = array.array('Q', [0])
+        self.partial_line = b''
+        # Text of lines cached_from up to the last complete line.
+        self.cached_from = 0
+        self.lines = []
+        self.cached_size = 0
+
+    @property
+    def line_count(self) -> int:
+        return len(self.line_offsets) - 1
+
+    def update(self) -> None:
+        '''Read the lines that were appended to the log file since the last update.'''
+        self.last_used = time.monotonic()
+        with open(self.logfilename, 'rb') as logfile:
+            stat = os.fstat(logfile.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self._reset(stat.st_ino)
+            logfile.seek(self.offset)
+            data = logfile.read()
+        if not data:
+            return
+        data = self.partial_line + data
+        line_start = self.offset - len(self.partial_line)
+        self.offset += len(data) - len(self.partial_line)
+        *complete, self.partial_line = data.split(b'\n')
+        for line in complete:
+            line_start += len(line) + 1
+            self.line_offsets.append(line_start)
+        self.lines += [line.decode('utf-8', errors='replace') for line in complete]
+        self.cached_size += len(data) - len(self.partial_line)
+        _evict(self)
+
+    def evict(self, keep_bytes: int = 0) -> None:
+        '''Drop the cached text of the oldest lines, so at most "keep_bytes" of text remains.'''
+        drop_until = self.cached_from
+        cached_size = self.cached_size
+        while drop_until < self.line_count and cached_size > keep_bytes:
+            cached_size -= self.line_offsets[drop_until + 1] - self.line_offsets[drop_until]
+            drop_until += 1
+        del self.lines[:drop_until - self.cached_from]
+        self.cached_from = drop_until
+        self.cached_size = cached_size
+
+    def get_line(self, line_number: int) -> str:
+        '''Get the text of a complete line, reading it from the file again if it was evicted.'''
+        if line_number < self.cached_from:
+            self._reload(line_number)
+        return self.lines[line_number - self.cached_from]
+
+    def _reload(self, line_number: int) -> None:
+        '''Read evicted lines from "line_number" on back into the cache.'''
+        with open(self.logfilename, 'rb') as logfile:
+            start = self.line_offsets[line_number]
+            end = self.line_offsets[self.cached_from]
+            logfile.seek(start)
+            data = logfile.read(end - start)
+        # The file may have been rotated in the mean time; that is detected on the next update.
+        reloaded = [line.decode('utf-8', errors='replace') for line in data.split(b'\n')[:-1]]
+        reloaded += [''] * (self.cached_from - line_number - len(reloaded))
+        self.lines[:0] = reloaded
+        self.cached_size += end - start
+        self.cached_from = line_number
+
+    def wait_for_change(self, timeout: float) -> None:
+        '''Wait until the log file may have changed, at most "timeout" seconds.'''
+        if self.inotify.fd is not None:
+            self.inotify.wait(min(timeout, self.INOTIFY_INTERVAL))
+        else:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+
+    def wait_for_line(self, regex: Union[str, Pattern], start_line: int,
+                      timeout: float) -> Tuple[int, re.Match]:
+        '''Wait until a line after "start_line" matches "regex".
+
+        Returns
+        -------
+        Tuple[int, re.Match]
+            The line number and match object of the first matching line, or (None, None) if there
+            is no match after "timeout" seconds.
+
+        Raises
+        ------
+        OSError
+            If the log file can't be read.
+        '''
+        pattern = re.compile(regex)
+        deadline = time.monotonic() + timeout
+        # Line numbers up to and including start_line are skipped
+        next_line = max(start_line + 1, 0)
+        while True:
+            self.update()
+            for line_number in range(next_line, self.line_count):
+                match = pattern.search(self.get_line(line_number))
+                if match:
+                    return line_number, match
+            next_line = max(next_line, self.line_count)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None, None
+            self.wait_for_change(remaining)
+
+    def wait_for_lines(self, regexes: Iterable[str], start_line: int,
+                       timeout: float) -> Dict[str, Tuple[int, re.Match]]:
+        '''Wait until each of "regexes" matches a line after "start_line".
+
+        All regexes are combined into a single alternation with a named group per regex, so the
+        new log data is scanned only once, whatever the number of regexes.
+
+        Returns
+        -------
+        Dict[str, Tuple[int, re.Match]]
+            For each regex, the line number and match object of the first matching line, or
+            (None, None) if there is no match after "timeout" seconds.
+
+        Raises
+        ------
+        OSError
+            If the log file can't be read.
+        '''
+        patterns = {regex: re.compile(regex) for regex in regexes}
+        results = {regex: (None, None) for regex in patterns}
+        deadline = time.monotonic() + timeout
+        next_line = max(start_line + 1, 0)
+        remaining_regexes = list(patterns)
+        combined = _combine(remaining_regexes)
+        while True:
+            self.update()
+            for line_number in range(next_line, self.line_count):
+                line = self.get_line(line_number)
+                if combined and not combined.search(line):
+                    continue
+                # The alternation reports only one of the regexes, others may match as well.
+                for regex in remaining_regexes:
+                    match = patterns[regex].search(line)
+                    if match:
+                        results[regex] = (line_number, match)
+                missing = [regex for regex in remaining_regexes if results[regex][1] is None]
+                if len(missing) < len(remaining_regexes):
+                    if not missing:
+                        return results
+                    remaining_regexes = missing
+                    combined = _combine(missing)
+            next_line = max(next_line, self.line_count)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return results
+            self.wait_for_change(remaining)
+
+
+def _combine(regexes: [str]) -> Pattern:
+    '''Combine regexes into one that matches if any of them matches.
+
+    Returns None if they can't be combined (e.g. because of global flags, or numbered
+    backreferences that would be shifted by the extra groups). In that case every line has to be
+    checked against every regex.
+    '''
+    if any(re.search(r'\\[1-9]', regex) for regex in regexes):
+        return None
+    try:
+        return re.compile('|'.join('(?P<_{}>{})'.format(i, regex)
+                                   for i, regex in enumerate(regexes)))
+    except re.error:
+        return None
+
+
+# Upper limit for the text cached by all followers together.
+MAX_CACHED_BYTES = 64 * 1024 * 1024
+
+# All followers, indexed by log file name.
+_log_followers = {}
+
+
+def get_log_follower(logfilename: str) -> LogFollower:
+    '''Get the (shared) LogFollower for "logfilename", creating it if needed.'''
+    follower = _log_followers.get(logfilename)
+    if not follower:
+        follower = LogFollower(logfilename)
+        _log_followers[logfilename] = follower
+    return follower
+
+
+def _evict(current: LogFollower) -> None:
+    '''Evict cached text, least recently used followers first, until under MAX_CACHED_BYTES.'''
+    total = sum(follower.cached_size for follower in _log_followers.values())
+    if current.logfilename not in _log_followers:
+        total += current.cached_size
+    if total <= MAX_CACHED_BYTES:
+        return
+    for follower in sorted(_log_followers.values(), key=lambda follower: follower.last_used):
+        if follower is current:
+            continue
+        total -= follower.cached_size
+        follower.evict()
+        if total <= MAX_CACHED_BYTES:
+            return
+    # The current one is too large by itself. Keep half of the budget so it doesn't have to evict
+    # again on every update.
+    current.evict(MAX_CACHED_BYTES // 2)
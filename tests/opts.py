@@ -11,6 +11,11 @@ class opts:
     verbose = False
     tcpdump_dir = ''
     stop_on_failure = False
+    # Capture in a ring buffer of this many files of ring_buffer_filesize kB; 0 to disable.
+    ring_buffer_files = 0
+    ring_buffer_filesize = 10240
+    # Decode the captures natively instead of with tshark, see sniffer.compare_decoders.
+    native_decoder = False
 
 
 def message(msg: str, color: int = 0):
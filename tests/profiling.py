@@ -0,0 +1,104 @@
+###############################################################
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+# SPDX-FileCopyrightText: 2020 the prplMesh contributors (see AUTHORS.md)
+# This code is subject to the terms of the BSD+Patent license.
+# See LICENSE file for more details.
+###############################################################
+
+'''Timing of the operations done by the tests (log checks, CAPI commands, docker exec, ...).
+
+Operations are timed with Profiler.measure or the Profiler.profiled decorator, and attributed to
+the test that is running. Operations can be nested, e.g. a beerocks_cli_command does a docker
+exec: besides the total duration, each operation records its self time, i.e. without the nested
+operations, so the self times of a test add up to at most the test duration.
+'''
+
+import contextlib
+import functools
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+class Operation:
+    '''A single timed operation.'''
+    __slots__ = ('test', 'name', 'detail', 'duration', 'self_time')
+
+    def __init__(self, test: str, name: str, detail: str, duration: float, self_time: float):
+        self.test = test
+        self.name = name
+        self.detail = detail
+        self.duration = duration
+        self.self_time = self_time
+
+    def to_dict(self) -> dict:
+        return {'operation': self.name, 'detail': self.detail, 'time': self.duration}
+
+
+class Profiler:
+    '''Collects the operations of each test.'''
+
+    def __init__(self):
+        self.test = None
+        self.operations = {}
+        # Stack of the time spent in nested operations, per thread.
+        self._local = threading.local()
+
+    def start_test(self, test: str) -> None:
+        '''Attribute the operations from now on to "test".'''
+        self.test = test
+        self.operations[test] = []
+
+    @contextlib.contextmanager
+    def measure(self, name: str, detail: str = ''):
+        '''Context manager that times the operation "name" in the block it wraps.'''
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += duration
+            # Appending to a list is atomic, so this is safe from other threads as well.
+            self.operations.setdefault(self.test, []).append(
+                Operation(self.test, name, detail, duration, duration - nested))
+
+    def profiled(self, name: str, describe: Callable[..., str] = None) -> Callable:
+        '''Decorator that times every call of the function as operation "name".
+
+        "describe" is called with the arguments of the function and returns the detail to record,
+        e.g. the regex of a log check.
+        '''
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                detail = describe(*args, **kwargs) if describe else ''
+                with self.measure(name, detail):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def breakdown(self, test: str) -> Dict[str, Dict[str, float]]:
+        '''Get the number of calls, the total self time and the longest call per operation.'''
+        result = {}
+        for operation in self.operations.get(test, []):
+            entry = result.setdefault(operation.name, {'count': 0, 'time': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['time'] += operation.self_time
+            entry['max'] = max(entry['max'], operation.duration)
+        return result
+
+    def slowest(self, test: str, count: int) -> List[dict]:
+        '''Get the "count" longest operations of "test", longest first.'''
+        operations = sorted(self.operations.get(test, []),
+                            key=lambda operation: operation.duration, reverse=True)
+        return [operation.to_dict() for operation in operations[:count]]
+
+
+# The profiler used by the tests and the test environment.
+profiler = Profiler()
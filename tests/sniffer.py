@@ -5,10 +5,22 @@
 # See LICENSE file for more details.
 ###############################################################
 
+import argparse
+import bisect
 import os
 import json
+import re
+import struct
 import subprocess
+import sys
+import time
+import tracemalloc
 from opts import debug, err, status
+from profiling import profiler
+
+
+# Translation of tshark field names into attribute names.
+_ATTRIBUTE_NAME_TABLE = str.maketrans('. ', '__')
 
 
 class TlvStruct:
@@ -16,9 +28,9 @@ class TlvStruct:
 
     def __init__(self, captured, level):
         '''Convert the dict from tshark JSON into a TlvStruct.'''
+        attributes = {}
         for name, value in captured.items():
-            name = name.split('.', level)[-1].lower()
-            name = name.translate(str.maketrans('. ', '__'))
+            name = name.split('.', level)[-1].lower().translate(_ATTRIBUTE_NAME_TABLE)
             if name.endswith('_list') and isinstance(value, dict):
                 name = name[:-len('_list')]
                 # Normally, wireshark converts list fields to JSON as follows:
@@ -30,7 +42,8 @@ class TlvStruct:
                     value = [TlvStruct(value, level + 1)]
                 else:
                     value = [TlvStruct(v, level + 1) for k, v in value.items()]
-            setattr(self, name, value)
+            attributes[name] = value
+        self.__dict__.update(attributes)
 
     def __repr__(self):
         return "{" + ", ".join(["{!r}: {!r}".format(k, v) for k, v in self._d().items()]) + "}"
@@ -53,10 +66,22 @@ class Tlv(TlvStruct):
 
 
 class Packet:
-    '''Represents a single (IEEE1905.1) packet.'''
+    '''Represents a single (IEEE1905.1) packet.
 
-    def __init__(self, captured):
-        '''Convert the dict from tshark JSON into a Packet.'''
+    Only the header fields are decoded up front. The TLVs are only converted into Tlv objects when
+    ieee1905_tlvs is accessed, since most checks only look at the header.
+    '''
+
+    __slots__ = ('layers', 'frame_number', 'frame_time_epoch', 'frame_time', 'eth_src', 'eth_dst',
+                 'ieee1905', 'ieee1905_message_type', 'ieee1905_mid', 'ieee1905_fragment_id',
+                 'ieee1905_last_fragment', 'ieee1905_relay_indicator', '_tlv_data', '_tlvs')
+
+    def __init__(self, captured, tlv_data: bytes = None):
+        '''Convert the dict from tshark JSON into a Packet.
+
+        If "tlv_data" is given, it is the raw TLV stream of the CMDU (see decode_frame_header),
+        and the IEEE1905 layer in "captured" only has the header fields.
+        '''
         # Only the layers are of interest, discard the rest
         self.layers = captured['_source']['layers']
         self.frame_number = int(self.layers['frame']['frame.number'], 0)
@@ -73,13 +98,26 @@ class Packet:
             flags_tree = ieee1905['ieee1905.flags_tree']
             self.ieee1905_last_fragment = bool(int(flags_tree['ieee1905.last_fragment']))
             self.ieee1905_relay_indicator = bool(int(flags_tree['ieee1905.relay_indicator']))
-            self.ieee1905_tlvs = [Tlv(fields)
-                                  for name, fields in ieee1905.items()
-                                  if not name.startswith('ieee1905.') and
-                                  fields['ieee1905.tlv_type'] != '0']
+            self._tlv_data = tlv_data
+            self._tlvs = None
         else:
             self.ieee1905 = False
 
+    @property
+    def ieee1905_tlvs(self) -> ['Tlv']:
+        '''The TLVs of the CMDU, without the end of message TLV. Decoded on first access.'''
+        if not self.ieee1905:
+            raise AttributeError("Packet is not IEEE1905")
+        if self._tlvs is None:
+            ieee1905 = self.layers['ieee1905']
+            if self._tlv_data is not None:
+                ieee1905.update(decode_tlvs(self._tlv_data))
+                self._tlv_data = None
+            self._tlvs = [Tlv(fields) for name, fields in ieee1905.items()
+                          if not name.startswith('ieee1905.') and
+                          fields['ieee1905.tlv_type'] != '0']
+        return self._tlvs
+
     def __repr__(self):
         d = {
             "frame_number": self.frame_number,
@@ -96,32 +134,437 @@ class Packet:
         return "{" + ", ".join(["{!r}: {!r}".format(k, v) for k, v in d.items()]) + "}"
 
 
+def _hex(data: bytes) -> str:
+    '''Format a MAC address or byte field the way wireshark does, e.g. "aa:bb:cc".'''
+    return ':'.join('{:02x}'.format(b) for b in data)
+
+
+def _decode_assoc_event(value: bytes) -> dict:
+    '''Decode a Client Association Event TLV (0x92).'''
+    return {
+        'ieee1905.assoc_event.client_mac': _hex(value[0:6]),
+        'ieee1905.assoc_event.agent_bssid': _hex(value[6:12]),
+        'ieee1905.assoc_event.flags': '0x{:02x}'.format(value[12]),
+    }
+
+
+def _decode_operating_channel_report(value: bytes) -> dict:
+    '''Decode an Operating Channel Report TLV (0x8F).'''
+    num_op_classes = value[6]
+    op_classes = {}
+    for i in range(num_op_classes):
+        op_class, channel = value[7 + 2 * i:9 + 2 * i]
+        op_classes['Operating class {}'.format(i)] = {
+            'ieee1905.operating_channel.op_class': str(op_class),
+            'ieee1905.operating_channel.channel': str(channel),
+        }
+    fields = {'ieee1905.operating_channel.radio_id': _hex(value[0:6])}
+    if op_classes:
+        fields['Operating classes list'] = op_classes
+    fields['ieee1905.operating_channel.eirp'] = str(value[7 + 2 * num_op_classes])
+    return fields
+
+
+def _decode_ap_metrics(value: bytes) -> dict:
+    '''Decode an AP Metrics TLV (0x94).'''
+    return {
+        'ieee1905.ap_metrics.bssid': _hex(value[0:6]),
+        'ieee1905.ap_metrics.channel_utilization': str(value[6]),
+        'ieee1905.ap_metrics.sta_count': str(struct.unpack_from('>H', value, 7)[0]),
+        'ieee1905.ap_metrics.esp': _hex(value[9:]),
+    }
+
+
+def _decode_assoc_sta_link_metrics(value: bytes) -> dict:
+    '''Decode an Associated STA Link Metrics TLV (0x96).'''
+    bsses = {}
+    for i in range(value[6]):
+        offset = 7 + 19 * i
+        time_delta, downlink, uplink, rssi = struct.unpack_from('>IIIB', value, offset + 6)
+        bsses['BSS {}'.format(i)] = {
+            'ieee1905.assoc_sta_link_metrics.bssid': _hex(value[offset:offset + 6]),
+            'ieee1905.assoc_sta_link_metrics.time_delta': str(time_delta),
+            'ieee1905.assoc_sta_link_metrics.downlink_data_rate': str(downlink),
+            'ieee1905.assoc_sta_link_metrics.uplink_data_rate': str(uplink),
+            'ieee1905.assoc_sta_link_metrics.uplink_rssi': str(rssi),
+        }
+    fields = {'ieee1905.assoc_sta_link_metrics.mac_addr': _hex(value[0:6])}
+    if bsses:
+        fields['BSS list'] = bsses
+    return fields
+
+
+def _decode_assoc_sta_traffic_stats(value: bytes) -> dict:
+    '''Decode an Associated STA Traffic Stats TLV (0xA2).'''
+    names = ('bytes_sent', 'bytes_received', 'packets_sent', 'packets_received',
+             'tx_packet_errors', 'rx_packet_errors', 'retransmission_count')
+    fields = {'ieee1905.assoc_sta_traffic_stats.mac_addr': _hex(value[0:6])}
+    for name, counter in zip(names, struct.unpack_from('>7I', value, 6)):
+        fields['ieee1905.assoc_sta_traffic_stats.' + name] = str(counter)
+    return fields
+
+
+# Decoders for the TLV values that the tests look into, indexed by TLV type.
+# Each decoder returns a dict with the same layout as the tshark JSON output for that TLV. TLVs
+# without a decoder only get their type, length and raw value (tlv_value), so a test that looks
+# into the fields of another TLV needs tshark, or a decoder added here. compare_decoders checks
+# the decoders against tshark.
+TLV_DECODERS = {
+    0x8F: _decode_operating_channel_report,
+    0x92: _decode_assoc_event,
+    0x94: _decode_ap_metrics,
+    0x96: _decode_assoc_sta_link_metrics,
+    0xA2: _decode_assoc_sta_traffic_stats,
+}
+
+ETHERTYPE_VLAN = 0x8100
+ETHERTYPE_IEEE1905 = 0x893A
+
+
+def decode_frame(frame_number: int, timestamp: float, data: bytes) -> dict:
+    '''Decode an ethernet frame into a dict with the same layout as the tshark JSON output.
+
+    This is a native replacement for tshark, which only dissects the Ethernet header, the IEEE1905
+    CMDU header and the TLV stream.
+    '''
+    captured, tlv_data = decode_frame_header(frame_number, timestamp, data)
+    if tlv_data is not None:
+        captured['_source']['layers']['ieee1905'].update(decode_tlvs(tlv_data))
+    return captured
+
+
+def decode_frame_header(frame_number: int, timestamp: float, data: bytes) -> (dict, bytes):
+    '''Like decode_frame, but leave the TLVs undecoded.
+
+    Returns the decoded headers and the raw TLV stream, which is None if it is not an IEEE1905
+    frame. The TLV stream can be decoded later on with decode_tlvs.
+    '''
+    frame = {
+        'frame.number': str(frame_number),
+        'frame.time_epoch': '{:.9f}'.format(timestamp),
+        'frame.time': time.strftime('%b %e, %Y %H:%M:%S', time.localtime(timestamp)) +
+        '.{:09d} {}'.format(int(timestamp % 1 * 1e9), time.strftime('%Z')),
+    }
+    layers = {
+        'frame': frame,
+        'eth': {'eth.dst': _hex(data[0:6]), 'eth.src': _hex(data[6:12])},
+    }
+    offset = 12
+    (ethertype,) = struct.unpack_from('>H', data, offset)
+    if ethertype == ETHERTYPE_VLAN:
+        offset += 4
+        (ethertype,) = struct.unpack_from('>H', data, offset)
+    offset += 2
+    if ethertype != ETHERTYPE_IEEE1905 or len(data) < offset + 8:
+        return {'_source': {'layers': layers}}, None
+
+    _, _, message_type, mid, fragment_id, flags = struct.unpack_from('>BBHHBB', data, offset)
+    ieee1905 = {
+        'ieee1905.message_type': str(message_type),
+        'ieee1905.message_id': str(mid),
+        'ieee1905.fragment_id': str(fragment_id),
+        'ieee1905.flags_tree': {
+            'ieee1905.last_fragment': str((flags >> 7) & 1),
+            'ieee1905.relay_indicator': str((flags >> 6) & 1),
+        },
+    }
+    layers['ieee1905'] = ieee1905
+    return {'_source': {'layers': layers}}, data[offset + 8:]
+
+
+def decode_tlvs(data: bytes) -> dict:
+    '''Decode a TLV stream into the TLV entries of the tshark JSON IEEE1905 layer.'''
+    tlvs = {}
+    offset = 0
+    tlv_index = 0
+    while offset + 3 <= len(data):
+        tlv_type, tlv_length = struct.unpack_from('>BH', data, offset)
+        value = data[offset + 3:offset + 3 + tlv_length]
+        fields = {'ieee1905.tlv_type': str(tlv_type), 'ieee1905.tlv_length': str(tlv_length)}
+        decoder = TLV_DECODERS.get(tlv_type)
+        try:
+            fields.update(decoder(value) if decoder else {'ieee1905.tlv_value': _hex(value)})
+        except (IndexError, struct.error):
+            # Truncated TLV, keep the raw value
+            fields['ieee1905.tlv_value'] = _hex(value)
+        # tshark uses the TLV description as key; only uniqueness matters here.
+        tlvs['TLV {}'.format(tlv_index)] = fields
+        tlv_index += 1
+        offset += 3 + tlv_length
+        if tlv_type == 0:
+            break  # End of message TLV
+    return tlvs
+
+
+class PcapFollower:
+    '''Follows a libpcap file while it is being written.
+
+    The follower remembers the byte offset up to which it has consumed the file, so every call to
+    read_records only reads the records that were appended since the previous call. Records that
+    are only partially written are left for the next call.
+    '''
+
+    GLOBAL_HEADER_LEN = 24
+    RECORD_HEADER_LEN = 16
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.offset = 0
+        self.global_header = None
+        self.record_header = None
+        self.timestamp_resolution = 1e-6
+        # Index of the first record that is still on disk; a single file is never truncated.
+        self.first_record = 0
+
+    def _read_global_header(self, pcapfile) -> bool:
+        '''Read and validate the global header. Return False if it is not available yet.'''
+        header = pcapfile.read(self.GLOBAL_HEADER_LEN)
+        if len(header) < self.GLOBAL_HEADER_LEN:
+            return False
+        magic = header[:4]
+        if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'):
+            self.timestamp_resolution = 1e-9
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            self.record_header = struct.Struct('<IIII')
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            self.record_header = struct.Struct('>IIII')
+        else:
+            raise ValueError("{} is not a libpcap file".format(self.filename))
+        self.global_header = header
+        self.offset = self.GLOBAL_HEADER_LEN
+        return True
+
+    def read_records(self) -> [bytes]:
+        '''Return the complete records (record header included) appended since the last call.'''
+        records = []
+        try:
+            with open(self.filename, 'rb') as pcapfile:
+                if not self.global_header and not self._read_global_header(pcapfile):
+                    return records
+                pcapfile.seek(self.offset)
+                data = pcapfile.read()
+        except FileNotFoundError:
+            return records
+        pos = 0
+        while pos + self.RECORD_HEADER_LEN <= len(data):
+            incl_len = self.record_header.unpack_from(data, pos)[2]
+            end = pos + self.RECORD_HEADER_LEN + incl_len
+            if end > len(data):
+                break  # Record not completely written yet
+            records.append(data[pos:end])
+            pos = end
+        self.offset += pos
+        return records
+
+    def split_record(self, record: bytes) -> (float, bytes):
+        '''Split a record returned by read_records into its timestamp and the frame data.'''
+        ts_sec, ts_frac, incl_len, _ = self.record_header.unpack_from(record)
+        data = record[self.RECORD_HEADER_LEN:self.RECORD_HEADER_LEN + incl_len]
+        return ts_sec + ts_frac * self.timestamp_resolution, data
+
+
+class RingFollower:
+    '''Follows the files of a dumpcap ring buffer while they are being written.
+
+    With "-b files:N", dumpcap writes <base>_<number>_<timestamp>.pcap files, switching to a new
+    file when the current one is full and deleting the oldest one when there are more than N. The
+    records of all files are returned as a single stream, so frame numbers keep counting up over
+    file boundaries.
+
+    The records of files that dumpcap already deleted are lost: if the follower falls behind by a
+    whole ring, it continues with the oldest file that is still there.
+    '''
+
+    def __init__(self, filename: str):
+        base, extension = os.path.splitext(filename)
+        self.directory = os.path.dirname(filename) or '.'
+        self.pattern = re.compile(re.escape(os.path.basename(base)) +
+                                  r'_(\d{5,})_\d{14}' + re.escape(extension) + '$')
+        self.follower = None
+        self.file_number = 0
+        # (file number, index of its first record) of the files that were followed, oldest first.
+        self.files = []
+        self.record_count = 0
+        self.first_record = 0
+
+    @property
+    def global_header(self) -> bytes:
+        return self.follower.global_header if self.follower else None
+
+    def _ring_files(self) -> [(int, str)]:
+        '''Get the (number, filename) of the files of the ring that exist, oldest first.'''
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        files = []
+        for name in names:
+            match = self.pattern.match(name)
+            if match:
+                files.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    def read_records(self) -> [bytes]:
+        '''Return the complete records appended since the last call, over all files.'''
+        records = []
+        ring_files = self._ring_files()
+        for number, filename in ring_files:
+            if number < self.file_number:
+                continue
+            if number > self.file_number:
+                if self.follower and number > self.file_number + 1:
+                    err("{} capture file(s) were rotated out before they were decoded".format(
+                        number - self.file_number - 1))
+                self.follower = PcapFollower(filename)
+                self.file_number = number
+                self.files.append((number, self.record_count + len(records)))
+            # Once a newer file exists, dumpcap has finished this one, so it is read completely.
+            records.extend(self.follower.read_records())
+        self.record_count += len(records)
+        # Forget the files that dumpcap deleted; their records are no longer kept either.
+        existing = {number for number, _ in ring_files}
+        while len(self.files) > 1 and self.files[0][0] not in existing:
+            self.files.pop(0)
+        if self.files:
+            self.first_record = self.files[0][1]
+        return records
+
+    def split_record(self, record: bytes) -> (float, bytes):
+        '''Split a record returned by read_records into its timestamp and the frame data.
+
+        All files of the ring are written by the same dumpcap, so they have the same format.
+        '''
+        return self.follower.split_record(record)
+
+
+class PacketStore:
+    '''List of decoded packets, with hash indexes on the CMDU header fields.
+
+    The indexes map a field value to the (ascending) positions of the IEEE1905 packets that have
+    that value, so CMDUs can be looked up without scanning the whole capture.
+
+    Old packets can be discarded to bound the memory use. Positions are absolute, i.e. they stay
+    the same when packets before them are discarded, so a position saved as checkpoint remains
+    valid.
+    '''
+
+    INDEXED_FIELDS = ('ieee1905_message_type', 'eth_src', 'eth_dst', 'ieee1905_mid')
+
+    def __init__(self):
+        self.packets = []
+        # Number of packets that were discarded, i.e. the position of self.packets[0].
+        self.offset = 0
+        self.indexes = {field: {} for field in self.INDEXED_FIELDS}
+
+    def __len__(self):
+        return self.offset + len(self.packets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = max((index.start or 0) - self.offset, 0)
+            return self.packets[start:]
+        return self.packets[index - self.offset]
+
+    def extend(self, packets: [Packet]) -> None:
+        '''Append packets and update the indexes.'''
+        for packet in packets:
+            position = len(self)
+            self.packets.append(packet)
+            if not packet.ieee1905:
+                continue
+            for field, index in self.indexes.items():
+                index.setdefault(getattr(packet, field), []).append(position)
+
+    def discard_frames_before(self, frame_number: int) -> None:
+        '''Discard the packets with a frame number lower than "frame_number".'''
+        count = 0
+        while count < len(self.packets) and self.packets[count].frame_number < frame_number:
+            count += 1
+        if not count:
+            return
+        del self.packets[:count]
+        self.offset += count
+        for index in self.indexes.values():
+            for value in list(index):
+                positions = index[value]
+                first = bisect.bisect_left(positions, self.offset)
+                if first == len(positions):
+                    del index[value]
+                elif first:
+                    index[value] = positions[first:]
+
+    def find(self, start: int = 0, **fields) -> [Packet]:
+        '''Return the IEEE1905 packets from position "start" on that match all "fields".
+
+        "fields" are keyword arguments with a name from INDEXED_FIELDS. A value of None means the
+        field is not checked.
+        '''
+        fields = {field: value for field, value in fields.items() if value is not None}
+        if not fields:
+            return [packet for packet in self[start:] if packet.ieee1905]
+        # Start from the most selective index and check the other fields on the candidates.
+        candidates = min((self.indexes[field].get(value, []) for field, value in fields.items()),
+                         key=len)
+        candidates = candidates[bisect.bisect_left(candidates, max(start, self.offset)):]
+        packets = [self.packets[position - self.offset] for position in candidates]
+        return [packet for packet in packets
+                if all(getattr(packet, field) == value for field, value in fields.items())]
+
+
 class Sniffer:
-    '''Captures packets on an interface.'''
+    '''Captures packets on an interface.
 
-    def __init__(self, interface: str, tcpdump_log_dir: str):
+    The capture file is decoded incrementally: every time the capture is queried, only the frames
+    that were added since the previous query are decoded, and appended to the packets list.
+
+    Frames are decoded with tshark, unless use_tshark is False: then they are decoded natively by
+    decode_frame, which is much faster, but only decodes the fields of the TLVs in TLV_DECODERS.
+    Use compare_decoders to check that both give the same result for a capture.
+
+    If "ring_buffer_files" is set, dumpcap writes a ring buffer of that many files of at most
+    "ring_buffer_filesize" kB each, so a long running capture uses a bounded amount of disk. The
+    packets of the files that are rotated out are discarded as well, so the memory use is bounded
+    too. Checkpoints remain valid over file boundaries.
+    '''
+
+    # Interval to check for new packets when waiting for a CMDU.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, interface: str, tcpdump_log_dir: str, use_tshark: bool = True,
+                 ring_buffer_files: int = 0, ring_buffer_filesize: int = 10240):
         self.interface = interface
+        self.use_tshark = use_tshark
+        self.ring_buffer_files = ring_buffer_files
+        self.ring_buffer_filesize = ring_buffer_filesize
         self.tcpdump_log_dir = tcpdump_log_dir
         self.tcpdump_proc = None
         self.current_outputfile = None
-        self.checkpoint_frame_number = 0
+        self.follower = None
+        self.packets = PacketStore()
+        self.frame_count = 0
+        self.checkpoint_index = 0
 
     def start(self, outputfile_basename):
         '''Start tcpdump to outputfile.'''
         debug("Starting tcpdump, output file {}.pcap".format(outputfile_basename))
         os.makedirs(os.path.join(self.tcpdump_log_dir, 'logs'), exist_ok=True)
-        self.current_outputfile = os.path.join(self.tcpdump_log_dir, outputfile_basename) + ".pcap"
-        self.checkpoint_frame_number = 0
+        self.follow(os.path.join(self.tcpdump_log_dir, outputfile_basename) + ".pcap")
         # '-q' avoids the output, which we don't need.
-        command = ["dumpcap", "-i", self.interface, '-q', '-w', self.current_outputfile, "-f",
-                   "ether proto 0x88CC or ether proto 0x893A"]
+        # '-P' writes libpcap instead of pcapng, so the file can be followed record by record.
+        command = ["dumpcap", "-i", self.interface, '-q', '-P', '-w', self.current_outputfile,
+                   "-f", "ether proto 0x88CC or ether proto 0x893A"]
+        if self.ring_buffer_files:
+            command += ["-b", "files:{}".format(self.ring_buffer_files),
+                        "-b", "filesize:{}".format(self.ring_buffer_filesize)]
         self.tcpdump_proc = subprocess.Popen(command, stderr=subprocess.PIPE)
         # dumpcap takes a while to start up. Wait for the appropriate output before continuing.
         # poll() so we exit the loop if dumpcap terminates for any reason.
+        # In ring buffer mode, the file name that is reported has a number and timestamp added.
+        expected_output = b"File: " + os.path.splitext(self.current_outputfile)[0].encode()
         while not self.tcpdump_proc.poll():
             line = self.tcpdump_proc.stderr.readline()
             debug(line.decode()[:-1])  # strip off newline
-            if line.startswith(b"File: " + self.current_outputfile.encode()):
+            if line.startswith(expected_output):
                 # Make sure it doesn't block due to stderr buffering
                 self.tcpdump_proc.stderr.close()
                 break
@@ -129,36 +572,107 @@ class Sniffer:
             err("tcpdump terminated")
             self.tcpdump_proc = None
             self.current_outputfile = None
+            self.follower = None
 
-    def get_packet_capture(self):
-        '''Get a list of packets from the last started tcpdump.'''
-        if not self.current_outputfile:
-            err("get_packet_capture but no capture file")
-            return []
-        tshark_command = ['tshark', '-r', self.current_outputfile, '-T', 'json',
-                          '-Y', 'frame.number >= {}'.format(self.checkpoint_frame_number)]
-        tshark_result = subprocess.run(tshark_command, stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
+    def follow(self, outputfile: str) -> None:
+        '''Start decoding "outputfile" from the beginning, discarding the packets decoded so far.
+
+        In ring buffer mode, "outputfile" is the name passed to dumpcap, and the files of the ring
+        that is written based on it are followed.
+        '''
+        self.current_outputfile = outputfile
+        if self.ring_buffer_files:
+            self.follower = RingFollower(outputfile)
+        else:
+            self.follower = PcapFollower(outputfile)
+        self.packets = PacketStore()
+        self.frame_count = 0
+        self.checkpoint_index = 0
+
+    def _decode_records(self, records: [bytes], first_frame_number: int) -> [Packet]:
+        '''Decode pcap records into packets.'''
+        if self.use_tshark:
+            return self._decode_records_tshark(records, first_frame_number)
+        return [Packet(*decode_frame_header(first_frame_number + i,
+                                            *self.follower.split_record(record)))
+                for i, record in enumerate(records)]
+
+    def _decode_records_tshark(self, records: [bytes], first_frame_number: int) -> [Packet]:
+        '''Decode pcap records with tshark.
+
+        The records are fed to tshark on stdin as a small pcap file of their own, so tshark only
+        dissects the new frames. Frame numbers are fixed up to be relative to the whole capture.
+        '''
+        tshark_command = ['tshark', '-r', '-', '-T', 'json']
+        tshark_result = subprocess.run(tshark_command,
+                                       input=self.follower.global_header + b''.join(records),
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if tshark_result.returncode != 0:
             debug(tshark_result.stderr)
             debug("tshark failed: {}".format(tshark_result.returncode))
         # Regardless of the exit code, try to make something of the JSON that comes out, if any.
         try:
             capture = json.loads(tshark_result.stdout)
-            return [Packet(x) for x in capture]
         except json.JSONDecodeError as error:
-            err("capture JSON decoding failed: %s".format(error))
+            err("capture JSON decoding failed: {}".format(error))
+            return []
+        packets = [Packet(x) for x in capture]
+        for packet in packets:
+            packet.frame_number += first_frame_number - 1
+        return packets
+
+    @profiler.profiled('capture_decode')
+    def update(self) -> None:
+        '''Decode the frames that were captured since the last update.'''
+        if not self.follower:
+            return
+        records = self.follower.read_records()
+        if records:
+            self.packets.extend(self._decode_records(records, self.frame_count + 1))
+            self.frame_count += len(records)
+        # Frame numbers start at 1, record indexes at 0.
+        self.packets.discard_frames_before(self.follower.first_record + 1)
+
+    def get_packet_capture(self):
+        '''Get a list of packets from the last started tcpdump.'''
+        if not self.current_outputfile:
+            err("get_packet_capture but no capture file")
             return []
+        self.update()
+        return self.packets[self.checkpoint_index:]
 
     def checkpoint(self):
         '''Checkpoint the capture.
 
         Any subsequent calls to get_packet_capture will only return packets capture after now.
+        The checkpoint is a position in the packet list, so it is not affected by file rotation.
         '''
-        capture = self.get_packet_capture()
-        if capture:
-            self.checkpoint_frame_number = capture[-1].frame_number + 1
-        # else keep last checkpoint
+        self.update()
+        self.checkpoint_index = len(self.packets)
+
+    def find_cmdus(self, msg_type: int = None, eth_src: str = None, eth_dst: str = None,
+                   mid: int = None) -> [Packet]:
+        '''Get the CMDUs captured since the checkpoint with the given header fields.
+
+        Arguments that are None are not checked.
+        '''
+        if not self.current_outputfile:
+            err("find_cmdus but no capture file")
+            return []
+        self.update()
+        return self.packets.find(self.checkpoint_index, ieee1905_message_type=msg_type,
+                                 eth_src=eth_src, eth_dst=eth_dst, ieee1905_mid=mid)
+
+    def wait_for_cmdus(self, msg_type: int = None, eth_src: str = None, eth_dst: str = None,
+                       mid: int = None, timeout: float = 2) -> [Packet]:
+        '''Like find_cmdus, but wait until at least one CMDU is captured or "timeout" expires.'''
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.find_cmdus(msg_type, eth_src, eth_dst, mid)
+            if result or not self.current_outputfile or time.monotonic() >= deadline:
+                return result
+            # Only the new part of the capture is decoded, so polling is cheap.
+            time.sleep(self.POLL_INTERVAL)
 
     def stop(self):
         '''Stop tcpdump if it is running.'''
@@ -167,3 +681,124 @@ class Sniffer:
             self.tcpdump_proc.terminate()
             self.tcpdump_proc = None
             self.current_outputfile = None
+            self.follower = None
+
+
+_HEADER_ATTRIBUTES = ('eth_src', 'eth_dst', 'ieee1905', 'ieee1905_message_type', 'ieee1905_mid',
+                      'ieee1905_fragment_id', 'ieee1905_last_fragment',
+                      'ieee1905_relay_indicator')
+
+
+def _compare_attributes(native, tshark, path: str) -> [str]:
+    '''Compare the attributes of TlvStruct "native" with the same attributes of "tshark".'''
+    differences = []
+    for name, value in native._d().items():
+        tshark_value = getattr(tshark, name, None)
+        if isinstance(value, list) and isinstance(tshark_value, list) and \
+                len(value) == len(tshark_value):
+            for i, (item, tshark_item) in enumerate(zip(value, tshark_value)):
+                differences += _compare_attributes(item, tshark_item,
+                                                   "{}.{}[{}]".format(path, name, i))
+        elif value != tshark_value:
+            differences.append("{}.{}: native {!r}, tshark {!r}".format(
+                path, name, value, tshark_value))
+    return differences
+
+
+def compare_decoders(pcap: str) -> ([str], set):
+    '''Decode "pcap" natively and with tshark, and compare the attributes the tests read.
+
+    The header fields of every frame are compared, as well as the type and length of every TLV.
+    For the TLVs with a native decoder, all the attributes it decodes must be the same as the
+    ones of tshark.
+
+    Returns
+    -------
+    ([str], set)
+        The differences found, and the types of the TLVs in the capture that have no native
+        decoder, i.e. of which only the raw value is available with the native decoder.
+    '''
+    captures = []
+    for use_tshark in (False, True):
+        sniffer = Sniffer('', '', use_tshark)
+        sniffer.follow(pcap)
+        captures.append(sniffer.get_packet_capture())
+    native_packets, tshark_packets = captures
+    differences = []
+    undecoded = set()
+    if len(native_packets) != len(tshark_packets):
+        differences.append("native decoded {} frames, tshark {}".format(len(native_packets),
+                                                                        len(tshark_packets)))
+    for native, tshark in zip(native_packets, tshark_packets):
+        frame = "frame {}".format(tshark.frame_number)
+        if native.frame_number != tshark.frame_number:
+            differences.append("{}: native frame number {}".format(frame, native.frame_number))
+        for name in _HEADER_ATTRIBUTES:
+            native_value = getattr(native, name, None)
+            tshark_value = getattr(tshark, name, None)
+            if native_value != tshark_value:
+                differences.append("{}: {}: native {!r}, tshark {!r}".format(
+                    frame, name, native_value, tshark_value))
+        if not (native.ieee1905 and tshark.ieee1905):
+            continue
+        native_tlvs = native.ieee1905_tlvs
+        tshark_tlvs = tshark.ieee1905_tlvs
+        if [(tlv.tlv_type, tlv.tlv_length) for tlv in native_tlvs] != \
+                [(tlv.tlv_type, tlv.tlv_length) for tlv in tshark_tlvs]:
+            differences.append("{}: TLVs: native {}, tshark {}".format(
+                frame, [hex(tlv.tlv_type) for tlv in native_tlvs],
+                [hex(tlv.tlv_type) for tlv in tshark_tlvs]))
+            continue
+        for i, (native_tlv, tshark_tlv) in enumerate(zip(native_tlvs, tshark_tlvs)):
+            if native_tlv.tlv_type in TLV_DECODERS:
+                differences += _compare_attributes(native_tlv, tshark_tlv,
+                                                   "{}: TLV {}".format(frame, i))
+            else:
+                undecoded.add(native_tlv.tlv_type)
+    return differences, undecoded
+
+
+def benchmark_decoders(pcap: str) -> None:
+    '''Print the time and memory it takes to decode "pcap", natively and with tshark.'''
+    for use_tshark in (False, True):
+        decoder = "tshark" if use_tshark else "native"
+        sniffer = Sniffer('', '', use_tshark)
+        sniffer.follow(pcap)
+        start = time.perf_counter()
+        packets = sniffer.get_packet_capture()
+        elapsed = time.perf_counter() - start
+        print("{}: decoded {} frames in {:.3f}s".format(decoder, len(packets), elapsed))
+        # The TLVs are decoded lazily, so time them separately.
+        start = time.perf_counter()
+        tlvs = sum(len(packet.ieee1905_tlvs) for packet in packets if packet.ieee1905)
+        elapsed = time.perf_counter() - start
+        print("{}: decoded {} TLVs in {:.3f}s".format(decoder, tlvs, elapsed))
+        # Decode again to measure the memory, since tracing the allocations slows it down.
+        del sniffer, packets
+        tracemalloc.start()
+        sniffer = Sniffer('', '', use_tshark)
+        sniffer.follow(pcap)
+        sniffer.update()
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{}: {:.1f} MB for the decoded frames".format(decoder, memory / 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare native and tshark decoding of a capture")
+    parser.add_argument("pcap", help="The libpcap file to decode.")
+    parser.add_argument("--benchmark", action='store_true', default=False,
+                        help="also compare the time and memory it takes to decode the capture")
+    args = parser.parse_args()
+
+    differences, undecoded = compare_decoders(args.pcap)
+    for difference in differences:
+        err(difference)
+    if undecoded:
+        status("TLVs without native decoder (only tlv_value): {}".format(
+            ', '.join(hex(tlv_type) for tlv_type in sorted(undecoded))))
+    if args.benchmark:
+        benchmark_decoders(args.pcap)
+    if differences:
+        sys.exit(1)
+    status("native and tshark decoding are equivalent")
@@ -0,0 +1,271 @@
+###############################################################
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+# SPDX-FileCopyrightText: 2020 the prplMesh contributors (see AUTHORS.md)
+# This code is subject to the terms of the BSD+Patent license.
+# See LICENSE file for more details.
+###############################################################
+
+'''Station churn generator, to stress the controller with many (dis)associations.
+
+A schedule of station events is generated up front, according to an arrival rate and
+distribution. It is then played back: every batch interval, the events that are due are sent to
+the agents with a single command per radio. In the mean time, the connection map is polled to
+measure how long it takes until each event is reflected in bml_conn_map.
+
+It is a stress test, so it is not part of test_flows: run it on its own, see --help.
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import cmdu_latency
+import connmap
+import environment as env
+from opts import debug, opts, status
+
+# Supported distributions of the station arrivals.
+DISTRIBUTIONS = ('constant', 'poisson', 'burst')
+
+
+class ChurnEvent:
+    '''A station event that is scheduled "time" seconds after the start of the churn.'''
+
+    def __init__(self, time: float, vap: env.VirtualAP, sta: env.Station,
+                 event: env.StationEvent):
+        self.time = time
+        self.vap = vap
+        self.sta = sta
+        self.event = event
+        # Set when the event is sent, and when it is seen in the connection map.
+        self.sent = None
+        self.reflected = None
+
+
+def _arrival_times(rng: random.Random, num_stations: int, rate: float, distribution: str,
+                   burst_size: int) -> List[float]:
+    if distribution == 'constant':
+        return [i / rate for i in range(num_stations)]
+    if distribution == 'poisson':
+        arrivals = []
+        now = 0
+        for _ in range(num_stations):
+            arrivals.append(now)
+            now += rng.expovariate(rate)
+        return arrivals
+    if distribution == 'burst':
+        # Bursts of "burst_size" stations, spaced so the average rate is still "rate".
+        return [(i // burst_size) * burst_size / rate for i in range(num_stations)]
+    raise ValueError("Unknown distribution {}, choose from {}".format(
+        distribution, DISTRIBUTIONS))
+
+
+def generate_schedule(vaps: List[env.VirtualAP], num_stations: int, rate: float,
+                      distribution: str = 'poisson', mean_dwell: float = None,
+                      burst_size: int = 10, seed: int = None) -> List[ChurnEvent]:
+    '''Generate a schedule of station associations and disassociations.
+
+    Parameters
+    ----------
+    vaps: List[env.VirtualAP]
+        The VAPs to spread the stations over. Each station picks one at random.
+
+    num_stations: int
+        The number of stations that associate.
+
+    rate: float
+        The average number of associations per second.
+
+    distribution: str
+        How the associations are spread over time, one of DISTRIBUTIONS.
+
+    mean_dwell: float
+        The average time (exponentially distributed) a station stays associated before it
+        disassociates again. If None, the stations stay associated.
+
+    burst_size: int
+        The number of stations in each burst, for the 'burst' distribution.
+
+    seed: int
+        Seed of the random generator, to make the schedule reproducible. The schedule has its own
+        random generator, so the global one is not affected.
+
+    Returns
+    -------
+    List[ChurnEvent]
+        The events, sorted by time.
+    '''
+    rng = random.Random(seed)
+    schedule = []
+    for arrival in _arrival_times(rng, num_stations, rate, distribution, burst_size):
+        vap = rng.choice(vaps)
+        sta = env.Station.create()
+        schedule.append(ChurnEvent(arrival, vap, sta, env.StationEvent.CONNECT))
+        if mean_dwell is not None:
+            departure = arrival + rng.expovariate(1 / mean_dwell)
+            schedule.append(ChurnEvent(departure, vap, sta, env.StationEvent.DISCONNECT))
+    schedule.sort(key=lambda event: event.time)
+    return schedule
+
+
+class ReflectionWatcher(connmap.ConnMapWatcher):
+    '''Polls the connection map and marks the events that are reflected in it.
+
+    Only the last event sent for a station can be reflected: an earlier one may already have been
+    undone before the connection map was queried.
+    '''
+
+    def __init__(self, poll_interval: float):
+        super().__init__(poll_interval)
+        self.lock = threading.Lock()
+        # Last event that was sent, per station MAC.
+        self.last_events = {}
+        self.polls = 0
+
+    def sent(self, events: List[ChurnEvent]) -> None:
+        with self.lock:
+            for event in events:
+                self.last_events[event.sta.mac] = event
+
+    def pending(self) -> int:
+        with self.lock:
+            return sum(1 for event in self.last_events.values() if event.reflected is None)
+
+    def poll(self) -> List[connmap.TopologyChange]:
+        changes = super().poll()
+        now = time.monotonic()
+        self.polls += 1
+        conn_map = self.snapshot
+        with self.lock:
+            for event in self.last_events.values():
+                if event.reflected is not None:
+                    continue
+                if event.event == env.StationEvent.CONNECT:
+                    done = conn_map.client_bssid(event.sta.mac) == event.vap.bssid
+                else:
+                    done = event.sta.mac not in conn_map.clients
+                if done:
+                    event.reflected = now
+        return changes
+
+
+def run_churn(schedule: List[ChurnEvent], batch_interval: float = 0.1,
+              poll_interval: float = 0.5, settle_timeout: float = 30) -> Dict:
+    '''Play back "schedule" and measure when the events are reflected in the connection map.
+
+    Events that are due are sent every "batch_interval" seconds, with one command per radio. After
+    the last batch, the connection map is polled for up to "settle_timeout" seconds until all
+    events are reflected.
+
+    Returns
+    -------
+    Dict
+        Statistics of the run: the number of events and batches, the time it took to send them,
+        the reflection latency percentiles (in seconds) and the number of events that were never
+        reflected.
+    '''
+    watcher = ReflectionWatcher(poll_interval)
+    watcher.start()
+    batches = 0
+    send_time = 0
+    start = time.monotonic()
+    next_event = 0
+    try:
+        while next_event < len(schedule):
+            batch_start = time.monotonic()
+            now = batch_start - start
+            due = []
+            while next_event < len(schedule) and schedule[next_event].time <= now:
+                due.append(schedule[next_event])
+                next_event += 1
+            by_radio = {}
+            for event in due:
+                by_radio.setdefault(event.vap.radio, []).append(event)
+            for radio, events in by_radio.items():
+                send_start = time.monotonic()
+                radio.send_station_events([(event.sta, event.event) for event in events])
+                sent = time.monotonic()
+                send_time += sent - send_start
+                batches += 1
+                for event in events:
+                    event.sent = sent
+                watcher.sent(events)
+            if next_event < len(schedule):
+                # Wait for the next batch, but don't wait longer than needed for the next event.
+                next_batch = max(batch_start + batch_interval, start + schedule[next_event].time)
+                time.sleep(max(0, next_batch - time.monotonic()))
+        deadline = time.monotonic() + settle_timeout
+        while watcher.pending() and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+    finally:
+        watcher.stop()
+
+    latencies = sorted(event.reflected - event.sent for event in watcher.last_events.values()
+                       if event.reflected is not None)
+    result = {
+        "events": len(schedule),
+        "batches": batches,
+        "send_time": send_time,
+        "duration": time.monotonic() - start,
+        "conn_map_polls": watcher.polls,
+        "reflected": len(latencies),
+        "not_reflected": watcher.pending(),
+    }
+    for percentile in (50, 90, 99, 100):
+        if latencies:
+            result["latency_p{}".format(percentile)] = cmdu_latency.percentile_of(latencies,
+                                                                                  percentile)
+    debug("Station churn: {}".format(result))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stress the controller with station churn")
+    parser.add_argument("--verbose", "-v", action='store_true', default=False,
+                        help="report each action")
+    user = os.getenv("SUDO_USER", os.getenv("USER", ""))
+    parser.add_argument("--unique-id", "-u", type=str, default=user,
+                        help="append UNIQUE_ID to all container names, e.g. gateway-<UNIQUE_ID>; "
+                             "defaults to {}".format(user))
+    parser.add_argument("--tag", "-t", type=str,
+                        help="use runner image with tag TAG instead of 'latest'")
+    parser.add_argument("--skip-init", action='store_true', default=False,
+                        help="don't start up the containers")
+    parser.add_argument("--agents", type=int, default=2, help="number of repeaters to start")
+    parser.add_argument("--stations", type=int, default=100, help="number of stations")
+    parser.add_argument("--rate", type=float, default=50, help="associations per second")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default='poisson',
+                        help="how the associations are spread over time")
+    parser.add_argument("--burst-size", type=int, default=10,
+                        help="stations per burst, for the 'burst' distribution")
+    parser.add_argument("--mean-dwell", type=float, default=2,
+                        help="average seconds a station stays associated; 0 to stay associated")
+    parser.add_argument("--settle-timeout", type=float, default=30,
+                        help="seconds to wait for the last events to be reflected in conn_map")
+    parser.add_argument("--seed", type=int, help="seed for the schedule")
+    parser.add_argument("--output", "-o", type=str, help="write the JSON result to this file")
+    options = parser.parse_args()
+
+    opts.verbose = options.verbose
+    opts.tcpdump_dir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..', 'logs'))
+
+    env.launch_environment_docker(options.unique_id, options.skip_init, options.tag or "",
+                                  options.agents)
+    vaps = [vap for agent in env.agents for radio in agent.radios for vap in radio.vaps]
+    schedule = generate_schedule(vaps, options.stations, options.rate, options.distribution,
+                                 options.mean_dwell or None, options.burst_size, options.seed)
+    result = run_churn(schedule, settle_timeout=options.settle_timeout)
+
+    status("Station churn: {events} events in {batches} batches, "
+           "{reflected} reflected in conn_map, {not_reflected} not reflected".format(**result))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(result, output, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    sys.exit(1 if result['not_reflected'] else 0)
@@ -7,22 +7,34 @@
 ###############################################################
 
 import argparse
+import json
 import os
+import subprocess
 import sys
 import time
 from typing import Callable, Union
+import xml.etree.ElementTree as ElementTree
 
+import cmdu_latency
 import connmap
 import environment as env
 from capi import tlv
 from opts import debug, err, message, opts, status
+from profiling import profiler
 import sniffer
 
 
 class TestFlows:
+    # Timeout of check_log, for log lines that are expected to be there already.
+    LOG_TIMEOUT = 0.3
+    # Timeout of check_log right after wait_for_cmdu. The logs can lag behind the capture, so they
+    # get as long as the sleep that wait_for_cmdu replaced gave them.
+    REPLY_LOG_TIMEOUT = 1.3
+
     def __init__(self):
         self.tests = [attr[len('test_'):] for attr in dir(self) if attr.startswith('test_')]
         self.running = ''
+        self.results = {}
 
     def __fail_no_message(self) -> bool:
         '''Increment failure count and return False.'''
@@ -41,11 +53,15 @@ class TestFlows:
         self.running = test
         status(test + " starting")
 
+    @profiler.profiled('check_log',
+                       lambda self, entity_or_radio, regex, *args, **kwargs: regex)
     def check_log(self, entity_or_radio: Union[env.ALEntity, env.Radio], regex: str,
-                  start_line: int = 0) -> bool:
+                  start_line: int = 0, timeout: float = LOG_TIMEOUT) -> bool:
         '''Verify that the logfile for "entity_or_radio" matches "regex", fail if not.'''
-        return self.wait_for_log(entity_or_radio, regex, start_line, 0.3)
+        return self.wait_for_log(entity_or_radio, regex, start_line, timeout)
 
+    @profiler.profiled('wait_for_log',
+                       lambda self, entity_or_radio, regex, *args, **kwargs: regex)
     def wait_for_log(self, entity_or_radio: Union[env.ALEntity, env.Radio], regex: str,
                      start_line: int, timeout: float) -> bool:
         result, line, match = entity_or_radio.wait_for_log(regex, start_line, timeout)
@@ -53,6 +69,29 @@ class TestFlows:
             self.__fail_no_message()
         return result, line, match
 
+    @profiler.profiled('check_logs',
+                       lambda self, entity_or_radio, regexes, *args, **kwargs: ', '.join(regexes))
+    def check_logs(self, entity_or_radio: Union[env.ALEntity, env.Radio], regexes: [str],
+                   start_line: int = 0) -> bool:
+        '''Verify that the logfile for "entity_or_radio" matches all "regexes", fail if not.
+
+        The log is scanned once for all regexes together. A failure is counted for every regex
+        that is not found.
+        '''
+        return self.wait_for_logs(entity_or_radio, regexes, start_line, 0.3)
+
+    @profiler.profiled('wait_for_logs',
+                       lambda self, entity_or_radio, regexes, *args, **kwargs: ', '.join(regexes))
+    def wait_for_logs(self, entity_or_radio: Union[env.ALEntity, env.Radio], regexes: [str],
+                      start_line: int, timeout: float) -> bool:
+        results = entity_or_radio.wait_for_logs(regexes, start_line, timeout)
+        result = True
+        for found, _, _ in results.values():
+            if not found:
+                result = self.__fail_no_message()
+        return result
+
+    @profiler.profiled('check_cmdu', lambda self, msg, *args, **kwargs: msg)
     def check_cmdu(
         self, msg: str, match_function: Callable[[sniffer.Packet], bool]
     ) -> [sniffer.Packet]:
@@ -82,6 +121,7 @@ class TestFlows:
             self.fail("No CMDU {} found".format(msg))
         return result
 
+    @profiler.profiled('check_cmdu_type', lambda self, msg, *args, **kwargs: msg)
     def check_cmdu_type(
         self, msg: str, msg_type: int, eth_src: str, eth_dst: str = None, mid: int = None
     ) -> [sniffer.Packet]:
@@ -115,16 +155,49 @@ class TestFlows:
         """
         if eth_dst is None:
             eth_dst = "01:80:c2:00:00:13"
-        return self.check_cmdu(msg, lambda packet:
-                               packet.eth_src == eth_src and
-                               packet.eth_dst == eth_dst and
-                               packet.ieee1905_message_type == msg_type and
-                               (mid is None or packet.ieee1905_mid == mid))
+        debug("Checking for CMDU {}".format(msg))
+        # Use the sniffer's indexes rather than scanning the capture with check_cmdu
+        result = env.wired_sniffer.find_cmdus(msg_type, eth_src, eth_dst, mid)
+        if not result:
+            self.fail("No CMDU {} found".format(msg))
+        return result
+
+    @profiler.profiled('wait_for_cmdu', lambda self, msg, *args, **kwargs: msg)
+    def wait_for_cmdu(
+        self, msg: str, msg_type: int, eth_src: str, eth_dst: str = None, mid: int = None,
+        timeout: float = 2
+    ) -> [sniffer.Packet]:
+        '''Wait up to "timeout" seconds until the wired sniffer has captured a CMDU.
 
+        It returns as soon as a matching CMDU is captured, so use it instead of sleeping until a
+        reply is expected to have arrived. It does not fail if the CMDU is not captured: follow
+        it with the checks the test needs (e.g. check_cmdu_type, or check_log with
+        REPLY_LOG_TIMEOUT).
+
+        Returns
+        -------
+        [sniffer.Packet]
+            The matching packets, empty if the CMDU was not captured in time.
+        '''
+        if eth_dst is None:
+            eth_dst = "01:80:c2:00:00:13"
+        debug("Waiting for CMDU {}".format(msg))
+        result = env.wired_sniffer.wait_for_cmdus(msg_type, eth_src, eth_dst, mid, timeout)
+        if not result:
+            debug("No CMDU {} found after {}s".format(msg, timeout))
+        return result
+
+    @profiler.profiled('check_cmdu_type_single', lambda self, msg, *args, **kwargs: msg)
     def check_cmdu_type_single(
-        self, msg: str, msg_type: int, eth_src: str, eth_dst: str = None, mid: int = None
+        self, msg: str, msg_type: int, eth_src: str, eth_dst: str = None, mid: int = None,
+        timeout: float = 0
     ) -> Union[sniffer.Packet, None]:
-        '''Like check_cmdu_type, but also check that only a single CMDU is found.'''
+        '''Like check_cmdu_type, but also check that only a single CMDU is found.
+
+        If "timeout" is given, wait for the CMDU like wait_for_cmdu.
+        '''
+        if timeout:
+            self.wait_for_cmdu(msg, msg_type, eth_src, eth_dst, mid, timeout)
         cmdus = self.check_cmdu_type(msg, msg_type, eth_src, eth_dst, mid)
         if not cmdus:
             return None  # Failure already reported by check_cmdu
@@ -257,39 +330,68 @@ class TestFlows:
 
         return True
 
-    def run_tests(self, tests):
-        '''Run all tests as specified on the command line.'''
+    def run_tests(self, tests, top: int = 10):
+        '''Run all tests as specified on the command line.
+
+        The error count and wall time of each test are stored in self.results, together with the
+        time spent per kind of operation (see profiling) and the "top" slowest operations.
+        '''
         total_errors = 0
         if not tests:
             tests = self.tests
         for test in tests:
             test_full = 'test_' + test
             self.start_test(test)
+            profiler.start_test(test)
             env.wired_sniffer.start(test_full)
             self.check_error = 0
+            test_start = time.monotonic()
             try:
                 getattr(self, test_full)()
             finally:
+                self.write_cmdu_latency_report(test)
                 env.wired_sniffer.stop()
+                self.results[test] = {'errors': self.check_error,
+                                      'time': time.monotonic() - test_start,
+                                      'profile': profiler.breakdown(test),
+                                      'slowest': profiler.slowest(test, top)}
             if self.check_error != 0:
-                err(test + " failed")
+                err("{} failed ({:.1f}s)".format(test, self.results[test]['time']))
             else:
-                message(test + " OK", 32)
+                message("{} OK ({:.1f}s)".format(test, self.results[test]['time']), 32)
+            status("  " + format_profile(self.results[test]))
             total_errors += self.check_error
         return total_errors
 
+    def write_cmdu_latency_report(self, test: str) -> None:
+        '''Write the CMDU latencies of the capture of "test" next to the capture file.
+
+        The report covers the whole capture, also what was captured before the last checkpoint.
+        It is only informational, so a failure to write it is reported but not raised: it must not
+        hide the outcome of the test.
+        '''
+        capture_file = env.wired_sniffer.current_outputfile
+        if not capture_file:
+            return
+        report_file = os.path.splitext(capture_file)[0] + "_cmdu_latency.json"
+        try:
+            env.wired_sniffer.update()
+            # Not get_packet_capture, which only has the packets since the last checkpoint.
+            packets = list(env.wired_sniffer.packets[0:])
+            cmdu_latency.write_report(packets, report_file, test)
+        except Exception as error:
+            err("Failed to write the CMDU latency report {}: {}".format(report_file, error))
+            return
+        debug("CMDU latency report written to {}".format(report_file))
+
     # TEST DEFINITIONS #
 
     def test_initial_ap_config(self):
         '''Check initial configuration on repeater1.'''
-        self.check_log(env.agents[0].radios[0], r"WSC Global authentication success")
-        self.check_log(env.agents[0].radios[1], r"WSC Global authentication success")
-        self.check_log(env.agents[0].radios[0], r"KWA \(Key Wrap Auth\) success")
-        self.check_log(env.agents[0].radios[1], r"KWA \(Key Wrap Auth\) success")
-        self.check_log(env.agents[0].radios[0],
-                       r".* Controller configuration \(WSC M2 Encrypted Settings\)")
-        self.check_log(env.agents[0].radios[1],
-                       r".* Controller configuration \(WSC M2 Encrypted Settings\)")
+        for radio in env.agents[0].radios:
+            self.check_logs(radio, [r"WSC Global authentication success",
+                                    r"KWA \(Key Wrap Auth\) success",
+                                    r".* Controller configuration \(WSC M2 Encrypted Settings\)"])
 
     def test_ap_config_renew(self):
         # Regression test: MAC address should be case insensitive
@@ -425,10 +527,13 @@ class TestFlows:
     def test_channel_selection(self):
         debug("Send channel preference query")
         ch_pref_query_mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8004)
-        time.sleep(1)
+        self.wait_for_cmdu("channel preferency response", 0x8005, env.agents[0].mac,
+                           env.controller.mac, ch_pref_query_mid)
         debug("Confirming channel preference query has been received on agent")
-        self.check_log(env.agents[0].radios[0], "CHANNEL_PREFERENCE_QUERY_MESSAGE")
-        self.check_log(env.agents[0].radios[1], "CHANNEL_PREFERENCE_QUERY_MESSAGE")
+        self.check_log(env.agents[0].radios[0], "CHANNEL_PREFERENCE_QUERY_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
+        self.check_log(env.agents[0].radios[1], "CHANNEL_PREFERENCE_QUERY_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         # TODO should be a single response (currently two are sent)
         self.check_cmdu_type("channel preferency response", 0x8005, env.agents[0].mac,
@@ -469,13 +574,9 @@ class TestFlows:
             )
             time.sleep(1)
 
-            self.check_log(env.agents[0].radios[0], "CHANNEL_SELECTION_REQUEST_MESSAGE")
-            self.check_log(env.agents[0].radios[1], "CHANNEL_SELECTION_REQUEST_MESSAGE")
-
-            self.check_log(env.agents[0].radios[0],
-                           "tlvTransmitPowerLimit {}".format(payload_transmit_power))
-            self.check_log(env.agents[0].radios[1],
-                           "tlvTransmitPowerLimit {}".format(payload_transmit_power))
+            for radio in env.agents[0].radios:
+                self.check_logs(radio, ["CHANNEL_SELECTION_REQUEST_MESSAGE",
+                                        "tlvTransmitPowerLimit {}".format(payload_transmit_power)])
 
             # TODO should be a single response (currently two are sent)
             self.check_cmdu_type("channel selection response", 0x8007, env.agents[0].mac,
@@ -609,25 +710,31 @@ class TestFlows:
             env.checkpoint()
 
     def test_ap_capability_query(self):
-        env.controller.dev_send_1905(env.agents[0].mac, 0x8001)
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8001)
+        self.wait_for_cmdu("AP capability report", 0x8002, env.agents[0].mac,
+                           env.controller.mac, mid)
 
         debug("Confirming ap capability query has been received on agent")
-        self.check_log(env.agents[0], "AP_CAPABILITY_QUERY_MESSAGE")
+        self.check_log(env.agents[0], "AP_CAPABILITY_QUERY_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming ap capability report has been received on controller")
-        self.check_log(env.controller, "AP_CAPABILITY_REPORT_MESSAGE")
+        self.check_log(env.controller, "AP_CAPABILITY_REPORT_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
     def test_link_metric_query(self):
-        env.controller.dev_send_1905(env.agents[0].mac, 0x0005,
-                                     tlv(0x08, 0x0002, "0x00 0x02"))
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x0005,
+                                           tlv(0x08, 0x0002, "0x00 0x02"))
+        self.wait_for_cmdu("link metric response", 0x0006, env.agents[0].mac,
+                           env.controller.mac, mid)
 
         debug("Confirming link metric query has been received on agent")
-        self.check_log(env.agents[0], "Received LINK_METRIC_QUERY_MESSAGE")
+        self.check_log(env.agents[0], "Received LINK_METRIC_QUERY_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming link metric response has been received on controller")
-        self.check_log(env.controller, "Received LINK_METRIC_RESPONSE_MESSAGE")
+        self.check_log(env.controller, "Received LINK_METRIC_RESPONSE_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
         self.check_log(env.controller, "Received TLV_TRANSMITTER_LINK_METRIC")
         self.check_log(env.controller, "Received TLV_RECEIVER_LINK_METRIC")
 
@@ -654,9 +761,8 @@ class TestFlows:
         mid = env.controller.dev_send_1905(env.agents[0].mac, 0x800B,
                                            tlv(0x93, 0x0007, "0x01 {%s}" % (vap1.bssid)))
 
-        time.sleep(1)
         response = self.check_cmdu_type_single("AP metrics response", 0x800C, env.agents[0].mac,
-                                               env.controller.mac, mid)
+                                               env.controller.mac, mid, timeout=2)
         debug("Check AP metrics response has AP metrics")
         ap_metrics_1 = self.check_cmdu_has_tlv_single(response, 0x94)
         if ap_metrics_1:
@@ -677,9 +783,8 @@ class TestFlows:
         mid = env.controller.dev_send_1905(env.agents[1].mac, 0x800B,
                                            tlv(0x93, 0x0007, "0x01 {%s}" % vap2.bssid))
 
-        time.sleep(1)
         response = self.check_cmdu_type_single("AP metrics response", 0x800C, env.agents[1].mac,
-                                               env.controller.mac, mid)
+                                               env.controller.mac, mid, timeout=2)
         debug("Check AP Metrics Response message has AP Metrics TLV")
         ap_metrics_2 = self.check_cmdu_has_tlv_single(response, 0x94)
         if ap_metrics_2:
@@ -702,9 +807,8 @@ class TestFlows:
         debug("Send 1905 Link metric query to agent 1 (neighbor gateway)")
         mid = env.controller.dev_send_1905(env.agents[0].mac, 0x0005,
                                            tlv(0x08, 0x0008, "0x01 {%s} 0x02" % env.controller.mac))
-        time.sleep(1)
         response = self.check_cmdu_type_single("Link metrics response", 0x0006, env.agents[0].mac,
-                                               env.controller.mac, mid)
+                                               env.controller.mac, mid, timeout=2)
         # We requested specific neighbour, so only one transmitter and receiver link metrics TLV
         debug("Check link metrics response has transmitter link metrics")
         tx_metrics_1 = self.check_cmdu_has_tlv_single(response, 9)
@@ -714,8 +818,9 @@ class TestFlows:
         # Trigger combined infra metrics
         debug("Send Combined infrastructure metrics message to agent 1")
         mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8013)
+        # The ACK is sent after the combined infra metrics are handled, so wait for that one.
+        self.wait_for_cmdu("ACK", 0x8000, env.agents[0].mac, env.controller.mac, mid)
 
-        time.sleep(1)
         combined_infra_metrics = self.check_cmdu_type_single("Combined infra metrics", 0x8013,
                                                              env.controller.mac, env.agents[0].mac,
                                                              mid)
@@ -752,17 +857,21 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
 03 c7 01 10 """
 
         debug("Send client capability query for unconnected STA")
-        env.controller.dev_send_1905(env.agents[0].mac, 0x8009,
-                                     tlv(0x90, 0x000C,
-                                         '{} {}'.format(env.agents[0].radios[0].mac, sta1.mac)))
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8009,
+                                           tlv(0x90, 0x000C,
+                                               '{} {}'.format(env.agents[0].radios[0].mac,
+                                                              sta1.mac)))
+        self.wait_for_cmdu("client capability report", 0x800A, env.agents[0].mac,
+                           env.controller.mac, mid)
         debug("Confirming client capability query has been received on agent")
         # check that both radio agents received it, in the future we'll add a check to verify which
         # radio the query was intended for.
-        self.check_log(env.agents[0], r"CLIENT_CAPABILITY_QUERY_MESSAGE")
+        self.check_log(env.agents[0], r"CLIENT_CAPABILITY_QUERY_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming client capability report message has been received on controller")
-        self.check_log(env.controller, r"Received CLIENT_CAPABILITY_REPORT_MESSAGE")
+        self.check_log(env.controller, r"Received CLIENT_CAPABILITY_REPORT_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
         self.check_log(env.controller,
                        r"Result Code= FAILURE, client MAC= {}, BSSID= {}"
                        .format(sta1.mac, env.agents[0].radios[0].mac))
@@ -771,13 +880,16 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
         env.agents[0].radios[0].vaps[0].associate(sta2)
 
         debug("Send client capability query for connected STA")
-        env.controller.dev_send_1905(env.agents[0].mac, 0x8009,
-                                     tlv(0x90, 0x000C,
-                                         '{} {}'.format(env.agents[0].radios[0].mac, sta2.mac)))
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8009,
+                                           tlv(0x90, 0x000C,
+                                               '{} {}'.format(env.agents[0].radios[0].mac,
+                                                              sta2.mac)))
+        self.wait_for_cmdu("client capability report", 0x800A, env.agents[0].mac,
+                           env.controller.mac, mid)
 
         debug("Confirming client capability report message has been received on controller")
-        self.check_log(env.controller, r"Received CLIENT_CAPABILITY_REPORT_MESSAGE")
+        self.check_log(env.controller, r"Received CLIENT_CAPABILITY_REPORT_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
         self.check_log(env.controller,
                        r"Result Code= SUCCESS, client MAC= {}, BSSID= {}"
                        .format(sta2.mac, env.agents[0].radios[0].mac))
@@ -811,7 +923,9 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
         # TODO client blocking not implemented in dummy bwl
 
         # Check in connection map
-        conn_map = connmap.get_conn_map()
+        watcher = connmap.ConnMapWatcher()
+        watcher.poll()
+        conn_map = watcher.snapshot
         map_radio = conn_map[env.agents[0].mac].radios[env.agents[0].radios[0].mac]
         map_vap = map_radio.vaps[env.agents[0].radios[0].vaps[0].bssid]
         if sta.mac not in map_vap.clients:
@@ -820,8 +934,9 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
         # Associate with other radio, check that conn_map is updated
         env.agents[0].radios[0].vaps[0].disassociate(sta)
         env.agents[0].radios[1].vaps[0].associate(sta)
-        time.sleep(1)  # Wait for conn_map to be updated
-        conn_map = connmap.get_conn_map()
+        bssid1 = env.agents[0].radios[1].vaps[0].bssid
+        watcher.wait_for_topology(lambda conn_map: conn_map.client_bssid(sta.mac) == bssid1, 3)
+        conn_map = watcher.snapshot
         map_agent = conn_map[env.agents[0].mac]
         map_radio1 = map_agent.radios[env.agents[0].radios[1].mac]
         map_vap1 = map_radio1.vaps[env.agents[0].radios[1].vaps[0].bssid]
@@ -834,8 +949,9 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
 
         # Associate with other radio implies disassociate from first
         env.agents[0].radios[0].vaps[0].associate(sta)
-        time.sleep(1)  # Wait for conn_map to be updated
-        conn_map = connmap.get_conn_map()
+        bssid0 = env.agents[0].radios[0].vaps[0].bssid
+        watcher.wait_for_topology(lambda conn_map: conn_map.client_bssid(sta.mac) == bssid0, 3)
+        conn_map = watcher.snapshot
         map_agent = conn_map[env.agents[0].mac]
         map_radio1 = map_agent.radios[env.agents[0].radios[1].mac]
         map_vap1 = map_radio1.vaps[env.agents[0].radios[1].vaps[0].bssid]
@@ -870,55 +986,63 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
 
         mid = env.controller.dev_send_1905(env.agents[0].mac, 0x800D,
                                            tlv(0x95, 0x0006, '{sta_mac}'.format(sta_mac=sta.mac)))
-        time.sleep(1)
+        self.wait_for_cmdu("associated STA link metrics response", 0x800E, env.agents[0].mac,
+                           env.controller.mac, mid)
         self.check_log(env.agents[0],
-                       "Send AssociatedStaLinkMetrics to controller, mid = {}".format(mid))
+                       "Send AssociatedStaLinkMetrics to controller, mid = {}".format(mid),
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         env.agents[0].radios[0].vaps[0].disassociate(sta)
 
     def test_client_steering_mandate(self):
         debug("Send topology request to agent 1")
-        env.controller.dev_send_1905(env.agents[0].mac, 0x0002)
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x0002)
+        self.wait_for_cmdu("topology response", 0x0003, env.agents[0].mac, env.controller.mac,
+                           mid)
         debug("Confirming topology query was received")
-        self.check_log(env.agents[0], "TOPOLOGY_QUERY_MESSAGE")
+        self.check_log(env.agents[0], "TOPOLOGY_QUERY_MESSAGE", timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Send topology request to agent 2")
-        env.controller.dev_send_1905(env.agents[1].mac, 0x0002)
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[1].mac, 0x0002)
+        self.wait_for_cmdu("topology response", 0x0003, env.agents[1].mac, env.controller.mac,
+                           mid)
         debug("Confirming topology query was received")
-        self.check_log(env.agents[1], "TOPOLOGY_QUERY_MESSAGE")
+        self.check_log(env.agents[1], "TOPOLOGY_QUERY_MESSAGE", timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Send Client Steering Request message for Steering Mandate to CTT Agent1")
-        env.controller.dev_send_1905(env.agents[0].mac, 0x8014,
-                                       tlv(0x9B, 0x001b,
-                                           "{%s 0xe0 0x0000 0x1388 0x01 {0x000000110022} 0x01 {%s 0x73 0x24}}" % (env.agents[0].radios[0].mac, env.agents[1].radios[0].mac)))  # noqa E501
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8014,
+                                             tlv(0x9B, 0x001b,
+                                                 "{%s 0xe0 0x0000 0x1388 0x01 {0x000000110022} 0x01 {%s 0x73 0x24}}" % (env.agents[0].radios[0].mac, env.agents[1].radios[0].mac)))  # noqa E501
+        self.wait_for_cmdu("ACK", 0x8000, env.agents[0].mac, env.controller.mac, mid)
         debug("Confirming Client Steering Request message was received - mandate")
-        self.check_log(env.agents[0].radios[0], "Got steer request")
+        self.check_log(env.agents[0].radios[0], "Got steer request",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming BTM Report message was received")
-        self.check_log(env.controller, "CLIENT_STEERING_BTM_REPORT_MESSAGE")
+        self.check_log(env.controller, "CLIENT_STEERING_BTM_REPORT_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Checking BTM Report source bssid")
         self.check_log(env.controller, "BTM_REPORT from source bssid %s" %
-                       env.agents[0].radios[0].mac)
+                       env.agents[0].radios[0].mac, timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming ACK message was received")
-        self.check_log(env.agents[0].radios[0], "ACK_MESSAGE")
+        self.check_log(env.agents[0].radios[0], "ACK_MESSAGE", timeout=self.REPLY_LOG_TIMEOUT)
 
-        env.controller.dev_send_1905(env.agents[0].mac, 0x8014,
-                                       tlv(0x9B, 0x000C,
-                                           "{%s 0x00 0x000A 0x0000 0x00}" % env.agents[0].radios[0].mac))  # noqa E501
-        time.sleep(1)
+        mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8014,
+                                             tlv(0x9B, 0x000C,
+                                                 "{%s 0x00 0x000A 0x0000 0x00}" % env.agents[0].radios[0].mac))  # noqa E501
+        self.wait_for_cmdu("ACK", 0x8000, env.agents[0].mac, env.controller.mac, mid)
         debug("Confirming Client Steering Request message was received - Opportunity")
-        self.check_log(env.agents[0].radios[0], "CLIENT_STEERING_REQUEST_MESSAGE")
+        self.check_log(env.agents[0].radios[0], "CLIENT_STEERING_REQUEST_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming ACK message was received")
-        self.check_log(env.controller, "ACK_MESSAGE")
+        self.check_log(env.controller, "ACK_MESSAGE", timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming steering completed message was received")
-        self.check_log(env.controller, "STEERING_COMPLETED_MESSAGE")
+        self.check_log(env.controller, "STEERING_COMPLETED_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
         debug("Confirming ACK message was received")
         self.check_log(env.agents[0].radios[0], "ACK_MESSAGE")
@@ -1006,13 +1130,14 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
         debug("Send multi-ap policy config request with steering policy to agent 1")
         mid = env.controller.dev_send_1905(env.agents[0].mac, 0x8003,
                                              tlv(0x89, 0x000C, "{0x00 0x00 0x01 {%s 0x01 0xFF 0x14}}" % env.agents[0].radios[0].mac))  # noqa E501
-        time.sleep(1)
+        self.wait_for_cmdu("ACK", 0x8000, env.agents[0].mac, env.controller.mac, mid)
         debug("Confirming multi-ap policy config request has been received on agent")
 
-        self.check_log(env.agents[0], r"MULTI_AP_POLICY_CONFIG_REQUEST_MESSAGE")
-        time.sleep(1)
+        self.check_log(env.agents[0], r"MULTI_AP_POLICY_CONFIG_REQUEST_MESSAGE",
+                       timeout=self.REPLY_LOG_TIMEOUT)
         debug("Confirming multi-ap policy config ack message has been received on the controller")
-        self.check_log(env.controller, r"ACK_MESSAGE, mid=0x{:04x}".format(mid))
+        self.check_log(env.controller, r"ACK_MESSAGE, mid=0x{:04x}".format(mid),
+                       timeout=self.REPLY_LOG_TIMEOUT)
 
     def send_and_check_policy_config_metric_reporting(self, agent, include_sta_traffic_stats=True,
                                                       include_sta_link_metrics=True):
@@ -1028,9 +1153,8 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
                                    "{0x00 0x%02x %s}" % (len(radio_policies),
                                                          " ".join(radio_policies)))
         mid = env.controller.dev_send_1905(agent.mac, 0x8003, metric_reporting_tlv)
-        time.sleep(1)
         debug("Confirming multi-ap policy config request was acked by agent")
-        self.check_cmdu_type_single("ACK", 0x8000, agent.mac, env.controller.mac, mid)
+        self.check_cmdu_type_single("ACK", 0x8000, agent.mac, env.controller.mac, mid, timeout=2)
 
     def test_multi_ap_policy_config_w_metric_reporting_policy(self):
         self.send_and_check_policy_config_metric_reporting(env.agents[0], True, True)
@@ -1114,6 +1238,125 @@ e1 09 00 bf 0c b0 79 d1 33 fa ff 0c 03 fa ff 0c
         env.agents[0].radios[0].vaps[0].disassociate(sta)
 
 
+def format_profile(result: dict) -> str:
+    '''Format the time per operation of a test result on a single line, most expensive first.
+
+    The time that is not spent in any of the profiled operations (sleeps and the test logic
+    itself) is shown as "other".
+    '''
+    profile = result.get('profile', {})
+    operations = sorted(profile.items(), key=lambda item: item[1]['time'], reverse=True)
+    other = max(0, result['time'] - sum(entry['time'] for entry in profile.values()))
+    return ", ".join(["{} {:.1f}s ({}x)".format(name, entry['time'], entry['count'])
+                      for name, entry in operations] + ["other {:.1f}s".format(other)])
+
+
+def print_slowest(results: dict, top: int) -> None:
+    '''Print the "top" slowest operations over all tests in "results".'''
+    slowest = sorted(((operation, test) for test, result in results.items()
+                      for operation in result.get('slowest', [])),
+                     key=lambda item: item[0]['time'], reverse=True)[:top]
+    if not slowest:
+        return
+    status("Slowest operations:")
+    for operation, test in slowest:
+        status("  {:7.2f}s  {:30} {:22} {}".format(operation['time'], test,
+                                                   operation['operation'], operation['detail']))
+
+
+def write_junit(results: dict, filename: str) -> None:
+    '''Write "results" as a JUnit XML report, with the time per operation as system-out.'''
+    suite = ElementTree.Element('testsuite', {
+        'name': 'test_flows',
+        'tests': str(len(results)),
+        'failures': str(sum(1 for result in results.values() if result['errors'])),
+        'time': '{:.3f}'.format(sum(result['time'] for result in results.values())),
+    })
+    for test, result in results.items():
+        case = ElementTree.SubElement(suite, 'testcase', {
+            'classname': 'test_flows', 'name': test, 'time': '{:.3f}'.format(result['time'])})
+        if result['errors']:
+            ElementTree.SubElement(case, 'failure', {
+                'message': '{} errors'.format(result['errors'])})
+        ElementTree.SubElement(case, 'system-out').text = format_profile(result)
+    ElementTree.ElementTree(suite).write(filename, encoding='utf-8', xml_declaration=True)
+
+
+def run_tests_parallel(options: argparse.Namespace, tests: [str]) -> int:
+    '''Run "tests" sharded over "options.parallel" independent environments.
+
+    Every worker is a separate test_flows.py process with unique id <unique-id>-<k>, so it has its
+    own containers, docker network (prplMesh-net-<unique-id>-<k>), sniffer and log directory
+    (logs/worker-<k>). The output of worker k goes to logs/worker-<k>/test_flows.log.
+
+    The results of all workers are merged into a single report, which is printed and written to
+    logs/results.json.
+
+    Returns the total number of errors.
+    '''
+    workers = []
+    for k in range(options.parallel):
+        shard = tests[k::options.parallel]
+        if not shard:
+            continue
+        worker_dir = os.path.join(opts.tcpdump_dir, 'worker-{}'.format(k))
+        os.makedirs(worker_dir, exist_ok=True)
+        results_file = os.path.join(worker_dir, 'results.json')
+        if os.path.exists(results_file):
+            os.remove(results_file)
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--unique-id', '{}-{}'.format(options.unique_id, k),
+                   '--tcpdump-dir', worker_dir, '--results-file', results_file,
+                   '--agents', str(options.agents), '--topology', options.topology,
+                   '--top', str(options.top),
+                   '--ring-buffer-files', str(options.ring_buffer_files),
+                   '--ring-buffer-filesize', str(options.ring_buffer_filesize)]
+        for flag, enabled in (('--verbose', options.verbose),
+                              ('--stop-on-failure', options.stop_on_failure),
+                              ('--native-decoder', options.native_decoder),
+                              ('--skip-init', options.skip_init)):
+            if enabled:
+                command.append(flag)
+        if options.tag:
+            command += ['--tag', options.tag]
+        status("Starting worker {} with tests: {}".format(k, ', '.join(shard)))
+        with open(os.path.join(worker_dir, 'test_flows.log'), 'w') as log:
+            process = subprocess.Popen(command + shard, stdout=log, stderr=subprocess.STDOUT)
+        workers.append((k, process, results_file, shard))
+
+    results = {}
+    for k, process, results_file, shard in workers:
+        process.wait()
+        try:
+            with open(results_file) as f:
+                worker_results = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            log_file = os.path.join(os.path.dirname(results_file), 'test_flows.log')
+            err("Worker {} failed, see {}".format(k, log_file))
+            worker_results = {}
+        for test in shard:
+            # A test without results didn't run or was interrupted: count it as failed.
+            results[test] = worker_results.get(test, {'errors': 1, 'time': 0})
+            results[test]['worker'] = k
+
+    total_errors = 0
+    for test in tests:
+        result = results[test]
+        line = "{:50} {:6} {:7.1f}s  worker {}".format(
+            test, "FAILED" if result['errors'] else "OK", result['time'], result['worker'])
+        if result['errors']:
+            err(line)
+        else:
+            message(line, 32)
+        total_errors += result['errors']
+    print_slowest(results, options.top)
+    with open(os.path.join(opts.tcpdump_dir, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    if options.junit:
+        write_junit(results, options.junit)
+    return total_errors
+
+
 if __name__ == '__main__':
     t = TestFlows()
 
@@ -1130,6 +1373,29 @@ if __name__ == '__main__':
                         help="use runner image with tag TAG instead of 'latest'")
     parser.add_argument("--skip-init", action='store_true', default=False,
                         help="don't start up the containers")
+    parser.add_argument("--agents", type=int, default=2,
+                        help="number of repeaters to start; the tests need at least 2")
+    parser.add_argument("--topology", choices=env.TOPOLOGIES, default='star',
+                        help="how the repeaters are connected to the gateway")
+    parser.add_argument("--parallel", "-j", type=int, default=1,
+                        help="shard the tests over PARALLEL independent environments")
+    parser.add_argument("--tcpdump-dir", type=str,
+                        help="directory for packet captures; defaults to the logs directory")
+    parser.add_argument("--results-file", type=str,
+                        help="write the error count, time and profile of each test as JSON to "
+                             "this file")
+    parser.add_argument("--ring-buffer-files", type=int, default=0,
+                        help="capture in a ring buffer of RING_BUFFER_FILES files, to bound the "
+                             "disk and memory use of long runs; 0 (default) to disable")
+    parser.add_argument("--ring-buffer-filesize", type=int, default=10240,
+                        help="size in kB of each file of the capture ring buffer (default: 10240)")
+    parser.add_argument("--native-decoder", action='store_true', default=False,
+                        help="decode the captures natively instead of with tshark; check that "
+                             "it is equivalent with sniffer.py <pcap> first")
+    parser.add_argument("--junit", type=str,
+                        help="write the results of the tests as JUnit XML to this file")
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of slowest operations to report (default: 10)")
     parser.add_argument("tests", nargs='*',
                         help="tests to run; if not specified, run all tests: " + ", ".join(t.tests))
     options = parser.parse_args()
@@ -1137,14 +1403,35 @@ if __name__ == '__main__':
     unknown_tests = [test for test in options.tests if test not in t.tests]
     if unknown_tests:
         parser.error("Unknown tests: {}".format(', '.join(unknown_tests)))
+    if options.agents < 2:
+        parser.error("--agents must be at least 2, the tests use two repeaters")
 
     opts.verbose = options.verbose
 
-    opts.tcpdump_dir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..', 'logs'))
+    opts.tcpdump_dir = options.tcpdump_dir or \
+        os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..', 'logs'))
     opts.stop_on_failure = options.stop_on_failure
+    opts.ring_buffer_files = options.ring_buffer_files
+    opts.ring_buffer_filesize = options.ring_buffer_filesize
+    opts.native_decoder = options.native_decoder
 
-    t.start_test('init')
-    env.launch_environment_docker(options.unique_id, options.skip_init, options.tag)
+    if options.parallel > 1:
+        if run_tests_parallel(options, options.tests or t.tests):
+            sys.exit(1)
+        sys.exit(0)
 
-    if t.run_tests(options.tests):
+    t.start_test('init')
+    env.launch_environment_docker(options.unique_id, options.skip_init, options.tag,
+                                  options.agents, options.topology)
+
+    try:
+        total_errors = t.run_tests(options.tests, options.top)
+    finally:
+        print_slowest(t.results, options.top)
+        if options.results_file:
+            with open(options.results_file, 'w') as f:
+                json.dump(t.results, f, indent=2)
+        if options.junit:
+            write_junit(t.results, options.junit)
+    if total_errors:
         sys.exit(1)
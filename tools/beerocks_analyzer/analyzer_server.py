@@ -0,0 +1,370 @@
+"""Reception of the data sent by the controllers (beerocks_cli -a) to the analyzer.
+
+The controllers connect to the SocketServerThread, which writes their data to sinks: the log file
+and its index, and optionally e.g. a stats_aggregator.StatsAggregator. BeerocksCliThread and
+SSHThread start beerocks_cli on the controller, locally or over SSH.
+
+This module does not depend on Qt, so it is used both by the analyzer and by its headless mode.
+"""
+
+import json
+import logging
+import os
+import selectors
+import socket
+import subprocess
+import threading
+import time
+from ipaddress import ip_address, IPv4Address
+from pathlib import Path
+from typing import Callable, List, Union
+
+import paramiko
+
+import log_index
+
+logger = logging.getLogger(__name__)
+
+
+def numbered_file(path: str, number: int) -> str:
+    """Get the path of file "number" of a series of files, e.g. beerocks_analyzer_1.log.
+
+    Number 0 is "path" itself, the other numbers are appended to the name, before the first dot.
+    """
+    if number == 0:
+        return path
+    path = Path(path)
+    name, dot, suffixes = path.name.partition('.')
+    return str(path.with_name("{}_{}{}{}".format(name, number, dot, suffixes)))
+
+
+class ControllerConnection:
+
+    def __init__(self, connection: socket.socket, address, slot: int, sinks: list):
+        """A controller sending data to the SocketServerThread.
+
+        Parameters
+        ----------
+        connection: socket.socket
+            The (non-blocking) socket connected to the controller.
+        address
+            The address of the controller.
+        slot: int
+            The index of the log this controller writes to.
+        sinks: list
+            The file-like objects the data is written to (see SocketServerThread).
+        """
+        self.connection = connection
+        self.address = address
+        self.slot = slot
+        self.sinks = sinks
+        self.start_time = time.time()
+        # Data received but not yet written, i.e. the last (incomplete) line.
+        self.buffer = bytearray()
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+    def write_marker(self, marker: str):
+        self.write(('%.3f|%s\n' % (time.time() - self.start_time, marker)).encode())
+
+    def receive(self) -> bool:
+        """Read the data available on the socket and write the complete lines to the log.
+
+        All the lines received at once are written with a single write, with the same timestamp.
+        The sinks are not flushed.
+
+        Returns
+        -------
+        bool
+            False if the controller closed the connection.
+        """
+        data = self.connection.recv(SocketServerThread.RECV_SIZE)
+        if not data:
+            return False
+        self.buffer += data
+        prefix = ('%.3f|' % (time.time() - self.start_time)).encode()
+        output = bytearray()
+        view = memoryview(self.buffer)
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end == -1:
+                break
+            if end > start:
+                output += prefix
+                output += view[start:end + 1]
+            start = end + 1
+        view.release()
+        del self.buffer[:start]
+        if output:
+            self.write(output)
+        return True
+
+
+class SocketServerThread(threading.Thread):
+
+    # Maximum number of bytes read from a socket at once.
+    RECV_SIZE = 65536
+    # Maximum time in seconds between writing a line and flushing it to the log file. The sinks
+    # of all logs are flushed at this interval, also when no data arrived.
+    FLUSH_INTERVAL = 0.2
+
+    def __init__(self, log_file: Union[str, None],
+                 sink_factory: Callable[[int], List] = None):
+        """Thread opening and listening to a socket to get data from the controllers.
+
+        Several controllers can connect at the same time, each of them gets its own log file.
+        The first one writes to "log_file", the next ones to "log_file" with "_<n>" appended
+        to its stem, e.g. beerocks_analyzer_1.log. When a controller disconnects, its log file
+        is reused by the next controller that connects. Each log file is indexed while it is
+        written (see log_index).
+
+        The data is written to sinks, file-like objects with write(bytes), flush() and close().
+        The log file and its indexer are the default sinks. flush() is called every
+        FLUSH_INTERVAL whether data arrived or not, so sinks can do time based work there, e.g.
+        close an aggregation interval of a controller that went quiet.
+
+        Parameters
+        ----------
+        log_file : Union[str, None]
+            Path to the logfile to store data to.
+            If the file doesn't exist, it will be created.
+            If it does, its content will be overwritten.
+            If None, no log file is written.
+        sink_factory: Callable[[int], List]
+            (optional) Called with the number of each new log, it returns the sinks to write
+            the data of that log to, besides the log file.
+        """
+        super().__init__()
+        self.log_file = log_file
+        self.sink_factory = sink_factory
+        self.run_flag = True
+        # The sinks of each log, by slot.
+        self.sinks = {}
+        self.controllers = []
+
+    def log_file_of(self, slot: int) -> str:
+        """Get the path of the log file of the controller in "slot"."""
+        return numbered_file(self.log_file, slot)
+
+    def open_log(self, slot: int):
+        if slot in self.sinks:
+            return
+        sinks = []
+        if self.log_file is not None:
+            # The log comes first, so the index never refers to data that is not in the log.
+            sinks.append(open(self.log_file_of(slot), 'wb'))
+            sinks.append(log_index.LogIndexer(self.log_file_of(slot)))
+        if self.sink_factory is not None:
+            sinks += self.sink_factory(slot)
+        self.sinks[slot] = sinks
+
+    def flush_log(self, slot: int):
+        for sink in self.sinks[slot]:
+            sink.flush()
+
+    def accept(self, sock: socket.socket, selector: selectors.BaseSelector):
+        connection, client_address = sock.accept()
+        connection.setblocking(False)
+        used_slots = {controller.slot for controller in self.controllers}
+        slot = next(i for i in range(len(self.controllers) + 1) if i not in used_slots)
+        self.open_log(slot)
+        controller = ControllerConnection(connection, client_address, slot, self.sinks[slot])
+        logger.info("connection from {} (log {})".format(client_address, slot))
+        controller.write_marker("START")
+        self.flush_log(slot)
+        self.controllers.append(controller)
+        selector.register(connection, selectors.EVENT_READ, controller)
+
+    def disconnect(self, controller: ControllerConnection, selector: selectors.BaseSelector):
+        logger.info("connection from {} closed".format(controller.address))
+        selector.unregister(controller.connection)
+        controller.connection.close()
+        controller.write_marker("STOP")
+        self.flush_log(controller.slot)
+        self.controllers.remove(controller)
+
+    def run(self):
+        # Create a TCP/IP socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Bind the socket to the port
+        server_address = ('', 10000)
+        try:
+            logger.info("starting up on {a[0]} port {a[1]}".format(a=server_address))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(server_address)
+        except Exception as e:  # TODO: too broad exception
+            logger.error("could not start up on {a[0]} port {a[1]}:\n{e}".format(
+                a=server_address, e=e))
+            return
+
+        # Listen for incoming connections
+        sock.listen(5)
+        sock.setblocking(False)
+
+        # open the log file of the first controller
+        self.open_log(0)
+
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        logger.info('waiting for a connection...')
+        last_flush = time.monotonic()
+        try:
+            while self.run_flag:
+                for key, _ in selector.select(self.FLUSH_INTERVAL):
+                    if key.data is None:
+                        self.accept(sock, selector)
+                        continue
+                    controller = key.data
+                    try:
+                        if not controller.receive():
+                            self.disconnect(controller, selector)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    except OSError as e:
+                        logger.error("Error when handling data from {}:\n{}".format(
+                            controller.address, e))
+                        self.disconnect(controller, selector)
+                now = time.monotonic()
+                if now - last_flush >= self.FLUSH_INTERVAL:
+                    for slot in self.sinks:
+                        self.flush_log(slot)
+                    last_flush = now
+        except KeyboardInterrupt:
+            logger.info("Keyboard interrupt, stopping")
+            self.run_flag = False
+        finally:
+            # Clean up the connections
+            for controller in list(self.controllers):
+                self.disconnect(controller, selector)
+            selector.close()
+            sock.close()
+            for sinks in self.sinks.values():
+                for sink in sinks:
+                    sink.close()
+
+    def terminate(self):
+        self.run_flag = False
+
+
+class BeerocksCliThread(threading.Thread):
+
+    def __init__(self, beerocks_cli_path: Union[Path, None], target_ip: IPv4Address,
+                 docker_container_name: str = None):
+        """Thread to start beerocks_cli locally.
+
+        Parameters
+        ----------
+        beerocks_cli_path: Union[Path, None]
+            The path to beerocks_cli's binary.
+            If None, the following path will be tried:
+            <prplMesh_top_level>/../build/install/bin/beerocks_cli
+        target_ip: IPv4Address
+            The IP address to send the data to. Defaults to 127.0.0.1.
+        docker_container_name: str
+            (optional) The name of the docker container on which to run beerocks_cli.
+            If None (default value), docker won't be used and a local controller is assumed.
+            Note that the binary path is assumed to be mapped to the same directory inside
+            the container than the path on the host.
+        """
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.beerocks_cli_path = beerocks_cli_path
+        self.target_ip = target_ip
+        self.docker_container_name = docker_container_name
+        self.process: Union[None, subprocess.Popen] = None
+        self.run_flag = False
+
+    def run(self):
+        if not self.beerocks_cli_path:
+            script_folder = Path(os.path.dirname(os.path.realpath(__file__)))
+            self.beerocks_cli_path = script_folder.parent.parent.parent \
+                / "build" / "install" / "bin" / "beerocks_cli"
+        if not self.beerocks_cli_path.is_file():
+            raise ValueError("Path to beerocks_cli not found: {}".format(self.beerocks_cli_path))
+        if not self.target_ip:
+            if self.docker_container_name:
+                try:
+                    # try to find the gateway IP based on the docker network settings
+                    config = json.loads(subprocess.check_output(
+                        ["docker", "inspect", self.docker_container_name]))[0]
+                    # pick any network:
+                    network_name = next(iter(config["NetworkSettings"]["Networks"]))
+                    network_config = json.loads(subprocess.check_output(
+                        ["docker", "network", "inspect", network_name]))[0]
+                    self.target_ip = network_config["IPAM"]["Config"][0]["Gateway"]
+                except (KeyError, TypeError):
+                    raise("Could not find the target IP, please use the -my_ip option")
+            else:
+                # running locally:
+                self.target_ip = ip_address("127.0.0.1")
+
+        self.run_flag = True
+
+        command = [str(self.beerocks_cli_path), "-a", str(self.target_ip)]
+        if self.docker_container_name:
+            command = ["docker", "exec", self.docker_container_name] + command
+        self.logger.debug("Starting '{}'", ' '.join(command))
+        self.process = subprocess.Popen(command)
+        outs = None
+        errs = None
+        while self.run_flag:
+            try:
+                outs, errs = self.process.communicate(timeout=1)
+            except subprocess.TimeoutExpired:
+                if outs:
+                    self.logger.info(outs)
+                if errs:
+                    self.logger.error(errs)
+
+    def terminate(self):
+        self.logger.debug("{} terminating".format(self.__class__.__name__))
+        self.run_flag = False
+        if self.process:
+            # note that there is a race between the creation of the Popen object
+            # and its assignment to self.process
+            self.process.kill()
+
+
+class SSHThread(threading.Thread):
+
+    def __init__(self, host="192.168.1.1", my_ip="", ssh_port=22, user='root'):
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.my_ip = my_ip
+        self.ssh_port = ssh_port
+        self.user = user
+        self.ssh_client = paramiko.SSHClient()
+
+    def run(self):
+        self.ssh_client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        self.ssh_client.connect(self.host, port=self.ssh_port, username=self.user)
+
+        if not self.my_ip:
+            self.my_ip = self.ssh_client.get_transport().sock.getsockname()[0]
+
+        self.logger.info("Controller will send update to IP {}".format(self.my_ip))
+        # TODO: add a cli option for the path
+        command = 'LD_LIBRARY_PATH=/opt/beerocks/lib /opt/beerocks/bin/beerocks_cli -a {}'.format(
+            self.my_ip)
+
+        # create ssh shell
+        ssh_shell = self.ssh_client.invoke_shell()
+
+        # establish connection
+        in_buff = ''
+        while not in_buff.endswith(':~# '):
+            in_buff += ssh_shell.recv(9999).decode("utf-8")
+
+        # execute command
+        logger.debug("Starting beerock_cli -a")
+        i, o, e = self.ssh_client.exec_command(command)
+        logger.debug("beerock_cli -a exited")
+        return o.channel.recv_exit_status()
+
+    def terminate(self):
+        self.ssh_client.close()
@@ -1,17 +1,12 @@
 #!/usr/bin/env python3
-import json
 from importlib.machinery import SourceFileLoader
 import logging
-import subprocess
 import sys
 import os
 import ctypes
 import threading
-import socket
 import time
-from ipaddress import ip_address, IPv4Address
 from pathlib import Path
-from typing import Union
 
 from PySide2.QtCore import QObject, Signal, QTimer, Qt, SIGNAL
 from PySide2.QtGui import QIcon
@@ -19,10 +14,12 @@ from PySide2.QtWidgets import QApplication, QMainWindow, QSplitter, QAction, QHB
                               QSlider, QLabel, QTextEdit, QWidget
 
 from random import randint
-import paramiko
 import signal
 
 import logger_setup
+import log_index
+import log_parser
+from analyzer_server import SocketServerThread, BeerocksCliThread, SSHThread
 
 VERSION = "3.3"
 
@@ -93,6 +90,10 @@ class BeeRocksAnalyzer(QMainWindow):
 
         self.fdLog = None
         self.fname = "beerocks_analyzer.log"
+        self.log_index = None
+        # Position in the log of which the state must be restored when the read sample thread
+        # starts, 0 if none.
+        self.restore_pos = 0
         self.isMap = False
         self.isGraphs = False
         self.isMapSepWin = False
@@ -213,128 +214,117 @@ class BeeRocksAnalyzer(QMainWindow):
             return True
 
     def readSample(self, line):
-        param_n = []
-        param_v = []
-        param_t = -1
-        is_start = False
-        is_stop = False
-        is_map_update = False
-        res = ""
+        """Parse a line of the log and update the analyzer state with it.
 
-        if line.startswith("#") or len(line) < 4:
-            return [param_t, is_start, is_stop, is_map_update, res]
-
-        i1 = line.find("|")
-        if(i1 == -1):
-            return [param_t, is_start, is_stop, is_map_update, res]
-
-        param_t = float(line[0:i1])
-
-        i2 = line.find(",")
-        if i2 == -1:  # START or STOP or error
-            try:
-                param_m = (str(line[i1+1:])).strip()
-                if param_m == "MARK":
-                    self.wait_for_mark = False
-                    self.cm_widget.increment_node_counters()
-                if param_m == "START" or param_m == "MARK":
-                    is_start = True
-                elif param_m == "STOP":
-                    is_stop = True
-                else:
-                    logger.error("readSample() 1 line --> {}\n", line)
-            except Exception as e:  # TODO: too broad exception
-                logger.error("readSample() 1 line --> {}\n{}", line, str(e))
-
-            return [param_t, is_start, is_stop, is_map_update, res]
-        else:
+        Returns
+        -------
+        Union[log_parser.LogRecord, None]
+            The record to pass on to the widgets. The analyzer ids are added to its fields.
+        """
+        record = log_parser.parse_line(line)
+        if record is None:
+            return None
+
+        if record.kind == log_parser.MARK:
+            self.wait_for_mark = False
+            self.cm_widget.increment_node_counters()
+        if record.kind in (log_parser.START, log_parser.STOP, log_parser.MARK) or \
+                self.wait_for_mark:
+            return record
+
+        fields = record.fields
+        if record.kind == log_parser.NODE:  # nw_map_update
             try:
-                param_m = str(line[i1+1:i2])
-                # read line's key,value: param_n<-key, param_v<-value
-                line_args = line[i2+1:].split(',')
-                param_n = []
-                for arg in line_args:
-                    arg_val = arg.split(':')
-                    key = arg_val[0].lower().strip()
-                    param_n.append(key)
-                    if ("mac" in key) or ("bssid" in key) or ("backhaul" in key):
-                        param_v.append(arg.replace(":", "=", 1).split("=")[1].strip())
-                    else:
-                        param_v.append(arg_val[1].strip())
-            except Exception as e:
-                logger.error("readSample() 1 line --> {}".format(line))
+                state = fields['state'].split()[0]
+                mac = fields['mac']
+                line_type = fields['type']
+            except (KeyError, IndexError) as e:
+                logger.error("readSample()  --> {}, "
+                             "nw_map_update line does not contain state "
+                             "or mac or type or parent bssid".format(line))
                 logger.exception(e)
-                return [param_t, is_start, is_stop, is_map_update, res]
+                return record
+
+            if "2" in line_type:  # IRE
+                # for IRE, the backhaul mac is the "client" mac
+                mac = fields.get('backhaul')
+                if mac is None:
+                    logger.error("readSample()  --> {}, "
+                                 "nw_map_update IRE line does not contain "
+                                 "a backhaul mac address".format(line))
+                    return record
+            if ("2" in line_type) or ("3" in line_type):  # IRE or client
+                if state == "Connected":
+                    if mac not in self.sta_mac2num:  # new sta mac addr
+                        self.sta_mac2num[mac] = len(self.sta_mac2num)
+                    fields['sta_id'] = self.sta_mac2num[mac]
 
-        if param_v is None:
-            return [param_t, is_start, is_stop, is_map_update, res]
-        if not self.wait_for_mark:
-            param_m_val = param_m.split(':')
-            param_m_n = param_m_val[0].strip()
+        elif record.kind == log_parser.STATS:
+            mac = fields.get('mac')
+            if mac is None:
+                logger.error(
+                    "readSample() --> {}, 'stats_update' line not contain mac address.".
+                    format(line))
+                return record
 
-            if param_m_n != "type" and param_m_n != "Type":
-                is_map_update = True
+            if record.value == 3:  # Client stats update
+                if mac not in self.sta_mac2num:  # new sta mac addr
+                    self.sta_mac2num[mac] = len(self.sta_mac2num)
+                fields['sta_id'] = self.sta_mac2num[mac]
 
-            if param_m_n == "Name":  # nw_map_update
-                try:
-                    i_state = param_n.index('state')
-                    i_mac = param_n.index('mac')
-                    i_type = param_n.index('type')
+        # End of readSample()
+        return record
 
-                except Exception as e:  # TODO: too broad exception
-                    logger.error("readSample()  --> {}, "
-                                 "nw_map_update line does not contain state "
-                                 "or mac or type or parent bssid".format(line))
-                    logger.exception(e)
-                    return [param_t, is_start, is_stop, is_map_update, res]
-
-                state = (param_v[i_state].split())[0]
-                mac = param_v[i_mac]
-                line_type = param_v[i_type]
-
-                if "2" in line_type:  # IRE
-                    try:
-                        i_backhaul = param_n.index('backhaul')
-                        mac = param_v[i_backhaul]  # for IRE, the backhaul mac is the "client" mac
-                    except Exception as e:  # TODO: too broad exception
-                        logger.error("readSample()  --> {}, "
-                                     "nw_map_update IRE line does not contain "
-                                     "a backhaul mac address\n{}".format(line, str(e)))
-                        return [param_t, is_start, is_stop, is_map_update, res]
-                if ("2" in line_type) or ("3" in line_type):  # IRE or client
-                    if state == "Connected":
-                        if mac not in self.sta_mac2num:  # new sta mac addr
-                            self.sta_mac2num[mac] = len(self.sta_mac2num)
-                        res += "sta_id: {:d},".format(self.sta_mac2num[mac])
-
-                        if res.endswith(','):
-                            res = res[:-1]
-
-            elif param_m_n == "type" or param_m_n == "Type":
-                param_m_v = int(param_m_val[1].strip())
-                try:
-                    i1 = param_n.index('mac')
-                except Exception as e:  # TODO: too broad exception
-                    logger.error(
-                        "readSample() --> {}, 'stats_update' line not contain mac address.\n{}".
-                        format(line, e))
-                    return [param_t, is_start, is_stop, is_map_update, res]
+    def updateLogIndex(self):
+        if self.log_index is None:
+            self.log_index = log_index.LogIndex(self.fname)
+        # The SocketServerThread indexes the log it writes, external logs are indexed here.
+        self.log_index.update(build=self.isExtLogFile)
 
-                mac = param_v[i1]
-                i1 += 1
+    def restoreFromIndex(self, log_pos):
+        """Restore the state of the widgets at position "log_pos" of the log.
 
-                if param_m_v == 3:  # Client stats update
-                    if mac not in self.sta_mac2num:  # new sta mac addr
-                        self.sta_mac2num[mac] = len(self.sta_mac2num)
-                    res += "sta_id: %d" % self.sta_mac2num[mac]
+        The last snapshot of the index before "log_pos" is restored, then the log between the
+        snapshot and "log_pos" is replayed without waiting.
+        """
+        self.updateLogIndex()
+        snapshot = self.log_index.snapshot_before(log_pos)
+        lines = []
+        snapshot_pos = 0
+        if snapshot is not None:
+            self.sta_mac2num = {mac: i for i, mac in enumerate(snapshot["stations"])}
+            lines = snapshot["lines"]
+            snapshot_pos = snapshot["offset"]
+        logger.info("Restoring the state at {:d} from the snapshot at {:d}".format(
+            log_pos, snapshot_pos))
+        with open(self.fname, "rb") as fd:
+            fd.seek(snapshot_pos)
+            lines += fd.read(log_pos - snapshot_pos).decode(errors='replace').splitlines()
 
-        # End of readSample()
-        return [param_t, is_start, is_stop, is_map_update, res]
+        if self.isMap:
+            self.cm_widget.hold_redraw = True
+        for line in lines:
+            record = self.readSample(line)
+            if record is None or record.kind in (log_parser.START, log_parser.STOP):
+                continue
+            if record.kind == log_parser.EVENT:
+                self.log_widget.readSampleAndUpdateLogger(record)
+                continue
+            if self.isMap:
+                self.cm_widget.readSample(record)
+            if self.isGraphs:
+                self.wa_widget.readSample(record)
+        if self.isMap:
+            self.cm_widget.hold_redraw = False
+            self.cm_widget.sendSig()
 
     def readSampleThread(self, update_start_time=False):
         if self.isGraphs:
             self.wa_widget.update_start_time = True
         self.threadExit = False
+        if self.restore_pos > 0:
+            self.restoreFromIndex(self.restore_pos)
+            self.restore_pos = 0
         while not self.threadExit:
             if self.fdLog is not None:
                 update_widgets = True
@@ -342,16 +332,17 @@ class BeeRocksAnalyzer(QMainWindow):
                 if not line:
                     time.sleep(1)
                     continue
-                [param_t1, is_start, is_stop, is_map_update, sta_ap_ids] = self.readSample(line)
-                if len(sta_ap_ids) > 0:
-                    line += ", " + sta_ap_ids
-                if is_stop:
+                # The line is parsed only once, all widgets use the same record.
+                record = self.readSample(line)
+                if record is None:
+                    time.sleep(0.1)
+                    continue
+                if record.kind == log_parser.STOP:
                     logger.info("Read stop flag, stopping")
                     self.threadExit = True
 
-                if param_t1 == -1:
-                    time.sleep(0.1)
-                elif param_t1 == 0.000:
+                param_t1 = record.time
+                if param_t1 == 0.000:
                     logger.debug("readSampleThread() --> param_t1=0.000, updating self.start_time")
                     self.start_time = time.time()
                 else:
@@ -361,6 +352,7 @@ class BeeRocksAnalyzer(QMainWindow):
                         update_start_time = False
                     self.runTime = round(time.time() - self.start_time, 3)
                     delta_t = self.fileTime - self.runTime
+                    is_map_update = record.kind != log_parser.STATS
                     if delta_t > 0.1:
                         # if delta_t > 5:
                         logger.debug(
@@ -373,16 +365,14 @@ class BeeRocksAnalyzer(QMainWindow):
                     self.restartRuntime = False
                     self.timeUpdateSig.sig.emit(param_t1)
                     if update_widgets and not self.wait_for_mark:
-                        if "BML_EVENT" in line:
-                            self.log_widget.readSampleAndUpdateLogger(
-                                line, param_t1, is_start, is_stop)
+                        if record.kind == log_parser.EVENT:
+                            self.log_widget.readSampleAndUpdateLogger(record)
                         else:
                             if self.isMap:
                                 logger.debug("self.isMap, calling readSample")
-                                self.cm_widget.readSample(line, param_t1, is_start, is_stop)
+                                self.cm_widget.readSample(record)
                             if self.isGraphs:
-                                self.wa_widget.readSampleAndUpdateGraphs(
-                                    line, param_t1, is_start, is_stop)
+                                self.wa_widget.readSampleAndUpdateGraphs(record)
 
     def createAnalyzerWidget(self, widget_index=0):
         self.wa_widget_mod = __import__("beerocks_analyzer_widget")
@@ -494,6 +484,7 @@ class BeeRocksAnalyzer(QMainWindow):
                 self.resetConnMapWidget()
             self.ap_mac2num = {}
             self.sta_mac2num = {}
+            self.restore_pos = self.log_start_pos
             self.restart = True
             self.timer.start(100)
 
@@ -596,24 +587,11 @@ class BeeRocksAnalyzer(QMainWindow):
         self.showMaximized()
 
     def getFileMarkers(self):
-        logger.info("Scanning log markers/time line...")
-        fd = open(self.fname, "rt")
-        line = " "
-        self.file_marks = []
-        p = 0
-        t = "0.000"
-        self.file_marks.append((p, t))
-        while True:
-            p = fd.tell()
-            line = fd.readline()
-            if line == "":
-                break
-            i = line.find("|")
-            t = line[0:i]
-            if line.find("|MARK") != -1:
-                self.file_marks.append((p, t))
-
-        fd.close()
+        logger.info("Reading log markers/time line...")
+        self.updateLogIndex()
+        # Use the time entries for logs without markers
+        marks = self.log_index.marks or self.log_index.times
+        self.file_marks = [(0, "0.000")] + [(p, "%.3f" % t) for t, p in marks]
         logger.info("Done.")
 
     def timeSliderChanged(self, value):
@@ -654,218 +632,6 @@ def show():
     app.exec_()
 
 
-class SocketServerThread(threading.Thread):
-
-    def __init__(self, log_file: str):
-        """Thread opening and listening to a socket to get data from the controller.
-
-        Parameters
-        ----------
-        log_file : str
-            Path to the logfile to store data to.
-            If the file doesn't exist, it will be created.
-            If it does, its content will be overwritten.
-        """
-        super().__init__()
-        self.log_file = log_file
-        self.run_flag = True
-
-    def run(self):
-        global g_marker_update
-        # Create a TCP/IP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Bind the socket to the port
-        server_address = ('', 10000)
-        try:
-            logger.info("starting up on {a[0]} port {a[1]}".format(a=server_address))
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(server_address)
-        except Exception as e:  # TODO: too broad exception
-            logger.error("could not start up on {a[0]} port {a[1]}:\n{e}".format(
-                a=server_address, e=e))
-            return
-
-        # Listen for incoming connections
-        sock.listen(1)
-
-        # open log file
-        file = open(self.log_file, 'w')
-
-        while self.run_flag:
-            # Wait for a connection
-            logger.info('waiting for a connection...')
-            connection, client_address = sock.accept()
-            connection.settimeout(5)
-            startTime = time.time()
-
-            logger.info("connection from {}".format(client_address))
-            file.write('%.3f|START\n' % (time.time() - startTime))
-            file.flush()
-            # Receive the data in chunks
-            data = ""
-            while self.run_flag:
-                if g_marker_update:
-                    g_marker_update = False
-                try:
-                    logger.debug("Trying to get data from the socket")
-                    data += connection.recv(256).decode("utf-8")
-                except socket.timeout:
-                    logger.debug("Socket timed out")
-                    continue
-                except KeyboardInterrupt:
-                    logger.info("Keyboard interrupt, stopping")
-                    self.run_flag = False
-                    break
-                except Exception as e:
-                    logger.error("Error when handling data from the socket_server:\n"
-                                 "{}\n"
-                                 "Stopping".format(str(e)))
-                    self.run_flag = False
-                    break
-                while self.run_flag:
-                    try:
-                        i = data.index('\n')
-                    except Exception:
-                        logger.debug("data.index failed: {}".format(data))
-                        break
-                    send_data = data.split('\n')[0]
-                    data = data[i+1:]
-                    if send_data:
-                        file.write(('%.3f|' % (time.time() - startTime)) + send_data + '\n')
-                        file.flush()
-
-            # Clean up the connection
-            connection.close()
-            file.write('%.3f|STOP\n' % (time.time() - startTime))
-            file.flush()
-
-        file.close()
-
-    def terminate(self):
-        self.run_flag = False
-
-
-class BeerocksCliThread(threading.Thread):
-
-    def __init__(self, beerocks_cli_path: Union[Path, None], target_ip: IPv4Address,
-                 docker_container_name: str = None):
-        """Thread to start beerocks_cli locally.
-
-        Parameters
-        ----------
-        beerocks_cli_path: Union[Path, None]
-            The path to beerocks_cli's binary.
-            If None, the following path will be tried:
-            <prplMesh_top_level>/../build/install/bin/beerocks_cli
-        target_ip: IPv4Address
-            The IP address to send the data to. Defaults to 127.0.0.1.
-        docker_container_name: str
-            (optional) The name of the docker container on which to run beerocks_cli.
-            If None (default value), docker won't be used and a local controller is assumed.
-            Note that the binary path is assumed to be mapped to the same directory inside
-            the container than the path on the host.
-        """
-        super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.beerocks_cli_path = beerocks_cli_path
-        self.target_ip = target_ip
-        self.docker_container_name = docker_container_name
-        self.process: Union[None, subprocess.Popen] = None
-        self.run_flag = False
-
-    def run(self):
-        if not self.beerocks_cli_path:
-            script_folder = Path(os.path.dirname(os.path.realpath(__file__)))
-            self.beerocks_cli_path = script_folder.parent.parent.parent \
-                / "build" / "install" / "bin" / "beerocks_cli"
-        if not self.beerocks_cli_path.is_file():
-            raise ValueError("Path to beerocks_cli not found: {}".format(self.beerocks_cli_path))
-        if not self.target_ip:
-            if self.docker_container_name:
-                try:
-                    # try to find the gateway IP based on the docker network settings
-                    config = json.loads(subprocess.check_output(
-                        ["docker", "inspect", self.docker_container_name]))[0]
-                    # pick any network:
-                    network_name = next(iter(config["NetworkSettings"]["Networks"]))
-                    network_config = json.loads(subprocess.check_output(
-                        ["docker", "network", "inspect", network_name]))[0]
-                    self.target_ip = network_config["IPAM"]["Config"][0]["Gateway"]
-                except (KeyError, TypeError):
-                    raise("Could not find the target IP, please use the -my_ip option")
-            else:
-                # running locally:
-                self.target_ip = ip_address("127.0.0.1")
-
-        self.run_flag = True
-
-        command = [str(self.beerocks_cli_path), "-a", str(self.target_ip)]
-        if self.docker_container_name:
-            command = ["docker", "exec", self.docker_container_name] + command
-        self.logger.debug("Starting '{}'", ' '.join(command))
-        self.process = subprocess.Popen(command)
-        outs = None
-        errs = None
-        while self.run_flag:
-            try:
-                outs, errs = self.process.communicate(timeout=1)
-            except subprocess.TimeoutExpired:
-                if outs:
-                    self.logger.info(outs)
-                if errs:
-                    self.logger.error(errs)
-
-    def terminate(self):
-        self.logger.debug("{} terminating".format(self.__class__.__name__))
-        self.run_flag = False
-        if self.process:
-            # note that there is a race between the creation of the Popen object
-            # and its assignment to self.process
-            self.process.kill()
-
-
-class SSHThread(threading.Thread):
-
-    def __init__(self, host="192.168.1.1", my_ip="", ssh_port=22, user='root'):
-        super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.host = host
-        self.my_ip = my_ip
-        self.ssh_port = ssh_port
-        self.user = user
-        self.ssh_client = paramiko.SSHClient()
-
-    def run(self):
-        self.ssh_client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        self.ssh_client.connect(self.host, port=self.ssh_port, username=self.user)
-
-        if not self.my_ip:
-            self.my_ip = self.ssh_client.get_transport().sock.getsockname()[0]
-
-        self.logger.info("Controller will send update to IP {}".format(self.my_ip))
-        # TODO: add a cli option for the path
-        command = 'LD_LIBRARY_PATH=/opt/beerocks/lib /opt/beerocks/bin/beerocks_cli -a {}'.format(
-            self.my_ip)
-
-        # create ssh shell
-        ssh_shell = self.ssh_client.invoke_shell()
-
-        # establish connection
-        in_buff = ''
-        while not in_buff.endswith(':~# '):
-            in_buff += ssh_shell.recv(9999).decode("utf-8")
-
-        # execute command
-        logger.debug("Starting beerock_cli -a")
-        i, o, e = self.ssh_client.exec_command(command)
-        logger.debug("beerock_cli -a exited")
-        return o.channel.recv_exit_status()
-
-    def terminate(self):
-        self.ssh_client.close()
-
-
 def main(argv):
     global t_list, g_ext_log_file
     signal.signal(signal.SIGINT, signal_handler)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Headless analyzer: collects the stats of the controllers without a display.
+
+Like the analyzer, it starts beerocks_cli on the controller to make it send its updates to the
+socket server. Instead of showing them, the stats are aggregated per interval (see
+stats_aggregator) and written to a compact file. It does not depend on Qt.
+"""
+
+import logging
+import signal
+import sys
+import time
+from pathlib import Path
+
+import logger_setup
+from analyzer_server import SocketServerThread, BeerocksCliThread, SSHThread, numbered_file
+from stats_aggregator import StatsAggregator
+
+OUT_FILE = "beerocks_stats.csv.gz"
+
+t_list = []
+
+logger_setup.setup_logger()
+logger = logging.getLogger(__name__)
+
+
+def printUsage():
+    logger.info("usage: beerocks_analyzer_headless [options]")
+    logger.info("    -out=<file>              - file to write the aggregated stats to,")
+    logger.info("                               {} by default".format(OUT_FILE))
+    logger.info("    -interval=<seconds>      - aggregation interval, 60 by default")
+    logger.info("    -f=<log file>            - also write the complete log to this file")
+    logger.info("    -gw_ip=<IP of GW>        - GW ip to get updates from.")
+    logger.info("                               If empty, the GW is assumed to be running locally")
+    logger.info("    -bin_path=<path>         - Path to the beerocks_cli binary.")
+    logger.info("                               If empty, use build from <top_level>/../")
+    logger.info("    -my_ip=[IP of PC]        - PC ip to send updates,")
+    logger.info("                               if not set will automaticly set")
+    logger.info("    -ssh_port=[port of GW]   - SSH port used to connect to GW")
+    logger.info("    -docker_container=[name] - Name of the docker container to run beerocks_cli")
+    logger.info("When several controllers connect, the files of the next ones are numbered,")
+    logger.info("e.g. beerocks_stats_1.csv.gz")
+
+
+def terminate_threads():
+    for t in t_list:
+        try:
+            t.terminate()
+        except Exception as e:
+            logger.warning("Exception when trying to terminate thread: " + str(e))
+
+
+def signal_handler(signal, frame):
+    logger.info("Signal {} received, terminating".format(signal))
+    terminate_threads()
+
+
+def main(argv):
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    out_file = OUT_FILE
+    interval = 60.0
+    log_file = None
+    gw_ip = ""
+    my_ip = None
+    ssh_port = 22
+    bin_path = None
+    docker_container = None
+    for arg in argv[1:]:
+        arg = arg.strip()
+        if arg.startswith("-out="):
+            out_file = arg.split("=")[1]
+        elif arg.startswith("-interval="):
+            interval = float(arg.split("=")[1])
+        elif arg.startswith("-f="):
+            log_file = arg.split("=")[1]
+        elif arg.startswith("-gw_ip="):
+            gw_ip = arg.split("=")[1]
+        elif arg.startswith("-bin_path="):
+            bin_path = Path(arg.split("=")[1])
+        elif arg.startswith("-my_ip="):
+            my_ip = arg.split("=")[1]
+        elif arg.startswith("-ssh_port="):
+            ssh_port = int(arg.split("=")[1])
+        elif arg.startswith("-docker_container="):
+            docker_container = arg.split("=")[1]
+        else:
+            printUsage()
+            return
+
+    def sink_factory(slot):
+        return [StatsAggregator(numbered_file(out_file, slot), interval)]
+
+    # start server_socket
+    server = SocketServerThread(log_file, sink_factory)
+    server.start()
+    t_list.append(server)
+    # beerocks_cli updates (either via ssh or locally)
+    time.sleep(3)
+    if not gw_ip:
+        # running locally
+        t = BeerocksCliThread(bin_path, my_ip, docker_container)
+    else:
+        t = SSHThread(gw_ip, my_ip, ssh_port)
+    t.daemon = True
+    t.start()
+    t_list.append(t)
+
+    logger.info("Writing the stats aggregated every {:g}s to {}".format(interval, out_file))
+    # The server writes the last aggregates when it stops.
+    while server.is_alive():
+        server.join(1)
+    terminate_threads()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -23,6 +23,9 @@ except ImportError:
 
 from matplotlib.ticker import ScalarFormatter
 
+import log_parser
+from time_series import TimeSeries
+
 matplotlib.use('Qt5Agg')
 
 BAR_CODES = (matplotlib.path.Path.MOVETO,
@@ -70,6 +73,9 @@ class UpdateSig(QObject):
 
 
 class BeeRocksAnalyzerWidget(QWidget):
+    # Maximum number of samples per second of each metric, to size its time series
+    MAX_SAMPLES_PER_SEC = 4
+
     def __init__(self, argv, parent=None):
         super(BeeRocksAnalyzerWidget, self).__init__(parent)
         self.logger = logging.getLogger(__name__)
@@ -100,6 +106,7 @@ class BeeRocksAnalyzerWidget(QWidget):
         self.general_label_color_idx = 0
 
         # Log Data containers
+        self.series = {}  # key = metric name : val = TimeSeries
         self.ap_mac2num = {}
         self.ap_mac2sta_mac = {}
         self.sta_mac2num = {}
@@ -110,6 +117,8 @@ class BeeRocksAnalyzerWidget(QWidget):
 
         ###########################
         self.getCommandLineArgs(argv)
+        # Keep the samples of the realtime window, and a margin for the gap markers
+        self.series_capacity = int(self.realtimeWindow * self.MAX_SAMPLES_PER_SEC) + 16
 
         self.figs_tab_widget = QTabWidget(self)
         vbox = QVBoxLayout()
@@ -215,26 +224,25 @@ class BeeRocksAnalyzerWidget(QWidget):
 
     def printLabels(self):
         self.logger.info("printLabels:")
-        for a_name in dir(self):
-            if a_name.endswith("_v"):
-                self.logger.info(" {}".format(a_name))
+        for name in self.series:
+            self.logger.info(" {}".format(name))
 
     def printVals(self):
         self.logger.info("printVals:\n")
-        for a_name in dir(self):
-            if a_name.endswith("_v") or a_name.endswith("_t"):
-                self.logger.info(" {} : {}\n".format(
-                    a_name, str(getattr(BeeRocksAnalyzerWidget, a_name))))
+        for name, series in self.series.items():
+            self.logger.info(" {}_v : {}\n".format(name, str(series.values())))
+            self.logger.info(" {}_t : {}\n".format(name, str(series.times())))
 
-    def readSampleAndUpdateGraphs(self, line, param_t1, is_start, is_stop):
-        if is_start:
+    def readSampleAndUpdateGraphs(self, record):
+        if record.kind in (log_parser.START, log_parser.MARK):
             self.wait_for_start = False
             return
-        elif is_stop:
+        elif record.kind == log_parser.STOP:
             self.restartSig.sig.emit(1)
             return
 
-        self.readSample(line, param_t1)
+        param_t1 = record.time
+        self.readSample(record)
         # update start time
         if self.update_start_time:
             self.realtimeWindow_start = param_t1
@@ -248,71 +256,33 @@ class BeeRocksAnalyzerWidget(QWidget):
                 self.threadEvent.clear()
                 self.update_start_time = True
 
-    def readSample(self, line, param_t):
-        param_n = []
-        param_v = []
-        if line.startswith("#") or len(line) < 4:
-            return None
-        i1 = line.find("|")
-        if(i1 == -1):
-            return
-
-        i2 = line.find(",")
-        try:
-            param_m = str(line[i1+1:i2])
-            line_args = line[i2+1:].split(',')
-            param_n = []
-            for arg in line_args:
-                arg_val = arg.split(':')
-                key = arg_val[0].lower().strip()
-                param_n.append(key)
-                if ("mac" in key) or ("bssid" in key) or ("backhaul" in key):
-                    param_v.append(arg.replace(":", "=", 1).split("=")[1].strip())
-                else:
-                    param_v.append(arg_val[1].strip())
-
-        except Exception as e:  # TODO: too broad exception
-            self.logger.error("Error, readSample() 1 line --> {}".format(line))
-            self.logger.exception(e)
-            return
-
-        if param_v is None:
-            return
+    def readSample(self, record):
+        param_t = record.time
+        fields = record.fields
 
-        param_m_val = param_m.split(':')
-        param_m_n = param_m_val[0].strip()
-
-        if param_m_n == "Name":  # nw_map_update
+        if record.kind == log_parser.NODE:  # nw_map_update
             self.logger.debug("Updating network map")
             try:
-                i_state = param_n.index('state')
-                i_mac = param_n.index('mac')
-                i_type = param_n.index('type')
-                if not ("1" in param_v[i_type]):
-                    i_ap_mac = param_n.index('parent bssid')
+                state = fields['state'].split()[0]
+                mac = fields['mac']
+                line_type = fields['type']
+                if not ("1" in line_type):
+                    ap_mac = fields['parent bssid']
 
-            except Exception as e:  # TODO: too broad exception
+            except (KeyError, IndexError) as e:
                 self.logger.error("readSample()  --> {}, "
                                   "nw_map_update line does not contain state or mac"
-                                  " or type or parent bssid".format(line))
+                                  " or type or parent bssid".format(record.line))
                 self.logger.exception(e)
                 return
 
-            state = (param_v[i_state].split())[0]
-            mac = param_v[i_mac]
-            line_type = param_v[i_type]
-            if not ("1" in line_type):
-                ap_mac = param_v[i_ap_mac]
-
             if "2" in line_type:  # IRE
-                try:
-                    i_backhaul = param_n.index('backhaul')
-                    mac = param_v[i_backhaul]  # for IRE, the backhaul mac is the "client" mac
-                except Exception as e:  # TODO: too broad exception
-                    self.logger.error("readSample()  --> %s, nw_map_update IRE line"
-                                      " does not contain a backhaul mac address".format(line))
-                    self.logger.exception(e)
+                if 'backhaul' not in fields:
+                    self.logger.error("readSample()  --> {}, nw_map_update IRE line"
+                                      " does not contain a backhaul mac address".format(
+                                          record.line))
                     return
+                mac = fields['backhaul']  # for IRE, the backhaul mac is the "client" mac
             if ("2" in line_type) or ("3" in line_type):  # IRE or client
                 if state == "Disconnected":
                     for mac_t in self.ap_mac2sta_mac:  # remove sta from the previous mac addr
@@ -321,29 +291,21 @@ class BeeRocksAnalyzerWidget(QWidget):
 
                 elif state == "Connected":
                     if mac not in self.sta_mac2num:  # new sta mac addr
-                        sta_id = -1
-                        try:
-                            i_sta_id = param_n.index('sta_id')
-                            sta_id = int(param_v[i_sta_id])
-                        except Exception as e:  # TODO: too broad exception
+                        if 'sta_id' not in fields:
                             self.logger.error("readSample()  --> {}, nw_map_update - "
-                                              "new STA line does not contain sta_id".format(line))
-                            self.logger.exception(e)
+                                              "new STA line does not contain sta_id".format(
+                                                  record.line))
                             return
-                        self.sta_mac2num[mac] = sta_id
+                        self.sta_mac2num[mac] = int(fields['sta_id'])
                         self.defineLineColor('sta', self.sta_mac2num[mac])
 
                     if ap_mac not in self.ap_mac2num:  # new ap mac addr
-                        # ap_id = len(self.ap_mac2num)
-                        ap_id = -1
-                        try:
-                            i_ap_id = param_n.index('ap_id')
-                            ap_id = int(param_v[i_ap_id])
-                        except Exception as e:  # TODO: too broad exception
-                            self.logger.error("readSample()  --> %s, nw_map_update - "
-                                              "new AP line does not contain ap_id\n{}".
-                                              format(line, e))
+                        if 'ap_id' not in fields:
+                            self.logger.error("readSample()  --> {}, nw_map_update - "
+                                              "new AP line does not contain ap_id".format(
+                                                  record.line))
                             return
+                        ap_id = int(fields['ap_id'])
                         self.ap_mac2num[ap_mac] = ap_id
                         self.defineLineColor('ap', ap_id)
                         self.ap_mac2sta_mac[ap_mac] = []
@@ -354,51 +316,42 @@ class BeeRocksAnalyzerWidget(QWidget):
                     if not(mac in self.ap_mac2sta_mac[ap_mac]):
                         self.ap_mac2sta_mac[ap_mac].append(mac)
 
-        elif param_m_n == "type" or param_m_n == "Type":
-            param_m_v = int(param_m_val[1].strip())
-            try:
-                i1 = param_n.index('mac')
-            except Exception as e:  # TODO: too broad exception
+        elif record.kind == log_parser.STATS:
+            if 'mac' not in fields:
                 self.logger.error(
-                    "readSample() --> {}, 'stats_update' line not contain mac address".format(line))
-                self.logger.exception(e)
+                    "readSample() --> {}, 'stats_update' line not contain mac address".format(
+                        record.line))
                 return
 
-            mac = param_v[i1]
-            i1 += 1
-            if param_m_v == 1:  # AP stats update
+            mac = fields['mac']
+            # The measurements are all the fields, except the MAC and the analyzer ids.
+            values = [(name, value) for name, value in fields.items()
+                      if name not in ('mac', 'ap_id', 'sta_id')]
+            if record.value == 1:  # AP stats update
                 if mac not in self.ap_mac2num:  # new ap mac addr
-                    ap_id = -1
-                    try:
-                        i_ap_id = param_n.index('ap_id')
-                        ap_id = int(param_v[i_ap_id])
-                    except Exception as e:  # TODO: too broad exception
-                        self.logger.error("readSample()  --> %s, nw_map_update"
-                                          " - new AP line does not contain ap_id".format(line))
-                        self.logger.exception(e)
+                    if 'ap_id' not in fields:
+                        self.logger.error("readSample()  --> {}, nw_map_update"
+                                          " - new AP line does not contain ap_id".format(
+                                              record.line))
                         return
+                    ap_id = int(fields['ap_id'])
                     self.ap_mac2num[mac] = ap_id
                     self.defineLineColor('ap', ap_id)
                     self.ap_mac2sta_mac[mac] = []
                 ap_id = self.ap_mac2num[mac]
 
-                for j in range(i1, len(param_n)):  # fill atrribute
-                    name = 'ap%d_' % self.ap_mac2num[mac] + param_n[j]
-                    val = int(param_v[j])
-                    self.addAttr(param_t, name, val, 'ap', ap_id)
+                for name, value in values:  # fill atrribute
+                    name = 'ap%d_' % ap_id + name
+                    self.addAttr(param_t, name, int(value), 'ap', ap_id)
 
-            elif param_m_v == 3:  # Client stats update
+            elif record.value == 3:  # Client stats update
                 if mac not in self.sta_mac2num:  # new sta mac addr
-                    sta_id = -1
-                    try:
-                        i_sta_id = param_n.index('sta_id')
-                        sta_id = int(param_v[i_sta_id])
-                    except Exception as e:  # TODO: too broad exception
-                        self.logger.error("readSample()  --> %s, nw_map_update"
-                                          " - new STA line does not contain sta_id".format(line))
-                        self.logger.exception(e)
+                    if 'sta_id' not in fields:
+                        self.logger.error("readSample()  --> {}, nw_map_update"
+                                          " - new STA line does not contain sta_id".format(
+                                              record.line))
                         return
-                    self.sta_mac2num[mac] = sta_id
+                    self.sta_mac2num[mac] = int(fields['sta_id'])
                     self.defineLineColor('sta', self.sta_mac2num[mac])
                 sta_num = self.sta_mac2num[mac]
 
@@ -412,34 +365,26 @@ class BeeRocksAnalyzerWidget(QWidget):
                 if ap_num is None:
                     self.logger.error("Error, readSample() --> {}, 'client_stats_update'"
                                       " did not find sta_mac={} in self.ap_mac2sta_mac".
-                                      format(line, mac))
+                                      format(record.line, mac))
                     return
 
-                for j in range(i1, len(param_n)):
-                    name_pattern = 'ap%d_sta%d_' + param_n[j]
-                    name = name_pattern % (ap_num, sta_num)
-                    val = int(param_v[j])
+                name_prefix = 'ap%d_sta%d_' % (ap_num, sta_num)
+                for name, value in values:
                     # fill right atrribute with val
-                    self.addAttr(param_t, name, val, 'sta', sta_num)
+                    self.addAttr(param_t, name_prefix + name, int(value), 'sta', sta_num)
         # End of readSample()
 
     def getAttrVal(self, name):
-        return [getattr(BeeRocksAnalyzerWidget, name + "_v"),
-                getattr(BeeRocksAnalyzerWidget, name + "_t")]
+        series = self.series[name]
+        return [series.values(), series.times()]
 
     def getValByName(self, name):
-        try:
-            ar_v = getattr(BeeRocksAnalyzerWidget, name + "_v")
-        except Exception:
-            ar_v = []
-        return ar_v
+        series = self.series.get(name)
+        return series.values() if series is not None else []
 
     def getTimeByName(self, name):
-        try:
-            ar_t = getattr(BeeRocksAnalyzerWidget, name + "_t")
-        except Exception:
-            ar_t = []
-        return ar_t
+        series = self.series.get(name)
+        return series.times() if series is not None else []
 
     def getTimeDiffSec(self, startTime):
         dt = datetime.now() - startTime
@@ -447,27 +392,16 @@ class BeeRocksAnalyzerWidget(QWidget):
         return dt_sec
 
     def addAttr(self, param_t, param_n, param_v, entity, entity_num):
-        is_new_attr = False
-        try:
-            ar_v = getattr(BeeRocksAnalyzerWidget, param_n + "_v")
-            ar_t = getattr(BeeRocksAnalyzerWidget, param_n + "_t")
-        except Exception:
-            ar_v = []
-            ar_t = []
-            setattr(BeeRocksAnalyzerWidget, param_n + "_v", ar_v)
-            setattr(BeeRocksAnalyzerWidget, param_n + "_t", ar_t)
-            is_new_attr = True
-
-        if ar_t != []:
-            if (param_t - ar_t[-1]) > 3:
-                ar_v.append(None)
-                ar_t.append(param_t-0.1)
+        series = self.series.get(param_n)
+        is_new_attr = series is None
+        if is_new_attr:
+            series = self.series[param_n] = TimeSeries(self.series_capacity)
 
-        ar_v.append(param_v)
-        ar_t.append(param_t)
+        series.append(param_t, param_v)
 
         if is_new_attr:
-            self.addRemoveNewFigSubplots(ar_t, ar_v, param_n, True, entity, entity_num)
+            self.addRemoveNewFigSubplots(series.times(), series.values(), param_n, True, entity,
+                                         entity_num)
 
     def defineLineColor(self, entity, num):
         if entity == 'ap':
@@ -602,10 +536,8 @@ class BeeRocksAnalyzerWidget(QWidget):
                 ax = None
                 for param_n in ar_lables:
                     if param_n.find("*") == -1:
-                        try:
-                            ar_t = getattr(BeeRocksAnalyzerWidget, param_n + "_t")
-                            ar_v = getattr(BeeRocksAnalyzerWidget, param_n + "_v")
-                        except Exception:
+                        series = self.series.get(param_n)
+                        if series is None:
                             continue
 
                         for s in range(len(self.subplots[f][p])):
@@ -613,8 +545,8 @@ class BeeRocksAnalyzerWidget(QWidget):
                             if param_n_tmp == param_n:
                                 update_subplot = True
                                 update_fig = True
-                                plot_line.set_data(ar_t, ar_v)
-                                min, max = self.getMinMax(ar_v)
+                                plot_line.set_data(series.times(), series.values())
+                                min, max = self.getMinMax(series)
                                 ymin.append(min)
                                 ymax.append(max)
                                 break
@@ -637,18 +569,8 @@ class BeeRocksAnalyzerWidget(QWidget):
             fig_num += 1
         self.threadEvent.set()
 
-    def getMinMax(self, vec):
-        if(len(vec) == 0):
-            return (0, 0)
-        vmax = vmin = 0
-        for i in range(len(vec)):
-            if vec[i] is None:
-                continue
-            if vmin > vec[i]:
-                vmin = vec[i]
-            if vmax < vec[i]:
-                vmax = vec[i]
-        return (vmin, vmax)
+    def getMinMax(self, series):
+        return series.min_max()
 
     def deleteOldSamples(self, fig):
         t_start = self.realtimeWindow_start - self.realtimeWindow
@@ -662,26 +584,10 @@ class BeeRocksAnalyzerWidget(QWidget):
             for p in range(len(self.figsInfo[f])):
                 ar_lables = self.figsInfo[f][p]
                 for param_n in ar_lables:
-                    try:
-                        ar_v = getattr(BeeRocksAnalyzerWidget, param_n + "_v")
-                        ar_t = getattr(BeeRocksAnalyzerWidget, param_n + "_t")
-                        idx = 0
-                        t_start_idx = -1
-                        while(idx < len(ar_t)):
-                            if ar_t[idx] >= t_start:
-                                t_start_idx = idx
-                                break
-                            idx += 1
+                    series = self.series.get(param_n)
+                    if series is not None:
                         # delete old elements
-                        if t_start_idx == -1:
-                            delattr(BeeRocksAnalyzerWidget, ar_v)
-                            delattr(BeeRocksAnalyzerWidget, ar_t)
-                            self.addRemoveNewFigSubplots(None, None, param_n, False, None, None)
-                        else:
-                            del ar_v[: t_start_idx]
-                            del ar_t[: t_start_idx]
-                    except Exception:
-                        pass
+                        series.delete_before(t_start)
 
     def setYticks(self, ax, vmax):
         if vmax != 0:
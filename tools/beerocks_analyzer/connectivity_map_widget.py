@@ -17,6 +17,8 @@ except ImportError:
 import pylab
 import matplotlib.pyplot as plt
 
+import log_parser
+
 matplotlib.use('Qt5Agg')
 
 
@@ -50,6 +52,8 @@ class ConnectivityMapWidget(QWidget):
         self.threadEvent = threading.Event()
         self.updateSig = UpdateSig()
         self.restartSig = UpdateSig()
+        # Set while a state is restored, so the map is redrawn only once at the end
+        self.hold_redraw = False
 
         self.figs_tab_widget = QTabWidget(self)
         vbox = QVBoxLayout()
@@ -675,97 +679,52 @@ class ConnectivityMapWidget(QWidget):
                 except Exception as e:  # TODO: too broad exception
                     self.logger.exception(e)
 
-    def readSample(self, line, param_t, is_start, is_stop):
-        if is_start:
+    def readSample(self, record):
+        if record.kind in (log_parser.START, log_parser.MARK):
             self.wait_for_start = False
             return
-        elif is_stop:
+        elif record.kind == log_parser.STOP:
             self.restartSig.sig.emit(1)
             return
 
-        param_n = []
-        param_v = []
-        i1 = line.find("|")
-        if(i1 == -1):
-            return
-
-        if ("Radio" in line) or ("VAP" in line):
-            line = line.replace(":", ":x,", 1)
-
-        i2 = line.find(",")
-        try:
-            param_m = str(line[i1+1:i2])
-            line_args = line[i2+1:].split(',')
-            param_n = []
-            for arg in line_args:
-                arg_val = arg.split(':')
-                key = arg_val[0].lower().strip()
-                param_n.append(key)
-                if ("mac" in key) or ("bssid" in key) or ("backhaul" in key):
-                    param_v.append(arg.replace(":", "=", 1).split("=")[1].strip())
-                else:
-                    param_v.append(arg_val[1].strip())
-
-        except Exception as e:  # TODO: too broad exception
-            self.logger.error("Error, readSample() 1 line --> {}".format(line))
-            self.logger.exception(e)
-            return
-
-        if param_v is None:
-            self.logger.debug("self.param_v is null, returning")
-            return
-
-        param_m_val = param_m.split(':')
-        param_m_n = param_m_val[0].strip()
-        param_m_n_val = ""
-        if len(param_m_val) > 1:
-            param_m_n_val = param_m_val[1].strip()
-
-        if param_m_n == "Name":  # nw_map_update
+        fields = record.fields
+        if record.kind == log_parser.NODE:  # nw_map_update
             try:
-                i_state = param_n.index('state')
-                i_mac = param_n.index('mac')
-                i_type = param_n.index('type')
-                i_ip = param_n.index('ip')
-
-                state = (param_v[i_state].split())[0]
-                mac = param_v[i_mac]
-                line_type = param_v[i_type]
-                ip = param_v[i_ip]
-                name = param_m_n_val
-                channel = -1
-                bandwidth = -1
-                cac_completed = False
-                backhaul_mac = ""
-
-                if "2" in line_type:
-                    try:
-                        i_backhaul = param_n.index('backhaul')
-                        backhaul_mac = param_v[i_backhaul]
-                    except Exception as e:  # TODO: too broad exception
-                        self.logger.error("readSample()  --> {}, nw_map_update IRE line "
-                                          "does not contain a backhaul mac address".format(line))
-                        self.logger.exception(e)
-                        return
-
-                if "3" in line_type:
-                    try:
-                        i_channel = param_n.index('channel')
-                        channel = param_v[i_channel]
-                    except ValueError:
-                        self.logger.debug(
-                            "channel not available for client with mac {}".format(mac))
-                    try:
-                        i_bandwidth = param_n.index('bandwidth')
-                        bandwidth = param_v[i_bandwidth]
-                    except ValueError:
-                        self.logger.debug(
-                            "bandwidth not available for client with mac {}".format(mac))
-            except Exception as e:  # TODO: too broad Exception
+                state = fields['state'].split()[0]
+                mac = fields['mac']
+                line_type = fields['type']
+                ip = fields['ip']
+            except (KeyError, IndexError) as e:
                 self.logger.error("readSample()  --> {}, nw_map_update line does not contain "
-                                  "state or mac address or parent bssid or type".format(line))
+                                  "state or mac address or parent bssid or type".format(
+                                      record.line))
                 self.logger.exception(e)
                 return
+            name = record.value
+            channel = -1
+            bandwidth = -1
+            cac_completed = False
+            backhaul_mac = ""
+
+            if "2" in line_type:
+                if 'backhaul' not in fields:
+                    self.logger.error("readSample()  --> {}, nw_map_update IRE line "
+                                      "does not contain a backhaul mac address".format(
+                                          record.line))
+                    return
+                backhaul_mac = fields['backhaul']
+
+            if "3" in line_type:
+                if 'channel' in fields:
+                    channel = fields['channel']
+                else:
+                    self.logger.debug(
+                        "channel not available for client with mac {}".format(mac))
+                if 'bandwidth' in fields:
+                    bandwidth = fields['bandwidth']
+                else:
+                    self.logger.debug(
+                        "bandwidth not available for client with mac {}".format(mac))
 
             if state == "Connected":
                 if "1" in line_type:  # GW
@@ -774,19 +733,9 @@ class ConnectivityMapWidget(QWidget):
                     self.add_node_to_graph(cm)
                     self.last_ap_mac = mac
                 else:
-                    i_sta_id = -1
-                    sta_id = -1
-                    try:
-                        i_sta_id = param_n.index('sta_id')
-                        sta_id = int(param_v[i_sta_id])
-                    except Exception:
-                        pass
-                    try:
-                        i_parent_mac = param_n.index('parent bssid')
-                        parent_mac = param_v[i_parent_mac]
-                    except ValueError:
-                        # if it has no parent bssid, it should be connected to the gateway
-                        parent_mac = self.gw_eth_mac
+                    sta_id = fields.get('sta_id', -1)
+                    # if it has no parent bssid, it should be connected to the gateway
+                    parent_mac = fields.get('parent bssid', self.gw_eth_mac)
                     if "2" in line_type:  # IRE
                         cm = ConnectivityMapWidget.node('IRE', mac, parent_mac, backhaul_mac,
                                                         channel, bandwidth, cac_completed,
@@ -801,74 +750,59 @@ class ConnectivityMapWidget(QWidget):
             elif state == "Disconnected":
                 self.remove_node_by_mac(mac)
 
-        elif "Radio" in param_m_n:
+        elif record.kind == log_parser.RADIO:
             try:
-                i_channel = param_n.index('channel')
-                i_bandwidth = param_n.index('bandwidth')
-                i_cac_completed = param_n.index('cac completed')
-                i_ap_active = param_n.index('ap active')
-            except Exception:  # TODO: too broad exception
+                bandwidth = fields['bandwidth']
+                channel_string = fields['channel']
+                cac_completed_string = fields['cac completed']
+                self.last_radio_active_string = fields['ap active']
+            except KeyError:
                 self.logger.error("readSample()  --> {}, nw_map_update line "
                                   "does not contain channel or bandwidth or cac_completed "
-                                  "or ap_active".format(line))
+                                  "or ap_active".format(record.line))
                 return
 
-            bandwidth = param_v[i_bandwidth]
             self.last_radio_bandwidth = int(bandwidth)
 
-            channel_string = param_v[i_channel]
             if (channel_string == 'N/A'):
                 self.last_radio_channel = -1
             else:
                 self.last_radio_channel = int(channel_string)
 
-            cac_completed_string = param_v[i_cac_completed]
             if cac_completed_string == "1":
                 self.last_radio_cac_completed = True
             else:
                 self.last_radio_cac_completed = False
 
-            self.last_radio_active_string = param_v[i_ap_active]
             if self.last_radio_active_string == "true":
                 self.last_radio_active = True
             else:
                 self.last_radio_active = False
 
-        elif "VAP" in param_m_n:
-            try:
-                i_bssid = param_n.index('bssid')
-            except Exception:  # TODO: too broad exception
+        elif record.kind == log_parser.VAP:
+            if 'bssid' not in fields:
                 self.logger.error(
-                    "readSample()  --> {}, nw_map_update line does not contain bssid".format(line))
+                    "readSample()  --> {}, nw_map_update line does not contain bssid".format(
+                        record.line))
                 return
-            mac = param_v[i_bssid]
+            mac = fields['bssid']
             self.add_node_to_graph(ConnectivityMapWidget.node('RADIO', mac, self.last_ap_mac, "",
                                                               self.last_radio_channel,
                                                               self.last_radio_bandwidth,
                                                               self.last_radio_cac_completed,
                                                               self.last_radio_active))
 
-        elif param_m_n == "type" or param_m_n == "Type":
-            param_m_v = int(param_m_val[1].strip())
-            try:
-                i1 = param_n.index('mac')
-            except Exception:  # TODO: too broad exception
+        elif record.kind == log_parser.STATS:
+            if 'mac' not in fields:
                 self.logger.error(
                     "Error, readSample() --> {}, 'stats_update' line not contain mac address".
-                    format(line))
+                    format(record.line))
                 return
 
-            mac = param_v[i1]
-            i1 += 1
+            mac = fields['mac']
 
-            if param_m_v == 3:  # Client stats update
-                i_sta_id = -1
-                sta_id = -1
-                try:
-                    i_sta_id = param_n.index('sta_id')
-                    sta_id = int(param_v[i_sta_id])
-                except Exception:
-                    pass
+            if record.value == 3:  # Client stats update
+                sta_id = fields.get('sta_id', -1)
                 if sta_id != -1:  # new sta mac addr
                     for n in self.graph:
                         if mac == n.mac or mac == n.backhaul_mac:
@@ -894,6 +828,8 @@ class ConnectivityMapWidget(QWidget):
         self.figs_tab_widget.addTab(fig_frame, "ConnectivityMap")
 
     def sendSig(self):
+        if self.hold_redraw:
+            return
         self.updateSig.sig.emit(0)
         self.threadEvent.wait(2.0)
         self.threadEvent.clear()
@@ -0,0 +1,292 @@
+"""Sidecar index of the analyzer log, to seek in the log without replaying it from the start.
+
+The index of "<log>" is stored in "<log>.idx". It has one JSON object per line:
+    {"version": 1}                          header
+    {"start": offset}                       START marker, the log time restarts at 0 there
+    {"time": t, "offset": offset}           first line at or after time t, every TIME_STEP
+    {"mark": t, "offset": offset}           MARK marker
+    {"snapshot": t, "offset": offset, "stations": [...], "lines": [...]}
+    {"size": size}                          size of the log indexed so far
+Offsets are byte offsets in the log.
+
+A snapshot holds the state of the analyzer at its offset, every SNAPSHOT_INTERVAL seconds of log
+time. "lines" are the log lines that rebuild it: the last line of each node of the connectivity
+map (for a VAP, with the lines of its node and radio) and the last stats line of each AP and
+station. "stations" are the station MACs in the order the analyzer numbered them.
+
+To seek, the last snapshot before the target is restored and only the log between the snapshot
+and the target is replayed, which is at most SNAPSHOT_INTERVAL seconds of log whatever the
+length of the log.
+"""
+
+import bisect
+import json
+import logging
+import os
+
+import log_parser
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+# Log time in seconds between two time entries
+TIME_STEP = 1.0
+# Log time in seconds between two snapshots
+SNAPSHOT_INTERVAL = 30.0
+# Number of MARKs after which a node that was not updated is removed, as
+# ConnectivityMapWidget._MAX_LAST_SEEN.
+MAX_LAST_SEEN = 2
+
+
+def index_file_of(log_file: str) -> str:
+    """Get the path of the index of "log_file"."""
+    return log_file + ".idx"
+
+
+class LogIndexer:
+
+    def __init__(self, log_file: str):
+        """Builds the index of a log from the data appended to the log.
+
+        The index file is overwritten. The data is indexed with write(), and the index is written
+        to disk with flush(), so the indexer is a sink of the SocketServerThread.
+
+        Parameters
+        ----------
+        log_file: str
+            Path of the log to index.
+        """
+        self.file = open(index_file_of(log_file), 'w')
+        self.size = 0
+        self.flushed_size = -1
+        self.next_time = 0.0
+        self.next_snapshot = SNAPSHOT_INTERVAL
+        # [lines, number of MARKs since the last update, parent MAC] of each node of the
+        # connectivity map, by MAC.
+        self.nodes = {}
+        self.last_node_line = ""
+        self.last_node_mac = ""
+        self.last_radio_line = ""
+        # The last stats line, by stats type and MAC.
+        self.stats = {}
+        # The station MACs, in the order they are numbered (the values are not used).
+        self.stations = {}
+        self.write_entry({"version": VERSION})
+
+    def write_entry(self, entry: dict):
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def write(self, data: bytes):
+        """Index "data", the complete lines that were just appended to the log."""
+        offset = self.size
+        self.size += len(data)
+        for line in data.split(b'\n'):
+            if line:
+                self.add_line(offset, line.decode(errors='replace'))
+            offset += len(line) + 1
+
+    def add_line(self, offset: int, line: str):
+        separator = line.find('|')
+        if separator == -1:
+            return
+        try:
+            time = float(line[:separator])
+        except ValueError:
+            return
+        message = line[separator + 1:]
+
+        if message == "START":
+            self.write_entry({"start": offset})
+            self.next_time = time
+            self.next_snapshot = time + SNAPSHOT_INTERVAL
+        elif time >= self.next_snapshot:
+            self.write_entry({"snapshot": time, "offset": offset,
+                              "stations": list(self.stations), "lines": self.snapshot_lines()})
+            self.next_snapshot = time + SNAPSHOT_INTERVAL
+        if time >= self.next_time:
+            self.write_entry({"time": time, "offset": offset})
+            self.next_time = time + TIME_STEP
+
+        if message.startswith("Type:") or message.startswith("type:"):
+            # stats_update, by far the most common line: avoid parsing all the fields.
+            key_end = message.find(',', message.find(',') + 1)
+            key = message[:key_end] if key_end != -1 else message
+            self.stats[key] = line
+            stats_type, _, mac = key[5:].partition(',')
+            if stats_type.strip() == "3":  # Client stats update
+                self.stations.setdefault(mac.partition(':')[2].strip().lower())
+            return
+        if message == "MARK":
+            self.write_entry({"mark": time, "offset": offset})
+            for mac, node in list(self.nodes.items()):
+                node[1] += 1
+                if node[1] >= MAX_LAST_SEEN:
+                    del self.nodes[mac]
+            return
+
+        record = log_parser.parse_line(line)
+        if record is None:
+            return
+        fields = record.fields
+        if record.kind == log_parser.NODE:
+            mac = fields.get('mac')
+            line_type = fields.get('type', "")
+            state = fields.get('state', "").partition(" ")[0]
+            if mac is None:
+                return
+            self.last_node_line = line
+            self.last_node_mac = mac
+            if state == "Connected":
+                self.update_node(mac, [line], fields.get('parent bssid', ""))
+                if "2" in line_type or "3" in line_type:  # IRE or client
+                    # for IRE, the backhaul mac is the "client" mac
+                    sta_mac = fields.get('backhaul') if "2" in line_type else mac
+                    if sta_mac is not None:
+                        self.stations.setdefault(sta_mac)
+            elif state == "Disconnected":
+                self.remove_node(mac)
+        elif record.kind == log_parser.RADIO:
+            self.last_radio_line = line
+        elif record.kind == log_parser.VAP and 'bssid' in fields:
+            # The connectivity map attaches a VAP to the last node, with the last radio
+            # parameters: keep their lines with it.
+            self.update_node(fields['bssid'], [self.last_node_line, self.last_radio_line, line],
+                             self.last_node_mac)
+
+    def update_node(self, mac: str, lines: list, parent: str):
+        # Move the node to the end, so the nodes are restored in the order they were last sent,
+        # parents first.
+        self.nodes.pop(mac, None)
+        self.nodes[mac] = [lines, 0, parent]
+
+    def remove_node(self, mac: str):
+        """Remove a node and its children, as ConnectivityMapWidget.remove_node_by_mac."""
+        if self.nodes.pop(mac, None) is not None:
+            for child in [child for child, node in self.nodes.items() if node[2] == mac]:
+                self.remove_node(child)
+
+    def snapshot_lines(self) -> list:
+        lines = []
+        for node_lines, _, parent in self.nodes.values():
+            # Skip the VAPs whose node was removed, replaying its line would add it back.
+            if len(node_lines) == 1 or parent in self.nodes:
+                lines += node_lines
+        return lines + list(self.stats.values())
+
+    def flush(self):
+        """Write the index of the data added so far to disk."""
+        if self.size != self.flushed_size:
+            self.write_entry({"size": self.size})
+            self.flushed_size = self.size
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class LogIndex:
+
+    def __init__(self, log_file: str):
+        """The index of a log, as read from its index file.
+
+        Parameters
+        ----------
+        log_file: str
+            Path of the log.
+        """
+        self.log_file = log_file
+        self.index_file = index_file_of(log_file)
+        self.clear()
+
+    def clear(self):
+        # Offsets of the START markers
+        self.starts = []
+        # (time, offset) of the time entries and of the MARK markers
+        self.times = []
+        self.marks = []
+        # (time, offset, position in the index file) of the snapshots
+        self.snapshots = []
+        self.size = 0
+        # Position in the index file up to which it was read
+        self.position = 0
+
+    def update(self, build: bool = False):
+        """Read the entries that were added to the index file since the last update.
+
+        Parameters
+        ----------
+        build: bool
+            If True, (re)build the index file when it does not cover the whole log. Use it for
+            logs that are not being written by the SocketServerThread.
+        """
+        self.read()
+        if build and self.size != os.path.getsize(self.log_file):
+            logger.info("Indexing {}...".format(self.log_file))
+            indexer = LogIndexer(self.log_file)
+            with open(self.log_file, 'rb') as log:
+                rest = b""
+                while True:
+                    chunk = log.read(1 << 20)
+                    if not chunk:
+                        break
+                    chunk = rest + chunk
+                    end = chunk.rfind(b'\n') + 1
+                    indexer.write(chunk[:end])
+                    rest = chunk[end:]
+                # The last line is not complete, it is not indexed.
+                indexer.size += len(rest)
+            indexer.close()
+            logger.info("Done.")
+            self.clear()
+            self.read()
+
+    def read(self):
+        try:
+            file = open(self.index_file, 'rb')
+        except FileNotFoundError:
+            self.clear()
+            return
+        with file:
+            if os.fstat(file.fileno()).st_size < self.position:
+                # The index file was rewritten
+                self.clear()
+            file.seek(self.position)
+            while True:
+                position = file.tell()
+                line = file.readline()
+                if not line.endswith(b'\n'):
+                    # Not written completely yet
+                    break
+                entry = json.loads(line)
+                if "version" in entry:
+                    if entry["version"] != VERSION:
+                        logger.warning("Unknown version of {}, ignoring it".format(
+                            self.index_file))
+                        break
+                elif "size" in entry:
+                    self.size = entry["size"]
+                elif "time" in entry:
+                    self.times.append((entry["time"], entry["offset"]))
+                elif "mark" in entry:
+                    self.marks.append((entry["mark"], entry["offset"]))
+                elif "start" in entry:
+                    self.starts.append(entry["start"])
+                elif "snapshot" in entry:
+                    self.snapshots.append((entry["snapshot"], entry["offset"], position))
+            self.position = position
+
+    def snapshot_before(self, offset: int):
+        """Get the last snapshot at or before "offset".
+
+        Returns
+        -------
+        Union[dict, None]
+            The snapshot entry, None if there is none before "offset".
+        """
+        i = bisect.bisect_right([o for _, o, _ in self.snapshots], offset) - 1
+        if i < 0:
+            return None
+        with open(self.index_file, 'rb') as file:
+            file.seek(self.snapshots[i][2])
+            return json.loads(file.readline())
@@ -0,0 +1,134 @@
+"""Parser for the lines of the analyzer log.
+
+Each line of the log is "<time>|<message>", where the message is what beerocks_cli -a sent, e.g.
+    12.345|Name: gateway, Type: GW (1), State: Connected (2), MAC: aa:bb:cc:dd:ee:ff, IP: ...
+    12.345|  Radio[0]: Interface: wlan0, Vendor: Intel, Channel: 36, Bandwidth: 80, ...
+    12.345|    VAP[0]: BSSID: aa:bb:cc:dd:ee:ff, SSID: prplmesh
+    12.345|Type: 3, mac: aa:bb:cc:dd:ee:ff, measurement_window_msec: 1000, ...
+or one of the markers START, STOP and MARK added by the analyzer itself.
+
+A line is parsed once into a LogRecord, which is then passed to all the widgets.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Kinds of records
+START = "start"
+STOP = "stop"
+MARK = "mark"
+NODE = "node"  # nw_map_update of a GW, IRE or client
+RADIO = "radio"
+VAP = "vap"
+STATS = "stats"  # stats_update, the stats type is the value of the record
+EVENT = "event"  # BML_EVENT
+OTHER = "other"
+
+_MARKERS = {"START": START, "STOP": STOP, "MARK": MARK}
+
+
+def is_mac_field(key: str) -> bool:
+    """Check if the field with (lower case) name "key" contains a MAC address."""
+    return "mac" in key or "bssid" in key or "backhaul" in key or "bridge" in key
+
+
+class LogRecord:
+    """A parsed line of the analyzer log.
+
+    Attributes
+    ----------
+    time: float
+        The time of the line, in seconds since the start of the log.
+    kind: str
+        What the line is about, one of the kinds defined in this module.
+    name: str
+        The name of the first item of the message, e.g. "Name", "Type" or "Radio[0]".
+    value: str
+        The value of the first item of the message, e.g. the node name for a NODE record. For a
+        STATS record, it is the stats type as int.
+    fields: dict
+        The other items of the message, by lower case name. MAC addresses are lower case.
+    line: str
+        The line as it was read.
+    """
+
+    __slots__ = ('time', 'kind', 'name', 'value', 'fields', 'line')
+
+    def __init__(self, time: float, kind: str, name: str = "", value="", fields: dict = None,
+                 line: str = ""):
+        self.time = time
+        self.kind = kind
+        self.name = name
+        self.value = value
+        self.fields = fields if fields is not None else {}
+        self.line = line
+
+    def __repr__(self):
+        return "LogRecord({!r}, {!r}, {!r}, {!r}, {!r})".format(self.time, self.kind, self.name,
+                                                                self.value, self.fields)
+
+
+def parse_fields(text: str) -> dict:
+    """Parse comma separated "key: value" items into a dict."""
+    fields = {}
+    for item in text.split(','):
+        key, _, value = item.partition(':')
+        key = key.strip().lower()
+        if not key:
+            continue
+        value = value.strip()
+        if is_mac_field(key):
+            value = value.lower()
+        fields[key] = value
+    return fields
+
+
+def parse_line(line: str):
+    """Parse a line of the analyzer log.
+
+    Returns
+    -------
+    Union[LogRecord, None]
+        The record, or None for comments and lines that are not valid.
+    """
+    if line.startswith("#") or len(line) < 4:
+        return None
+    separator = line.find("|")
+    if separator == -1:
+        return None
+    try:
+        time = float(line[:separator])
+    except ValueError:
+        logger.error("parse_line() invalid time --> {}".format(line))
+        return None
+    message = line[separator + 1:].strip()
+
+    kind = _MARKERS.get(message)
+    if kind:
+        return LogRecord(time, kind, message, line=line)
+    if "BML_EVENT" in message:
+        return LogRecord(time, EVENT, line=line)
+
+    head, _, rest = message.partition(',')
+    name, _, value = head.partition(':')
+    name = name.strip()
+    value = value.strip()
+    if name.startswith("Radio") or name.startswith("VAP"):
+        # The first item is not a value of its own, but the first field, e.g.
+        # "Radio[0]: Interface: wlan0, ...".
+        rest = value + "," + rest
+        value = ""
+        kind = RADIO if name.startswith("Radio") else VAP
+    elif name == "Name":
+        kind = NODE
+    elif name in ("Type", "type"):
+        kind = STATS
+        try:
+            value = int(value)
+        except ValueError:
+            logger.error("parse_line() invalid stats type --> {}".format(line))
+            return None
+    else:
+        kind = OTHER
+    return LogRecord(time, kind, name, value, parse_fields(rest), line)
@@ -3,6 +3,8 @@ from PySide2.QtCore import Signal, QObject
 from PySide2.QtGui import QTextCursor
 from PySide2.QtWidgets import QWidget, QTextEdit, QTabWidget, QFormLayout
 
+import log_parser
+
 
 class UpdateSig(QObject):
     sig = Signal(float)
@@ -39,7 +41,7 @@ class LoggerWidget(QWidget):
         self.updateSig = UpdateSig()
         self.restartSig = UpdateSig()
 
-    def readSampleAndUpdateLogger(self, line, param_t1, is_start, is_stop):
-        if "BML_EVENT" in line:
-            self.logOutput.insertPlainText(line)
+    def readSampleAndUpdateLogger(self, record):
+        if record.kind == log_parser.EVENT:
+            self.logOutput.insertPlainText(record.line)
             self.logOutput.moveCursor(QTextCursor.End)
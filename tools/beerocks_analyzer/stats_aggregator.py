@@ -0,0 +1,124 @@
+"""Aggregation of the stats sent by a controller into min/max/mean/p95 per interval.
+
+The aggregates are written to a gzip compressed CSV file with the columns of HEADER, e.g.
+    time,entity,mac,metric,count,min,max,mean,p95
+    1603000800,sta,02:00:00:00:00:75,signal_strength,60,-52,-40,-44.2,-41
+"time" is the start of the interval, in seconds since the epoch. "entity" is "ap", "vap" or
+"sta", as the stats types of bml_defs.h.
+"""
+
+import array
+import csv
+import gzip
+import math
+import time
+
+import log_parser
+
+# The entity of each stats type
+ENTITIES = {1: "ap", 2: "vap", 3: "sta"}
+HEADER = ("time", "entity", "mac", "metric", "count", "min", "max", "mean", "p95")
+
+
+def percentile_of(values: list, percentile: float) -> float:
+    """Get the "percentile" (nearest rank) of the sorted list "values"."""
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def _compact(value: float):
+    return int(value) if value.is_integer() else round(value, 3)
+
+
+class StatsAggregator:
+
+    def __init__(self, out_file: str, interval: float = 60.0):
+        """Sink of the SocketServerThread that aggregates the stats of a controller.
+
+        During an interval, the samples of each metric of each AP and station are kept in an
+        array of doubles. At the end of the interval, a row with the number of samples, their
+        minimum, maximum, mean and 95th percentile is written for each metric, and the samples
+        are dropped. The memory used is bounded by the number of samples of a single interval,
+        however long the aggregator runs and however many stations come and go.
+
+        Parameters
+        ----------
+        out_file: str
+            Path of the gzip compressed CSV file to write the aggregates to. It is overwritten.
+        interval: float
+            The aggregation interval, in seconds.
+        """
+        self.interval = interval
+        self.out = gzip.open(out_file, 'wt', newline='')
+        self.writer = csv.writer(self.out)
+        self.writer.writerow(HEADER)
+        # Start of the current interval, in seconds since the epoch
+        self.interval_start = self.interval_start_of(time.time())
+        # The samples of the current interval, by (entity, MAC, metric)
+        self.samples = {}
+
+    def write(self, data: bytes):
+        """Aggregate the stats lines of "data", complete lines of the analyzer log."""
+        self.check_interval()
+        for line in data.decode(errors='replace').split('\n'):
+            # Only the stats lines are parsed, i.e. the ones starting with "<time>|Type: ".
+            separator = line.find('|')
+            if line[separator + 1:separator + 5] not in ("Type", "type"):
+                continue
+            record = log_parser.parse_line(line)
+            if record is None or record.kind != log_parser.STATS:
+                continue
+            mac = record.fields.get('mac')
+            if mac is None:
+                continue
+            entity = ENTITIES.get(record.value, "type{}".format(record.value))
+            for name, value in record.fields.items():
+                if name in ('mac', 'ap_id', 'sta_id'):
+                    continue
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+                key = (entity, mac, name)
+                samples = self.samples.get(key)
+                if samples is None:
+                    samples = self.samples[key] = array.array('d')
+                samples.append(value)
+
+    def interval_start_of(self, t: float) -> float:
+        return math.floor(t / self.interval) * self.interval
+
+    def check_interval(self):
+        """Write the aggregates of the current interval if it is over.
+
+        The end of the interval is checked against the clock, so it does not depend on incoming
+        data: the server calls it through flush() every FLUSH_INTERVAL, so the aggregates of a
+        controller that went quiet are still written when its interval ends.
+        """
+        now = time.time()
+        if now < self.interval_start + self.interval:
+            return
+        if self.samples:
+            self.roll_up()
+        self.interval_start = self.interval_start_of(now)
+
+    def roll_up(self):
+        interval_start = _compact(float(self.interval_start))
+        for (entity, mac, metric), samples in self.samples.items():
+            values = sorted(samples)
+            self.writer.writerow((interval_start, entity, mac, metric, len(values),
+                                  _compact(values[0]), _compact(values[-1]),
+                                  _compact(sum(values) / len(values)),
+                                  _compact(percentile_of(values, 95))))
+        self.samples = {}
+        self.out.flush()
+
+    def flush(self):
+        # Called periodically by the server, also without new data. The aggregates are only
+        # written and flushed at the end of an interval, flushing a gzip file more often makes it
+        # less compact.
+        self.check_interval()
+
+    def close(self):
+        if self.samples:
+            self.roll_up()
+        self.out.close()
@@ -0,0 +1,69 @@
+"""Fixed size time series of the values of a metric, e.g. the RSSI of a station."""
+
+import numpy as np
+
+
+class TimeSeries:
+
+    # A gap is shown in the series when two samples are more than GAP seconds apart.
+    GAP = 3.0
+
+    def __init__(self, capacity: int):
+        """Ring buffer of the last "capacity" (time, value) samples of a metric.
+
+        The samples are kept twice in buffers of 2 * capacity, so the samples held are always
+        available as contiguous arrays (see times() and values()) without copying them.
+        A gap in the series is marked by a NaN value.
+
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of samples held, including the gap markers. When it is full, the
+            oldest sample is dropped for each new sample.
+        """
+        self.capacity = capacity
+        self._t = np.zeros(2 * capacity)
+        self._v = np.zeros(2 * capacity)
+        # Index of the next sample to write, in [0, capacity)
+        self._next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _write(self, t: float, v: float):
+        i = self._next
+        self._t[i] = self._t[i + self.capacity] = t
+        self._v[i] = self._v[i + self.capacity] = v
+        self._next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def append(self, t: float, v: float):
+        """Add a sample, after a gap marker if the previous one is more than GAP seconds old."""
+        if self.count and t - self.last_time() > self.GAP:
+            self._write(t - 0.1, np.nan)
+        self._write(t, v)
+
+    def last_time(self) -> float:
+        return self._t[self._next + self.capacity - 1]
+
+    def times(self) -> np.ndarray:
+        """Get the times of the samples, oldest first. The array is a view on the buffer."""
+        end = self._next + self.capacity
+        return self._t[end - self.count:end]
+
+    def values(self) -> np.ndarray:
+        """Get the values of the samples, oldest first. The array is a view on the buffer."""
+        end = self._next + self.capacity
+        return self._v[end - self.count:end]
+
+    def delete_before(self, t: float):
+        """Drop the samples older than "t"."""
+        self.count -= int(np.searchsorted(self.times(), t))
+
+    def min_max(self) -> tuple:
+        """Get the minimum and maximum value, extended to include 0. Gaps are ignored."""
+        values = self.values()
+        if not values.size or np.isnan(values).all():
+            return (0, 0)
+        return (min(0, np.nanmin(values)), max(0, np.nanmax(values)))